@@ -9,6 +9,16 @@
 #    into a JSON file (/app/data.json)
 #
 # Note: Adjust the file names if your actual use case differs.
+#
+# Pass -Incremental to only re-read question and answer files that changed since
+# the last incremental run and patch /app/data.jsonl in place.
+#
+# Pass -Workers to convert byte ranges of /app/data.jsonl in that many processes.
+
+param (
+    [switch]$Incremental,
+    [int]$Workers = 1
+)
 
 # Define fixed values for directories, file names, and container/environment
 $inputDir = "/var/kolo_data/qa_generation_output"
@@ -20,7 +30,11 @@ $envActivate = "source /opt/conda/bin/activate kolo_env"
 # Step 1: Run parse_qa_data.py inside the container
 try {
     Write-Host "Running parse_qa_data.py in container $containerName..."
-    docker exec -it $containerName bash -c "$envActivate && python /app/parse_qa_data.py"
+    $parseArgs = ""
+    if ($Incremental) {
+        $parseArgs = "--incremental"
+    }
+    docker exec -it $containerName bash -c "$envActivate && python /app/parse_qa_data.py $parseArgs"
     
     if ($LASTEXITCODE -eq 0) {
         Write-Host "parse_qa_data.py executed successfully." -ForegroundColor Green
@@ -38,7 +52,7 @@ catch {
 # Step 2: Run convert_jsonl_to_json.py inside the container
 try {
     Write-Host "Running convert_jsonl_to_json.py in container $containerName..."
-    docker exec -it $containerName bash -c "$envActivate && python /app/convert_jsonl_to_json.py '$qaJsonlFile' '$finalJsonFile'"
+    docker exec -it $containerName bash -c "$envActivate && python /app/convert_jsonl_to_json.py '$qaJsonlFile' '$finalJsonFile' --workers $Workers"
     
     if ($LASTEXITCODE -eq 0) {
         Write-Host "Conversion successful! JSON file created at $finalJsonFile." -ForegroundColor Green
@@ -8,6 +8,8 @@
 .EXAMPLE
     .\generate_qa_data.ps1 -OpenAI_API_KEY "your_api_key_here" -GroupWorkers 8 -AnswerWorkers 4
     .\generate_qa_data.ps1 -GroupWorkers 8 -AnswerWorkers 4
+    .\generate_qa_data.ps1 -Threads 256 -Engine async
+    .\generate_qa_data.ps1 -Plan
 #>
 
 [CmdletBinding()]
@@ -16,7 +18,14 @@ param(
     [string]$OpenAI_API_KEY,
     
     [Parameter(Mandatory = $false, HelpMessage = "Max workers for processing.")]
-    [int]$Threads = 8
+    [int]$Threads = 8,
+
+    [Parameter(Mandatory = $false, HelpMessage = "Execution engine: threads, async or batch.")]
+    [ValidateSet("threads", "async", "batch")]
+    [string]$Engine = "threads",
+
+    [Parameter(Mandatory = $false, HelpMessage = "Only estimate the requests and prompt tokens of the run.")]
+    [switch]$Plan
 )
 
 # Define the container name
@@ -31,7 +40,10 @@ if (-Not $containerRunning) {
 }
 
 # Build the command string to execute inside the container.
-$baseCommand = "source /opt/conda/bin/activate kolo_env && python /app/generate_qa_data.py --threads $Threads"
+$baseCommand = "source /opt/conda/bin/activate kolo_env && python /app/generate_qa_data.py --threads $Threads --engine $Engine"
+if ($Plan) {
+    $baseCommand += " --plan"
+}
 
 if ($OpenAI_API_KEY) {
     $command = "export OPENAI_API_KEY='$OpenAI_API_KEY'; $baseCommand"
@@ -0,0 +1,124 @@
+import json
+import re
+import threading
+from typing import Optional, List, Dict, Any, Tuple, Hashable
+
+DEFAULT_ANSWER_BATCHING_CONFIG = {
+    "enabled": False,
+    "questions_per_prompt": 8,  # Questions answered by one request; the file content is sent once for all of them.
+    "max_attempts": 3,          # Requests per batch; each retry only asks the questions that are still missing.
+}
+
+# Takes the place of {question} in the answer prompt.
+BATCH_QUESTION_TEMPLATE = (
+    "Answer each of the following {count} questions on its own.\n"
+    "{questions}\n"
+    "Respond only with a JSON object that maps each question number to its answer, "
+    'for example {{"1": "<answer to question 1>", "2": "<answer to question 2>"}}.'
+)
+
+class AnswerBatcher:
+    """
+    Packs several questions that share file content and answer instruction into
+    one answer prompt, asks for the answers as a JSON object keyed by question
+    number, and splits the response back into one answer per question. Questions
+    are collected per key until questions_per_prompt of them are waiting; the rest
+    are drained once the group has no question requests left.
+    """
+    def __init__(self, questions_per_prompt: int, max_attempts: int):
+        self.questions_per_prompt = max(questions_per_prompt, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.lock = threading.Lock()
+        self.pending: Dict[Hashable, List[Any]] = {}
+        self.open_tasks = 0
+
+    @staticmethod
+    def resolve_config(batching_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_ANSWER_BATCHING_CONFIG)
+        resolved.update(batching_config or {})
+        return resolved
+
+    @staticmethod
+    def from_config(batching_config: Optional[Dict[str, Any]]) -> Optional["AnswerBatcher"]:
+        config = AnswerBatcher.resolve_config(batching_config)
+        if not config["enabled"]:
+            return None
+        return AnswerBatcher(config["questions_per_prompt"], config["max_attempts"])
+
+    def start_tasks(self, count: int) -> None:
+        """Registers question tasks whose questions may still be added."""
+        with self.lock:
+            self.open_tasks += count
+
+    def finish_task(self) -> bool:
+        """Marks one question task as finished; True once none are left and the rest should be drained."""
+        with self.lock:
+            self.open_tasks -= 1
+            return self.open_tasks <= 0
+
+    def add(self, key: Hashable, item: Any) -> Optional[List[Any]]:
+        """Adds a question; returns a full batch once questions_per_prompt are waiting under key."""
+        with self.lock:
+            items = self.pending.setdefault(key, [])
+            items.append(item)
+            if len(items) < self.questions_per_prompt:
+                return None
+            del self.pending[key]
+            return items
+
+    def drain(self) -> List[Tuple[Hashable, List[Any]]]:
+        """Returns the partly filled batches and forgets them."""
+        with self.lock:
+            batches = list(self.pending.items())
+            self.pending = {}
+        return batches
+
+    def chunks(self, items: List[Any]) -> List[List[Any]]:
+        size = self.questions_per_prompt
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    @staticmethod
+    def question_block(questions: List[str]) -> str:
+        numbered = "\n".join(f"{number}. {question}" for number, question in enumerate(questions, start=1))
+        return BATCH_QUESTION_TEMPLATE.format(count=len(questions), questions=numbered)
+
+    @staticmethod
+    def schema(count: int) -> Dict[str, Any]:
+        """JSON schema for Ollama's format option: one required string per question number."""
+        keys = [str(number) for number in range(1, count + 1)]
+        return {
+            "type": "object",
+            "properties": {key: {"type": "string"} for key in keys},
+            "required": keys,
+        }
+
+    @staticmethod
+    def parse(text: Optional[str], count: int) -> Dict[int, str]:
+        """
+        Maps question numbers 1..count to the non-empty answers found in a response.
+        Accepts an object keyed by number (optionally wrapped in a code fence) or a
+        list of answers in question order; anything else yields no answers.
+        """
+        if not text:
+            return {}
+        match = re.search(r"[\[{].*[\]}]", text, re.DOTALL)
+        if match is None:
+            return {}
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            return {}
+        if isinstance(data, list):
+            data = {str(number): value for number, value in enumerate(data, start=1)}
+        if not isinstance(data, dict):
+            return {}
+        answers = {}
+        for key, value in data.items():
+            number = re.sub(r"\D", "", str(key))
+            if not number or not 1 <= int(number) <= count:
+                continue
+            if isinstance(value, dict):
+                value = value.get("answer")
+            if isinstance(value, str) and value.strip():
+                answers[int(number)] = value.strip()
+        return answers
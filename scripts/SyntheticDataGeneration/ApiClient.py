@@ -1,16 +1,13 @@
-import os
-import re
-import yaml
-import argparse
+import json
 import requests
-import hashlib
-import logging
-import random
 import time
-from pathlib import Path
-from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, Iterator
+from requests.adapters import HTTPAdapter
 
+from SyntheticDataGeneration.EndpointPool import Endpoint, EndpointPool
+from SyntheticDataGeneration.Metrics import RunMetrics
+from SyntheticDataGeneration.PrefixCache import PromptEvalStats
+from SyntheticDataGeneration.RateController import ProviderController, FATAL, UNAVAILABLE
 from SyntheticDataGeneration.Utils import Utils
 
 # Try importing the OpenAI client
@@ -20,61 +17,301 @@ except ImportError:
     OpenAI = None
     Utils.logger.warning("OpenAI package not installed; openai provider will not work.")
 
+DEFAULT_HTTP_CONFIG = {
+    "pool_size": 32,
+    "keep_alive": True,
+    "connect_timeout": 10,
+    "read_timeout": 60,
+    "stream": False,
+    "idle_timeout": 30,
+}
+
+class APIStreamError(Exception):
+    """Raised when a streamed response fails after part of it was delivered."""
+
 class APIClient:
-    def __init__(self, provider: str, model: str, global_ollama_url: Optional[str] = None, openai_client: Optional[OpenAI] = None):
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        global_ollama_url: Optional[str] = None,
+        openai_client: Optional[OpenAI] = None,
+        http_config: Optional[Dict[str, Any]] = None,
+        controller: Optional[ProviderController] = None,
+        endpoints: Optional[EndpointPool] = None,
+        options: Optional[Dict[str, Any]] = None,
+        keep_alive: Optional[str] = None,
+        prompt_stats: Optional[PromptEvalStats] = None,
+        phase: str = "",
+        metrics: Optional[RunMetrics] = None
+    ):
         self.provider = provider.lower()
         self.model = model
         self.global_ollama_url = global_ollama_url
         self.openai_client = openai_client
+        self.http_config = APIClient.resolve_http_config(http_config)
+        self.timeout = (self.http_config["connect_timeout"], self.http_config["read_timeout"])
+        self.stream = self.http_config["stream"]
+        self.stream_timeout = (self.http_config["connect_timeout"], self.http_config["idle_timeout"])
+        self.controller = controller or ProviderController(self.provider, ProviderController.resolve_config({"enabled": False}), 1)
+        self.endpoints = APIClient.resolve_endpoints(self.provider, global_ollama_url, self.controller, endpoints)
+        self.session = (
+            APIClient.create_session(self.http_config, len(self.endpoints.endpoints)) if self.provider == "ollama" else None
+        )
+        # Ollama model options (num_ctx, temperature, ...); keep_alive is how long Ollama keeps the model loaded.
+        self.options: Dict[str, Any] = dict(options or {})
+        self.keep_alive = keep_alive
+        self.prompt_stats = prompt_stats
+        # Metrics are labelled by provider, model and phase ("questions" or "answers").
+        self.labels = (self.provider, self.model, phase)
+        self.metrics = metrics
+
+    @staticmethod
+    def resolve_http_config(http_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_HTTP_CONFIG)
+        resolved.update(http_config or {})
+        return resolved
+
+    @staticmethod
+    def resolve_endpoints(
+        provider: str, global_ollama_url: Optional[str], controller: ProviderController, endpoints: Optional[EndpointPool]
+    ) -> EndpointPool:
+        """
+        Ollama requests are routed through an EndpointPool. Without one (a single URL,
+        or the openai provider, whose SDK client holds its own URL) every request
+        goes to one endpoint governed by this client's controller.
+        """
+        if provider == "ollama" and endpoints is not None:
+            return endpoints
+        if provider == "ollama" and not global_ollama_url:
+            return EndpointPool([])
+        return EndpointPool([Endpoint(global_ollama_url if provider == "ollama" else None, controller)])
+
+    @staticmethod
+    def create_session(http_config: Dict[str, Any], host_count: int = 1) -> requests.Session:
+        """
+        Creates a session backed by a connection pool. urllib3 pools are thread-safe,
+        so one session is shared by every worker thread using this client; with
+        pool_block the pool never grows past pool_size connections per host.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max(host_count, 1),
+            pool_maxsize=http_config["pool_size"],
+            pool_block=True,
+            max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not http_config["keep_alive"]:
+            session.headers["Connection"] = "close"
+        return session
+
+    def close(self) -> None:
+        if self.session is not None:
+            self.session.close()
+
+    def cache_identity(self) -> Dict[str, Any]:
+        """Everything besides the prompt that determines the response; part of every cache key."""
+        return {"provider": self.provider, "model": self.model, "options": self.options}
+
+    @staticmethod
+    def openai_format(schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # Ollama is given the JSON schema itself; OpenAI's JSON mode only guarantees a JSON object.
+        return {"response_format": {"type": "json_object"}} if schema is not None else {}
+
+    # The request functions take the endpoint URL (the OpenAI client already holds its own)
+    # and the prompt's prefix key, used to attribute Ollama's prompt evaluation stats.
+    def _request_openai(
+        self, prompt: str, url: Optional[str], prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        response = self.openai_client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model,
+            **self.openai_format(schema)
+        )
+        if response.usage is not None:
+            self.record_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    def _request_ollama(
+        self, prompt: str, url: str, prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False,
+            "options": self.options
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        if schema is not None:
+            payload["format"] = schema
+        response = self.session.post(url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        self.record_usage(prefix, result)
+        return result.get("response", "").strip()
+
+    def _stream_openai(
+        self, prompt: str, url: Optional[str], prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Iterator[str]:
+        response = self.openai_client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model,
+            stream=True,
+            **self.openai_format(schema)
+        )
+        for chunk in response:
+            if getattr(chunk, "usage", None) is not None:
+                self.record_tokens(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
-    def call_api(self, prompt: str) -> Optional[str]:
-        max_retries = 5
-        backoff_factor = 1
+    def _stream_ollama(
+        self, prompt: str, url: str, prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Iterator[str]:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": True,
+            "options": self.options
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        if schema is not None:
+            payload["format"] = schema
+        # With stream=True the read timeout applies to each socket read, so it
+        # acts as an idle-token timeout rather than a limit on the whole response.
+        with self.session.post(url, json=payload, timeout=self.stream_timeout, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                if "error" in result:
+                    raise APIStreamError(result["error"])
+                if result.get("response"):
+                    yield result["response"]
+                if result.get("done"):
+                    self.record_usage(prefix, result)
+                    return
+
+    def record_usage(self, prefix: Optional[str], result: Dict[str, Any]) -> None:
+        """Records the token counts of an Ollama response."""
+        if self.prompt_stats is not None:
+            self.prompt_stats.record(prefix, result)
+        self.record_tokens(result.get("prompt_eval_count"), result.get("eval_count"))
+
+    def record_tokens(self, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+        if self.metrics is not None:
+            self.metrics.record_tokens(self.labels, prompt_tokens, completion_tokens)
+
+    def record_attempt(self, request_started: float, kind: str = "") -> None:
+        if self.metrics is not None:
+            self.metrics.record_request(self.labels, time.monotonic() - request_started, kind)
+
+    def record_retry(self, kind: str) -> None:
+        if self.metrics is not None:
+            self.metrics.record_retry(self.labels, kind)
+
+    def _resolve_provider(self, streaming: bool):
         if self.provider == "openai":
             if not self.openai_client:
                 Utils.logger.error("OpenAI client not initialized.")
-                return None
-            attempt = 0
-            while attempt <= max_retries:
-                try:
-                    response = self.openai_client.chat.completions.create(
-                        messages=[{"role": "user", "content": prompt}],
-                        model=self.model
-                    )
-                    return response.choices[0].message.content
-                except Exception as e:
-                    Utils.logger.error(f"OpenAI API error on attempt {attempt+1}/{max_retries}: {e}")
-                    if attempt == max_retries:
-                        return None
-                    sleep_time = backoff_factor * (2 ** attempt) + random.uniform(0, 1)
-                    Utils.logger.info(f"Retrying OpenAI API call in {sleep_time:.2f} seconds...")
-                    time.sleep(sleep_time)
-                    attempt += 1
+                return None, None
+            return (self._stream_openai if streaming else self._request_openai), "OpenAI"
         elif self.provider == "ollama":
-            if not self.global_ollama_url:
+            if not self.endpoints.endpoints:
                 Utils.logger.error("Global Ollama URL not provided.")
+                return None, None
+            return (self._stream_ollama if streaming else self._request_ollama), "Ollama"
+        Utils.logger.error(f"Unknown provider specified: {self.provider}")
+        return None, None
+
+    def call_api(
+        self, prompt: str, prefix: Optional[str] = None, schema: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """
+        prefix identifies prompts that start with the same content, for endpoint affinity
+        and cache stats. With a JSON schema the response is requested as JSON.
+        """
+        if self.stream:
+            try:
+                return "".join(self.stream_api(prompt, prefix, schema)).strip()
+            except APIStreamError as e:
+                Utils.logger.error(f"Streaming API call failed: {e}")
                 return None
-            payload = {
-                "model": self.model,
-                "prompt": prompt,
-                "stream": False,
-                "options": {}
-            }
-            attempt = 0
-            while attempt <= max_retries:
-                try:
-                    response = requests.post(self.global_ollama_url, json=payload, timeout=60)
-                    response.raise_for_status()
-                    result = response.json()
-                    return result.get("response", "").strip()
-                except Exception as e:
-                    Utils.logger.error(f"Ollama API error on attempt {attempt+1}/{max_retries}: {e}")
-                    if attempt == max_retries:
-                        return None
-                    sleep_time = backoff_factor * (2 ** attempt) + random.uniform(0, 1)
-                    Utils.logger.info(f"Retrying Ollama API call in {sleep_time:.2f} seconds...")
-                    time.sleep(sleep_time)
-                    attempt += 1
-        else:
-            Utils.logger.error(f"Unknown provider specified: {self.provider}")
-            return None
\ No newline at end of file
+
+        max_retries = self.controller.max_retries
+        request, label = self._resolve_provider(streaming=False)
+        if request is None:
+            return None
+        attempt = 0
+        while attempt <= max_retries:
+            endpoint, started_at = self.endpoints.acquire(prefix)
+            request_started = time.monotonic()
+            try:
+                result = request(prompt, endpoint.url, prefix, schema)
+            except Exception as e:
+                kind = self.endpoints.release(endpoint, started_at, e)
+                self.record_attempt(request_started, kind)
+                Utils.logger.error(f"{label} API error ({kind}) on attempt {attempt+1}/{max_retries}: {e}")
+                if kind == FATAL or attempt == max_retries:
+                    return None
+                sleep_time = self.retry_delay(endpoint, kind, attempt)
+                Utils.logger.info(f"Retrying {label} API call in {sleep_time:.2f} seconds...")
+                self.record_retry(kind)
+                time.sleep(sleep_time)
+                attempt += 1
+                continue
+            self.endpoints.release(endpoint, started_at)
+            self.record_attempt(request_started)
+            return result
+
+    def retry_delay(self, endpoint: Endpoint, kind: str, attempt: int) -> float:
+        # A request to an unreachable endpoint is re-routed at once if another endpoint is up.
+        if kind == UNAVAILABLE and self.endpoints.can_reroute(endpoint):
+            return 0.0
+        return self.controller.backoff_time(attempt)
+
+    def stream_api(
+        self, prompt: str, prefix: Optional[str] = None, schema: Optional[Dict[str, Any]] = None
+    ) -> Iterator[str]:
+        """
+        Yields response text fragments as they arrive. A failed attempt is retried
+        only if nothing has been yielded yet; once the caller has seen part of a
+        response the error is raised as APIStreamError instead.
+        """
+        max_retries = self.controller.max_retries
+        request, label = self._resolve_provider(streaming=True)
+        if request is None:
+            raise APIStreamError(f"Provider '{self.provider}' is not configured for streaming.")
+        attempt = 0
+        while True:
+            yielded = False
+            endpoint, started_at = self.endpoints.acquire(prefix)
+            request_started = time.monotonic()
+            try:
+                for fragment in request(prompt, endpoint.url, prefix, schema):
+                    yielded = True
+                    yield fragment
+            except GeneratorExit:
+                # The caller stopped reading; give the slot back.
+                self.endpoints.release(endpoint, started_at)
+                raise
+            except Exception as e:
+                kind = self.endpoints.release(endpoint, started_at, e)
+                self.record_attempt(request_started, kind)
+                Utils.logger.error(f"{label} streaming error ({kind}) on attempt {attempt+1}/{max_retries}: {e}")
+                if yielded or kind == FATAL or attempt == max_retries:
+                    raise APIStreamError(str(e)) from e
+                sleep_time = self.retry_delay(endpoint, kind, attempt)
+                Utils.logger.info(f"Retrying {label} streaming call in {sleep_time:.2f} seconds...")
+                self.record_retry(kind)
+                time.sleep(sleep_time)
+                attempt += 1
+                continue
+            self.endpoints.release(endpoint, started_at)
+            self.record_attempt(request_started)
+            return
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import time
+from typing import Optional, Dict, Any, AsyncIterator
+
+from SyntheticDataGeneration.ApiClient import APIClient, APIStreamError
+from SyntheticDataGeneration.EndpointPool import Endpoint, EndpointPool
+from SyntheticDataGeneration.Metrics import RunMetrics
+from SyntheticDataGeneration.PrefixCache import PromptEvalStats
+from SyntheticDataGeneration.RateController import ProviderController, FATAL, UNAVAILABLE
+from SyntheticDataGeneration.Utils import Utils
+
+# Try importing the async HTTP and OpenAI clients
+try:
+    import httpx
+except ImportError:
+    httpx = None
+    Utils.logger.warning("httpx package not installed; async ollama provider will not work.")
+
+try:
+    from openai import AsyncOpenAI
+except ImportError:
+    AsyncOpenAI = None
+    Utils.logger.warning("OpenAI package not installed; async openai provider will not work.")
+
+class AsyncAPIClient:
+    """
+    Asyncio version of APIClient. All clients of a run share one semaphore, so the
+    number of requests in flight never exceeds the configured limit no matter how
+    many groups, questions or answers are scheduled at once.
+    """
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        semaphore: asyncio.Semaphore,
+        global_ollama_url: Optional[str] = None,
+        openai_client: Optional["AsyncOpenAI"] = None,
+        http_client: Optional["httpx.AsyncClient"] = None,
+        stream: bool = False,
+        idle_timeout: float = 30,
+        controller: Optional[ProviderController] = None,
+        endpoints: Optional[EndpointPool] = None,
+        options: Optional[Dict[str, Any]] = None,
+        keep_alive: Optional[str] = None,
+        prompt_stats: Optional[PromptEvalStats] = None,
+        phase: str = "",
+        metrics: Optional[RunMetrics] = None
+    ):
+        self.provider = provider.lower()
+        self.model = model
+        self.semaphore = semaphore
+        self.global_ollama_url = global_ollama_url
+        self.openai_client = openai_client
+        self.http_client = http_client
+        self.stream = stream
+        self.idle_timeout = idle_timeout
+        self.controller = controller or ProviderController(self.provider, ProviderController.resolve_config({"enabled": False}), 1)
+        self.endpoints = APIClient.resolve_endpoints(self.provider, global_ollama_url, self.controller, endpoints)
+        # Ollama model options (num_ctx, temperature, ...); keep_alive is how long Ollama keeps the model loaded.
+        self.options: Dict[str, Any] = dict(options or {})
+        self.keep_alive = keep_alive
+        self.prompt_stats = prompt_stats
+        # Metrics are labelled by provider, model and phase ("questions" or "answers").
+        self.labels = (self.provider, self.model, phase)
+        self.metrics = metrics
+
+    @staticmethod
+    def create_http_client(http_config: Dict[str, Any], max_in_flight: int) -> "httpx.AsyncClient":
+        """
+        Builds the pooled client shared by every coroutine of a run. The pool must be
+        at least as large as the in-flight limit or requests would queue for sockets.
+        """
+        keepalive = http_config["pool_size"] if http_config["keep_alive"] else 0
+        limits = httpx.Limits(
+            max_connections=max(max_in_flight, http_config["pool_size"]),
+            max_keepalive_connections=keepalive
+        )
+        timeout = httpx.Timeout(http_config["read_timeout"], connect=http_config["connect_timeout"])
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    def cache_identity(self) -> Dict[str, Any]:
+        return {"provider": self.provider, "model": self.model, "options": self.options}
+
+    async def _request_openai(
+        self, prompt: str, url: Optional[str], prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        response = await self.openai_client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model,
+            **APIClient.openai_format(schema)
+        )
+        if response.usage is not None:
+            self.record_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def _request_ollama(
+        self, prompt: str, url: str, prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False,
+            "options": self.options
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        if schema is not None:
+            payload["format"] = schema
+        response = await self.http_client.post(url, json=payload)
+        response.raise_for_status()
+        result = response.json()
+        self.record_usage(prefix, result)
+        return result.get("response", "").strip()
+
+    async def _stream_openai(
+        self, prompt: str, url: Optional[str], prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> AsyncIterator[str]:
+        response = await self.openai_client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model,
+            stream=True,
+            **APIClient.openai_format(schema)
+        )
+        async for chunk in response:
+            if getattr(chunk, "usage", None) is not None:
+                self.record_tokens(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def _stream_ollama(
+        self, prompt: str, url: str, prefix: Optional[str], schema: Optional[Dict[str, Any]]
+    ) -> AsyncIterator[str]:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": True,
+            "options": self.options
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        if schema is not None:
+            payload["format"] = schema
+        # httpx applies the read timeout per socket read: an idle-token timeout.
+        timeout = httpx.Timeout(self.http_client.timeout.connect, read=self.idle_timeout,
+                                write=self.http_client.timeout.write, pool=None)
+        async with self.http_client.stream("POST", url, json=payload, timeout=timeout) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                if "error" in result:
+                    raise APIStreamError(result["error"])
+                if result.get("response"):
+                    yield result["response"]
+                if result.get("done"):
+                    self.record_usage(prefix, result)
+                    return
+
+    def record_usage(self, prefix: Optional[str], result: Dict[str, Any]) -> None:
+        """Records the token counts of an Ollama response."""
+        if self.prompt_stats is not None:
+            self.prompt_stats.record(prefix, result)
+        self.record_tokens(result.get("prompt_eval_count"), result.get("eval_count"))
+
+    def record_tokens(self, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+        if self.metrics is not None:
+            self.metrics.record_tokens(self.labels, prompt_tokens, completion_tokens)
+
+    def record_attempt(self, request_started: float, kind: str = "") -> None:
+        if self.metrics is not None:
+            self.metrics.record_request(self.labels, time.monotonic() - request_started, kind)
+
+    def record_retry(self, kind: str) -> None:
+        if self.metrics is not None:
+            self.metrics.record_retry(self.labels, kind)
+
+    def _resolve_provider(self, streaming: bool):
+        if self.provider == "openai":
+            if not self.openai_client:
+                Utils.logger.error("OpenAI client not initialized.")
+                return None, None
+            return (self._stream_openai if streaming else self._request_openai), "OpenAI"
+        elif self.provider == "ollama":
+            if not self.endpoints.endpoints:
+                Utils.logger.error("Global Ollama URL not provided.")
+                return None, None
+            if not self.http_client:
+                Utils.logger.error("Async HTTP client not initialized.")
+                return None, None
+            return (self._stream_ollama if streaming else self._request_ollama), "Ollama"
+        Utils.logger.error(f"Unknown provider specified: {self.provider}")
+        return None, None
+
+    def retry_delay(self, endpoint: Endpoint, kind: str, attempt: int) -> float:
+        if kind == UNAVAILABLE and self.endpoints.can_reroute(endpoint):
+            return 0.0
+        return self.controller.backoff_time(attempt)
+
+    async def call_api(
+        self, prompt: str, prefix: Optional[str] = None, schema: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        if self.stream:
+            try:
+                return "".join([fragment async for fragment in self.stream_api(prompt, prefix, schema)]).strip()
+            except APIStreamError as e:
+                Utils.logger.error(f"Streaming API call failed: {e}")
+                return None
+
+        max_retries = self.controller.max_retries
+        request, label = self._resolve_provider(streaming=False)
+        if request is None:
+            return None
+
+        attempt = 0
+        while attempt <= max_retries:
+            # Only hold a slot while the request is actually in flight.
+            async with self.semaphore:
+                endpoint, started_at = await self.endpoints.acquire_async(prefix)
+                request_started = time.monotonic()
+                try:
+                    result = await request(prompt, endpoint.url, prefix, schema)
+                except Exception as e:
+                    kind = self.endpoints.release(endpoint, started_at, e)
+                    self.record_attempt(request_started, kind)
+                    error = e
+                except BaseException:
+                    # Cancelled (asyncio.CancelledError is not an Exception); give the slot back.
+                    self.endpoints.release(endpoint, started_at)
+                    raise
+                else:
+                    self.endpoints.release(endpoint, started_at)
+                    self.record_attempt(request_started)
+                    return result
+            Utils.logger.error(f"{label} API error ({kind}) on attempt {attempt+1}/{max_retries}: {error}")
+            if kind == FATAL or attempt == max_retries:
+                return None
+            sleep_time = self.retry_delay(endpoint, kind, attempt)
+            Utils.logger.info(f"Retrying {label} API call in {sleep_time:.2f} seconds...")
+            self.record_retry(kind)
+            await asyncio.sleep(sleep_time)
+            attempt += 1
+
+    async def stream_api(
+        self, prompt: str, prefix: Optional[str] = None, schema: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Async generator counterpart of APIClient.stream_api. The semaphore slot is
+        held for the whole stream and released while backing off.
+        """
+        max_retries = self.controller.max_retries
+        request, label = self._resolve_provider(streaming=True)
+        if request is None:
+            raise APIStreamError(f"Provider '{self.provider}' is not configured for streaming.")
+        attempt = 0
+        while True:
+            yielded = False
+            error = None
+            async with self.semaphore:
+                endpoint, started_at = await self.endpoints.acquire_async(prefix)
+                request_started = time.monotonic()
+                try:
+                    async for fragment in request(prompt, endpoint.url, prefix, schema):
+                        yielded = True
+                        yield fragment
+                except Exception as e:
+                    kind = self.endpoints.release(endpoint, started_at, e)
+                    self.record_attempt(request_started, kind)
+                    error = e
+                except BaseException:
+                    # The caller stopped reading (GeneratorExit) or was cancelled; give the slot back.
+                    self.endpoints.release(endpoint, started_at)
+                    raise
+                else:
+                    self.endpoints.release(endpoint, started_at)
+                    self.record_attempt(request_started)
+                    return
+            Utils.logger.error(f"{label} streaming error ({kind}) on attempt {attempt+1}/{max_retries}: {error}")
+            if yielded or kind == FATAL or attempt == max_retries:
+                raise APIStreamError(str(error)) from error
+            sleep_time = self.retry_delay(endpoint, kind, attempt)
+            Utils.logger.info(f"Retrying {label} streaming call in {sleep_time:.2f} seconds...")
+            self.record_retry(kind)
+            await asyncio.sleep(sleep_time)
+            attempt += 1
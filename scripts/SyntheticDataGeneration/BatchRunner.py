@@ -0,0 +1,134 @@
+import json
+import time
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple
+
+from SyntheticDataGeneration.Metrics import RunMetrics
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_BATCH_CONFIG = {
+    "poll_interval": 30,
+    "completion_window": "24h",
+    "max_requests_per_batch": 50000,
+}
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+class OpenAIBatchRunner:
+    """
+    Runs a list of prompts through the OpenAI Batch API: writes a batch JSONL,
+    uploads it, submits the batch, polls until it finishes and returns the
+    responses by custom_id. The batch id is saved next to the JSONL so an
+    interrupted run resumes polling the same batch instead of resubmitting.
+
+    Only the files and batches endpoints are used, so pointing the OpenAI client
+    at a local stand-in server (global.openai_base_url) replaces OpenAI in tests.
+    """
+    def __init__(
+        self, openai_client, model: str, work_dir: Path, batch_config: Optional[Dict[str, Any]] = None,
+        metrics: Optional[RunMetrics] = None
+    ):
+        self.openai_client = openai_client
+        self.model = model
+        self.metrics = metrics
+        self.work_dir = work_dir
+        self.config = OpenAIBatchRunner.resolve_config(batch_config)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def resolve_config(batch_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_BATCH_CONFIG)
+        resolved.update(batch_config or {})
+        return resolved
+
+    def run(self, phase: str, requests: List[Tuple[str, str]], json_output: bool = False) -> Dict[str, Optional[str]]:
+        """Runs (custom_id, prompt) pairs; with json_output every response is requested in JSON mode."""
+        results: Dict[str, Optional[str]] = {}
+        chunk_size = max(self.config["max_requests_per_batch"], 1)
+        for start in range(0, len(requests), chunk_size):
+            chunk = requests[start:start + chunk_size]
+            results.update(self.run_chunk(phase, chunk, json_output))
+        return results
+
+    def write_input_file(self, phase: str, requests: List[Tuple[str, str]], json_output: bool = False) -> Path:
+        lines = []
+        for custom_id, prompt in requests:
+            body = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+            if json_output:
+                body["response_format"] = {"type": "json_object"}
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }, ensure_ascii=False))
+        content = "\n".join(lines) + "\n"
+        # Name the file after its content so a rerun with the same work finds the saved batch id.
+        input_path = self.work_dir / f"{phase}_{Utils.get_hash(content)[:16]}.jsonl"
+        if not input_path.exists():
+            input_path.write_text(content, encoding="utf-8")
+        return input_path
+
+    def submit(self, input_path: Path) -> str:
+        state_path = input_path.with_suffix(".batch.json")
+        if state_path.exists():
+            batch_id = json.loads(state_path.read_text(encoding="utf-8"))["batch_id"]
+            Utils.logger.info(f"Resuming batch {batch_id} for {input_path.name}")
+            return batch_id
+        with open(input_path, "rb") as f:
+            input_file = self.openai_client.files.create(file=f, purpose="batch")
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.config["completion_window"]
+        )
+        state_path.write_text(json.dumps({"batch_id": batch.id, "input_file_id": input_file.id}), encoding="utf-8")
+        Utils.logger.info(f"Submitted batch {batch.id} for {input_path.name}")
+        return batch.id
+
+    def wait(self, batch_id: str):
+        while True:
+            batch = self.openai_client.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            if counts is not None:
+                Utils.logger.info(
+                    f"Batch {batch_id}: {batch.status} ({counts.completed}/{counts.total} completed, {counts.failed} failed)"
+                )
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            time.sleep(self.config["poll_interval"])
+
+    def read_results(self, phase: str, batch) -> Dict[str, Optional[str]]:
+        results: Dict[str, Optional[str]] = {}
+        if batch.output_file_id:
+            for line in self.openai_client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                    usage = response["body"].get("usage")
+                    if usage and self.metrics is not None:
+                        self.metrics.record_tokens(
+                            ("openai", self.model, phase), usage.get("prompt_tokens"), usage.get("completion_tokens")
+                        )
+                else:
+                    Utils.logger.error(f"Batch request {record['custom_id']} failed: {record.get('error') or response}")
+                    results[record["custom_id"]] = None
+        if batch.error_file_id:
+            for line in self.openai_client.files.content(batch.error_file_id).text.splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    Utils.logger.error(f"Batch request {record['custom_id']} failed: {record.get('error')}")
+                    results.setdefault(record["custom_id"], None)
+        return results
+
+    def run_chunk(self, phase: str, requests: List[Tuple[str, str]], json_output: bool = False) -> Dict[str, Optional[str]]:
+        input_path = self.write_input_file(phase, requests, json_output)
+        batch = self.wait(self.submit(input_path))
+        if batch.status != "completed":
+            Utils.logger.error(f"Batch {batch.id} ended with status '{batch.status}'.")
+            # A failed or expired batch must not be resumed on the next run.
+            input_path.with_suffix(".batch.json").unlink(missing_ok=True)
+        return self.read_results(phase, batch)
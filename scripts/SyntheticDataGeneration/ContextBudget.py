@@ -0,0 +1,70 @@
+import math
+from typing import Optional, List, Dict, Any
+
+from SyntheticDataGeneration.Utils import Utils
+
+# Try importing a Hugging Face tokenizer for exact counts
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+DEFAULT_CHUNKING_CONFIG = {
+    "enabled": False,
+    "num_ctx": 8192,          # Context window requested from Ollama; the budget every prompt must fit in.
+    "reserved_tokens": 2048,  # Kept free for the prompt template, seed, instruction, question and the response.
+    "overlap_tokens": 256,    # Content repeated at the start of the next window.
+    "tokenizer": None,        # Hugging Face tokenizer name; without one, tokens are estimated from characters.
+    "chars_per_token": 4,
+}
+
+class ContextBudget:
+    """
+    Counts tokens of input files and decides how much file content fits in one
+    prompt: num_ctx minus the tokens reserved for the rest of the prompt and the
+    response. Counts come from a Hugging Face tokenizer when one is configured and
+    installed, otherwise they are estimated as characters / chars_per_token.
+    """
+    def __init__(self, num_ctx: int, reserved_tokens: int, overlap_tokens: int,
+                 tokenizer_name: Optional[str] = None, chars_per_token: float = 4):
+        self.num_ctx = num_ctx
+        self.budget = max(num_ctx - reserved_tokens, 1)
+        # At most half a window is repeated, so every window still moves forward.
+        self.overlap = max(min(overlap_tokens, self.budget // 2), 0)
+        self.chars_per_token = chars_per_token if chars_per_token > 0 else 4
+        self.tokenizer = None
+        self.name = f"chars/{self.chars_per_token}"
+        if tokenizer_name:
+            if AutoTokenizer is None:
+                Utils.logger.warning(
+                    f"transformers is not installed; estimating tokens instead of using tokenizer '{tokenizer_name}'."
+                )
+            else:
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                self.name = tokenizer_name
+
+    @staticmethod
+    def resolve_config(chunking_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_CHUNKING_CONFIG)
+        resolved.update(chunking_config or {})
+        return resolved
+
+    @staticmethod
+    def from_config(chunking_config: Optional[Dict[str, Any]]) -> Optional["ContextBudget"]:
+        config = ContextBudget.resolve_config(chunking_config)
+        if not config["enabled"]:
+            return None
+        return ContextBudget(
+            config["num_ctx"], config["reserved_tokens"], config["overlap_tokens"],
+            config["tokenizer"], config["chars_per_token"]
+        )
+
+    def count(self, text: str) -> int:
+        return self.count_lines([text])[0]
+
+    def count_lines(self, lines: List[str]) -> List[int]:
+        if not lines:
+            return []
+        if self.tokenizer is not None:
+            return [len(ids) for ids in self.tokenizer(lines, add_special_tokens=False)["input_ids"]]
+        return [math.ceil(len(line) / self.chars_per_token) for line in lines]
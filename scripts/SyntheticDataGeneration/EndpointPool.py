@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+
+from SyntheticDataGeneration.RateController import ProviderController, ProviderControllerRegistry, UNAVAILABLE
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_ENDPOINT_CONFIG = {
+    "weight": 1,
+    "max_in_flight": 0,  # 0 = only limited by --threads and rate control.
+}
+
+# Prefixes remembered for endpoint affinity; the least recently used are forgotten first.
+MAX_AFFINITY_ENTRIES = 4096
+
+DEFAULT_HEALTH_CHECK_CONFIG = {
+    "enabled": True,
+    "interval": 10,
+    "timeout": 2,
+}
+
+class Endpoint:
+    def __init__(self, url: Optional[str], controller: ProviderController, weight: float = 1, max_in_flight: int = 0):
+        self.url = url
+        self.controller = controller
+        self.weight = weight if weight > 0 else 1
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.healthy = True
+
+    @property
+    def health_url(self) -> str:
+        # Ollama answers "Ollama is running" on its root URL.
+        parts = urlsplit(self.url)
+        return f"{parts.scheme}://{parts.netloc}/"
+
+    def has_capacity(self) -> bool:
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.weight
+
+class EndpointPool:
+    """
+    Routes each request to the endpoint with the fewest outstanding requests
+    relative to its weight. Endpoints that refuse connections are taken out of
+    rotation until a background health check (or a later success) finds them
+    responding again; their requests are retried on the remaining endpoints.
+
+    With prefix affinity on, requests that share a prompt prefix go to the
+    endpoint that served the prefix first, so Ollama can reuse the prefix from its
+    KV cache, unless that endpoint is busier than the least loaded one by more
+    than affinity_slack.
+    """
+    def __init__(self, endpoints: List[Endpoint], health_config: Optional[Dict[str, Any]] = None):
+        self.endpoints = endpoints
+        self.health_config = EndpointPool.resolve_health_config(health_config)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.health_thread: Optional[threading.Thread] = None
+        self.affinity_slack: Optional[float] = None
+        self.affinity: "OrderedDict[str, Endpoint]" = OrderedDict()
+
+    @staticmethod
+    def resolve_health_config(health_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_HEALTH_CHECK_CONFIG)
+        resolved.update(health_config or {})
+        return resolved
+
+    @staticmethod
+    def parse_endpoints(ollama_url: Union[str, List[Any], None]) -> List[Dict[str, Any]]:
+        """Accepts a single URL, a list of URLs, or a list of {url, weight, max_in_flight} entries."""
+        if not ollama_url:
+            return []
+        entries = ollama_url if isinstance(ollama_url, list) else [ollama_url]
+        endpoints = []
+        for entry in entries:
+            endpoint = dict(DEFAULT_ENDPOINT_CONFIG)
+            endpoint.update({"url": entry} if isinstance(entry, str) else entry)
+            endpoints.append(endpoint)
+        return endpoints
+
+    @staticmethod
+    def from_config(
+        ollama_url: Union[str, List[Any], None],
+        health_config: Optional[Dict[str, Any]],
+        controllers: ProviderControllerRegistry
+    ) -> "EndpointPool":
+        endpoints = [
+            Endpoint(entry["url"], controllers.get("ollama", entry["url"]), entry["weight"], entry["max_in_flight"])
+            for entry in EndpointPool.parse_endpoints(ollama_url)
+        ]
+        return EndpointPool(endpoints, health_config)
+
+    def enable_prefix_affinity(self, affinity_slack: float) -> None:
+        self.affinity_slack = affinity_slack
+
+    def try_acquire(self, prefix: Optional[str] = None) -> Tuple[Optional[Endpoint], float]:
+        """Admits one request and returns its endpoint, or returns how long to wait before asking again."""
+        with self.lock:
+            # If every endpoint looks down, keep trying them all; their breakers pace the probes.
+            healthy = [e for e in self.endpoints if e.healthy] or self.endpoints
+            candidates = sorted((e for e in healthy if e.has_capacity()), key=Endpoint.load)
+            use_affinity = prefix is not None and self.affinity_slack is not None and len(self.endpoints) > 1
+            preferred = self.affinity.get(prefix) if use_affinity else None
+            if preferred in candidates and preferred.load() - candidates[0].load() <= self.affinity_slack:
+                candidates.remove(preferred)
+                candidates.insert(0, preferred)
+            wait = 0.05
+            for endpoint in candidates:
+                endpoint_wait = endpoint.controller.try_acquire()
+                if endpoint_wait <= 0:
+                    endpoint.in_flight += 1
+                    if use_affinity:
+                        # A prefix that spilled over stays with its endpoint unless that endpoint went down.
+                        self.remember(prefix, preferred if preferred is not None and preferred.healthy else endpoint)
+                    return endpoint, 0.0
+                wait = min(wait, endpoint_wait)
+            return None, wait
+
+    def remember(self, prefix: str, endpoint: Endpoint) -> None:
+        self.affinity[prefix] = endpoint
+        self.affinity.move_to_end(prefix)
+        if len(self.affinity) > MAX_AFFINITY_ENTRIES:
+            self.affinity.popitem(last=False)
+
+    def acquire(self, prefix: Optional[str] = None) -> Tuple[Endpoint, float]:
+        started = time.monotonic()
+        while True:
+            endpoint, wait = self.try_acquire(prefix)
+            if endpoint is not None:
+                return endpoint, started
+            time.sleep(wait)
+
+    async def acquire_async(self, prefix: Optional[str] = None) -> Tuple[Endpoint, float]:
+        started = time.monotonic()
+        while True:
+            endpoint, wait = self.try_acquire(prefix)
+            if endpoint is not None:
+                return endpoint, started
+            await asyncio.sleep(wait)
+
+    def release(self, endpoint: Endpoint, started_at: float, error: Optional[BaseException] = None) -> str:
+        """Records the outcome of an admitted request and returns its error class ("" on success)."""
+        kind = endpoint.controller.release(started_at, error)
+        with self.lock:
+            endpoint.in_flight -= 1
+            if kind == UNAVAILABLE:
+                self.mark(endpoint, False)
+            elif not kind:
+                self.mark(endpoint, True)
+        return kind
+
+    def can_reroute(self, endpoint: Endpoint) -> bool:
+        """True if a request that failed on this endpoint has another healthy endpoint to go to."""
+        with self.lock:
+            return any(e is not endpoint and e.healthy for e in self.endpoints)
+
+    def mark(self, endpoint: Endpoint, healthy: bool) -> None:
+        if endpoint.healthy == healthy or len(self.endpoints) < 2:
+            return
+        endpoint.healthy = healthy
+        if healthy:
+            Utils.logger.info(f"Ollama endpoint {endpoint.url} is healthy again; adding it back to rotation.")
+        else:
+            Utils.logger.warning(f"Ollama endpoint {endpoint.url} is unreachable; routing requests to other endpoints.")
+
+    def check_health(self) -> None:
+        for endpoint in self.endpoints:
+            try:
+                response = requests.get(endpoint.health_url, timeout=self.health_config["timeout"])
+                healthy = response.ok
+            except requests.RequestException:
+                healthy = False
+            with self.lock:
+                self.mark(endpoint, healthy)
+
+    def _health_loop(self) -> None:
+        while not self.stop_event.wait(self.health_config["interval"]):
+            self.check_health()
+
+    def start_health_checks(self) -> None:
+        # With a single endpoint there is nowhere to re-route to; the breaker covers it.
+        if not self.health_config["enabled"] or len(self.endpoints) < 2 or self.health_thread is not None:
+            return
+        self.stop_event.clear()
+        self.check_health()
+        self.health_thread = threading.Thread(target=self._health_loop, name="ollama-health-check", daemon=True)
+        self.health_thread.start()
+
+    def stop_health_checks(self) -> None:
+        self.stop_event.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+            self.health_thread = None
@@ -1,20 +1,23 @@
-import os
-import re
-import yaml
-import argparse
-import requests
-import hashlib
-import logging
-import random
-import time
+import math
+import string
+import threading
 from pathlib import Path
-from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List, Dict, Any, Set, Tuple, Callable
 
-from SyntheticDataGeneration.ApiClient import APIClient
+from SyntheticDataGeneration.AnswerBatcher import AnswerBatcher
+from SyntheticDataGeneration.ApiClient import APIClient, APIStreamError
+from SyntheticDataGeneration.ContextBudget import ContextBudget
 from SyntheticDataGeneration.FileManager import FileManager
+from SyntheticDataGeneration.OutputStore import FileOutputStore, QUESTIONS, ANSWERS
+from SyntheticDataGeneration.QuestionDeduplicator import QuestionDeduplicator
+from SyntheticDataGeneration.ResponseCache import ResponseCache
 from SyntheticDataGeneration.Utils import Utils
-from SyntheticDataGeneration.TextParser import TextParser
+from SyntheticDataGeneration.TextParser import TextParser, QuestionStreamParser
+from SyntheticDataGeneration.WorkLedger import WorkLedger, PLANNED, IN_FLIGHT, DONE, FAILED
+from SyntheticDataGeneration.WorkScheduler import WorkScheduler, AsyncWorkScheduler, ANSWER_PRIORITY, QUESTION_PRIORITY
+
+# Assumed length of a question that has not been generated yet, for --plan.
+ESTIMATED_QUESTION_TOKENS = 20
 
 class FileGroupProcessor:
     def __init__(
@@ -27,7 +30,15 @@ class FileGroupProcessor:
         question_api_client: APIClient,
         answer_api_client: APIClient,
         thread_count: int,
-        file_manager: FileManager
+        file_manager: FileManager,
+        response_cache: Optional[ResponseCache] = None,
+        cache_sample: Optional[str] = None,
+        output_store=None,
+        question_dedup: Optional[QuestionDeduplicator] = None,
+        context_budget: Optional[ContextBudget] = None,
+        prefix_grouping: bool = False,
+        ledger: Optional[WorkLedger] = None,
+        answer_batcher: Optional[AnswerBatcher] = None
     ):
         self.group_name = group_name
         self.group_config = group_config
@@ -38,6 +49,9 @@ class FileGroupProcessor:
         self.answer_api_client = answer_api_client
         self.thread_count = thread_count
         self.file_manager = file_manager
+        self.response_cache = response_cache
+        # Distinguishes iterations of a group in the cache; None lets identical prompts share entries.
+        self.cache_sample = cache_sample
 
         # Extract configuration sections
         self.file_headers = config.get("FileHeaders", [])
@@ -47,12 +61,23 @@ class FileGroupProcessor:
         self.answer_instruction_lists = config.get("AnswerInstructionList", [])
         self.generate_question_lists = config.get("GenerateQuestionLists", [])
 
-        # Prepare output directories
-        self.questions_dir = self.output_base_path / "qa_generation_output" / "questions"
-        self.answers_dir = self.output_base_path / "qa_generation_output" / "answers"
-        self.debug_dir = self.output_base_path / "qa_generation_output" / "debug"
-        for d in [self.questions_dir, self.answers_dir, self.debug_dir]:
-            d.mkdir(parents=True, exist_ok=True)
+        # Questions, answers and debug prompts go through the run's output store (files or shards).
+        self.output_store = output_store or FileOutputStore(self.output_base_path / "qa_generation_output", file_manager)
+        # Shared by every group of the run, so duplicates are found across groups and iterations.
+        self.question_dedup = question_dedup
+        # When set, file content larger than the token budget is split into windows.
+        self.context_budget = context_budget
+        # Queues answers that share a prompt prefix together; see answer_prefix_key.
+        self.prefix_grouping = prefix_grouping
+        # Records planned, in-flight, done and failed requests; shared by every group of the run.
+        self.ledger = ledger
+        # When set, several questions are answered by one request; see AnswerBatcher.
+        self.answer_batcher = answer_batcher
+        # Answers to question lists that are still streaming, written once the list is stored;
+        # lists whose stream failed are dropped and get no answers. Keyed by questions file name.
+        self.held_lock = threading.Lock()
+        self.held_answers: Dict[str, List[Tuple[str, Callable[[], None]]]] = {}
+        self.dropped_lists: Set[str] = set()
 
     def resolve_templates(self) -> bool:
         file_header_name = self.group_config.get("file_header", "")
@@ -102,139 +127,700 @@ class FileGroupProcessor:
     def generate_file_content(self, file_list: List[str], for_questions: bool = True) -> str:
         return self.file_manager.build_files_content(file_list, self.file_header_template)
 
-    def generate_question_task(
-        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str]
-    ) -> Optional[str]:
-        file_name_list_str = ", ".join(file_list)
-        final_prompt = self.question_prompt_template.format(
+    def generate_content_windows(self, file_list: List[str]) -> List[Tuple[int, str]]:
+        """
+        Returns (window, content) pairs. Window 0 is the whole group; a group that
+        does not fit the token budget is split into windows numbered from 1.
+        """
+        if self.context_budget is None:
+            return [(0, self.generate_file_content(file_list))]
+        windows = self.file_manager.build_content_windows(file_list, self.file_header_template, self.context_budget)
+        if len(windows) == 1:
+            return [(0, windows[0])]
+        Utils.logger.info(
+            f"[Group: {self.group_name}] Content exceeds {self.context_budget.budget} tokens; "
+            f"split into {len(windows)} overlapping windows."
+        )
+        return list(enumerate(windows, start=1))
+
+    def answer_prefix_key(self, combined_content: str) -> Optional[str]:
+        """
+        Hash of the part of the answer prompt that every answer for this content
+        shares: the template up to its first placeholder other than {file_content}.
+        None if that part does not include the file content.
+        """
+        prefix = ""
+        includes_content = False
+        for literal, field_name, _, _ in string.Formatter().parse(self.answer_prompt_template):
+            prefix += literal
+            if field_name != "file_content":
+                break
+            prefix += combined_content
+            includes_content = True
+        return Utils.get_hash(prefix) if includes_content else None
+
+    def output_group(self, window: int) -> str:
+        # Each window is named like a group of its own, so its outputs pair up in parse_qa_data unchanged.
+        return f"{self.group_name}_w{window}" if window else self.group_name
+
+    def questions_name(self, q_seed_idx: int, instr_idx: int, window: int = 0) -> str:
+        return f"questions_{self.output_group(window)}_seed{q_seed_idx}_instr{instr_idx}.txt"
+
+    def answer_name(
+        self, q_seed_idx: int, instr_idx: int, question_number: int, answer_instruction: str, window: int = 0
+    ) -> str:
+        ans_instr_hash = Utils.get_hash(answer_instruction)[:8]
+        group = self.output_group(window)
+        return f"answer_{group}_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{ans_instr_hash}.txt"
+
+    def question_prompt(self, seed_text: str, instruction: str, combined_content: str, file_list: List[str]) -> str:
+        return self.question_prompt_template.format(
             file_content=combined_content,
             generate_question=seed_text,
             instruction=instruction,
-            file_name_list=file_name_list_str
+            file_name_list=", ".join(file_list)
         )
-        out_filename = f"questions_{self.group_name}_seed{q_seed_idx}_instr{instr_idx}.txt"
-        debug_filename = f"debug_{self.group_name}_seed{q_seed_idx}_instr{instr_idx}_questions.txt"
-        questions_path = self.questions_dir / out_filename
-        debug_path = self.debug_dir / debug_filename
-
-        if questions_path.exists():
-            question_text = self.file_manager.read_text(questions_path).strip()
-            Utils.logger.info(f"[Group: {self.group_name}] Using existing questions file: {out_filename}")
-        else:
-            question_text = self.question_api_client.call_api(final_prompt)
-            if not question_text:
-                Utils.logger.error(f"[Group: {self.group_name}] Failed to generate questions (seed={q_seed_idx}, instr={instr_idx}).")
-                return None
-            self.file_manager.write_text(questions_path, question_text)
-            self.file_manager.write_text(debug_path, final_prompt)
-        return question_text
 
-    def generate_answer(
-        self, q_seed_idx: int, instr_idx: int, question_number: int, question_text: str,
-        answer_instruction: str, combined_content: str
-    ):
-        final_prompt = self.answer_prompt_template.format(
+    def answer_prompt(self, question_text: str, answer_instruction: str, combined_content: str) -> str:
+        return self.answer_prompt_template.format(
             file_content=combined_content,
             instruction=answer_instruction,
             question=question_text
         )
-        ans_instr_hash = Utils.get_hash(answer_instruction)[:8]
-        answer_filename = f"answer_{self.group_name}_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{ans_instr_hash}.txt"
-        debug_filename = f"debug_{self.group_name}_answer_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{ans_instr_hash}.txt"
-        meta_filename = f"answer_{self.group_name}_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{ans_instr_hash}.meta"
 
-        answer_file_path = self.answers_dir / answer_filename
-        answer_debug_path = self.debug_dir / debug_filename
-        meta_file_path = self.answers_dir / meta_filename
+    def mark(self, kind: str, name: str, state: str) -> None:
+        if self.ledger is not None:
+            self.ledger.mark(kind, name, state)
 
-        current_hash = Utils.get_hash(final_prompt)
-        regenerate = True
-        if answer_file_path.exists():
-            if meta_file_path.exists():
-                stored_hash = self.file_manager.read_text(meta_file_path).strip()
-                if stored_hash == current_hash:
-                    Utils.logger.info(
-                        f"[Group: {self.group_name}] Answer for (seed={q_seed_idx}, instr={instr_idx}, q={question_number}) is up to date."
-                    )
-                    regenerate = False
-                else:
-                    Utils.logger.info(f"[Group: {self.group_name}] Changed prompt detected, regenerating answer.")
+    def is_trusted(self, kind: str, name: str) -> bool:
+        """False if the previous run stopped while this output was being regenerated."""
+        return self.ledger is None or self.ledger.trusts(kind, name)
+
+    def hold_answers(self, questions_name: str) -> None:
+        with self.held_lock:
+            self.held_answers[questions_name] = []
+
+    def release_answers(self, questions_name: str, stored: bool) -> None:
+        """Writes the answers held for a streamed list once it is stored, or drops them with the list."""
+        with self.held_lock:
+            held = self.held_answers.pop(questions_name, [])
+            if not stored:
+                self.dropped_lists.add(questions_name)
+        for answer_name, write in held:
+            if stored:
+                write()
             else:
-                self.file_manager.write_text(meta_file_path, current_hash)
-                regenerate = False
+                self.mark(ANSWERS, answer_name, FAILED)
+
+    def is_dropped(self, q_seed_idx: int, instr_idx: int, window: int) -> bool:
+        with self.held_lock:
+            return self.questions_name(q_seed_idx, instr_idx, window) in self.dropped_lists
 
-        if not regenerate:
+    def write_answer(self, request: Dict[str, Any], write: Callable[[], None]) -> None:
+        """Runs write now, holds it while the answer's question list is streaming, or drops it with the list."""
+        questions_name = self.questions_name(request["q_seed_idx"], request["instr_idx"], request["window"])
+        with self.held_lock:
+            dropped = questions_name in self.dropped_lists
+            if not dropped and questions_name in self.held_answers:
+                self.held_answers[questions_name].append((request["answer_name"], write))
+                return
+        if dropped:
+            self.mark(ANSWERS, request["answer_name"], FAILED)
             return
+        write()
+
+    def prepare_question(
+        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str],
+        window: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Builds the question prompt and output paths. "existing_text" is set when the
+        questions can be reused from the response cache or a previous run.
+        """
+        final_prompt = self.question_prompt(seed_text, instruction, combined_content, file_list)
+        group = self.output_group(window)
+        out_filename = self.questions_name(q_seed_idx, instr_idx, window)
+        fields = {"group": group, "seed": q_seed_idx, "instr": instr_idx}
+
+        existing_text = None
+        cache_key = None
+        trusted = self.is_trusted(QUESTIONS, out_filename)
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(self.question_api_client.cache_identity(), final_prompt, self.cache_sample)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                existing_text = cached
+                self.output_store.sync(QUESTIONS, out_filename, cached, final_prompt, fields)
+                Utils.logger.info(f"[Group: {self.group_name}] Using cached questions: {out_filename}")
+            elif trusted and self.output_store.prompt_hash(QUESTIONS, out_filename) == Utils.get_hash(final_prompt):
+                # Output from before the cache existed, generated from this exact prompt.
+                existing_text = self.output_store.read(QUESTIONS, out_filename).strip()
+                self.response_cache.put(cache_key, existing_text)
+                Utils.logger.info(f"[Group: {self.group_name}] Using existing questions file: {out_filename}")
+        else:
+            stored = self.output_store.read(QUESTIONS, out_filename) if trusted else None
+            if stored is not None:
+                existing_text = stored.strip()
+                Utils.logger.info(f"[Group: {self.group_name}] Using existing questions file: {out_filename}")
+        if existing_text is not None:
+            self.mark(QUESTIONS, out_filename, DONE)
+        return {
+            "q_seed_idx": q_seed_idx,
+            "instr_idx": instr_idx,
+            "window": window,
+            "content": combined_content,
+            "final_prompt": final_prompt,
+            "questions_name": out_filename,
+            "fields": fields,
+            "existing_text": existing_text,
+            "cache_key": cache_key,
+        }
+
+    def store_questions(self, request: Dict[str, Any], question_text: Optional[str]) -> Optional[str]:
+        if not question_text:
+            Utils.logger.error(
+                f"[Group: {self.group_name}] Failed to generate questions (seed={request['q_seed_idx']}, instr={request['instr_idx']})."
+            )
+            self.mark(QUESTIONS, request["questions_name"], FAILED)
+            return None
+        if request["cache_key"] is not None:
+            self.response_cache.put(request["cache_key"], question_text)
+        self.output_store.write(QUESTIONS, request["questions_name"], question_text, request["final_prompt"], request["fields"])
+        self.mark(QUESTIONS, request["questions_name"], DONE)
+        return question_text
+
+    def generate_question_task(
+        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str],
+        window: int = 0
+    ) -> Optional[str]:
+        request = self.prepare_question(q_seed_idx, instr_idx, seed_text, instruction, combined_content, file_list, window)
+        if request["existing_text"] is not None:
+            return request["existing_text"]
+        self.mark(QUESTIONS, request["questions_name"], IN_FLIGHT)
+        question_text = self.question_api_client.call_api(request["final_prompt"])
+        return self.store_questions(request, question_text)
+
+    async def generate_question_task_async(
+        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str],
+        window: int = 0
+    ) -> Optional[str]:
+        request = self.prepare_question(q_seed_idx, instr_idx, seed_text, instruction, combined_content, file_list, window)
+        if request["existing_text"] is not None:
+            return request["existing_text"]
+        self.mark(QUESTIONS, request["questions_name"], IN_FLIGHT)
+        question_text = await self.question_api_client.call_api(request["final_prompt"])
+        return self.store_questions(request, question_text)
+
+    def stream_question_task(
+        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str],
+        on_question: Callable[[int, str], None], window: int = 0
+    ) -> List[str]:
+        """
+        Streams the question list and calls on_question(question_number, text) as soon
+        as each numbered line is complete, so answers can start before the list ends.
+        Their outputs are held until the list is stored; if the stream fails they are
+        dropped along with it, so no answer is written for a question that was not.
+        """
+        request = self.prepare_question(q_seed_idx, instr_idx, seed_text, instruction, combined_content, file_list, window)
+        if request["existing_text"] is not None:
+            questions = TextParser.parse_questions(request["existing_text"])
+            for q_num, q_text in enumerate(questions, start=1):
+                on_question(q_num, q_text)
+            return questions
+
+        self.mark(QUESTIONS, request["questions_name"], IN_FLIGHT)
+        fragments = []
+        questions = []
+        parser = QuestionStreamParser()
+        question_text = None
+        self.hold_answers(request["questions_name"])
+        try:
+            try:
+                for fragment in self.question_api_client.stream_api(request["final_prompt"]):
+                    fragments.append(fragment)
+                    for q_text in parser.feed(fragment):
+                        questions.append(q_text)
+                        on_question(len(questions), q_text)
+                for q_text in parser.finish():
+                    questions.append(q_text)
+                    on_question(len(questions), q_text)
+            except APIStreamError:
+                fragments = []
+            question_text = self.store_questions(request, "".join(fragments).strip())
+        finally:
+            self.release_answers(request["questions_name"], question_text is not None)
+        return questions if question_text else []
+
+    async def stream_question_task_async(
+        self, q_seed_idx: int, instr_idx: int, seed_text: str, instruction: str, combined_content: str, file_list: List[str],
+        on_question: Callable[[int, str], None], window: int = 0
+    ) -> List[str]:
+        request = self.prepare_question(q_seed_idx, instr_idx, seed_text, instruction, combined_content, file_list, window)
+        if request["existing_text"] is not None:
+            questions = TextParser.parse_questions(request["existing_text"])
+            for q_num, q_text in enumerate(questions, start=1):
+                on_question(q_num, q_text)
+            return questions
+
+        self.mark(QUESTIONS, request["questions_name"], IN_FLIGHT)
+        fragments = []
+        questions = []
+        parser = QuestionStreamParser()
+        question_text = None
+        self.hold_answers(request["questions_name"])
+        try:
+            try:
+                async for fragment in self.question_api_client.stream_api(request["final_prompt"]):
+                    fragments.append(fragment)
+                    for q_text in parser.feed(fragment):
+                        questions.append(q_text)
+                        on_question(len(questions), q_text)
+                for q_text in parser.finish():
+                    questions.append(q_text)
+                    on_question(len(questions), q_text)
+            except APIStreamError:
+                fragments = []
+            question_text = self.store_questions(request, "".join(fragments).strip())
+        finally:
+            self.release_answers(request["questions_name"], question_text is not None)
+        return questions if question_text else []
+
+    def prepare_answer(
+        self, q_seed_idx: int, instr_idx: int, question_number: int, question_text: str,
+        answer_instruction: str, combined_content: str, window: int = 0
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Builds the answer prompt and output name. Returns None when the answer is
+        already cached (or, without a cache, when the stored answer was generated
+        from the same prompt) and no API call is needed.
+        """
+        final_prompt = self.answer_prompt(question_text, answer_instruction, combined_content)
+        group = self.output_group(window)
+        answer_filename = self.answer_name(q_seed_idx, instr_idx, question_number, answer_instruction, window)
+        fields = {"group": group, "seed": q_seed_idx, "instr": instr_idx, "question": question_number}
+        if self.is_dropped(q_seed_idx, instr_idx, window):
+            # The question list failed while streaming; its questions do not exist.
+            self.mark(ANSWERS, answer_filename, FAILED)
+            return None
+        trusted = self.is_trusted(ANSWERS, answer_filename)
+
+        current_hash = Utils.get_hash(final_prompt)
+        request = {
+            "q_seed_idx": q_seed_idx,
+            "instr_idx": instr_idx,
+            "window": window,
+            "question_number": question_number,
+            "final_prompt": final_prompt,
+            "answer_name": answer_filename,
+            "fields": fields,
+            "prefix": self.answer_prefixes.get(window),
+            "cache_key": None,
+        }
+        up_to_date_message = (
+            f"[Group: {self.group_name}] Answer for (seed={q_seed_idx}, instr={instr_idx}, q={question_number}) is up to date."
+        )
+
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(self.answer_api_client.cache_identity(), final_prompt, self.cache_sample)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                def sync_cached():
+                    self.output_store.sync(ANSWERS, answer_filename, cached, final_prompt, fields)
+                    self.mark(ANSWERS, answer_filename, DONE)
+                    Utils.logger.info(up_to_date_message)
+                self.write_answer(request, sync_cached)
+                return None
+            if trusted and self.output_store.prompt_hash(ANSWERS, answer_filename) == current_hash:
+                # Output from before the cache existed; adopt it instead of regenerating.
+                self.response_cache.put(cache_key, self.output_store.read(ANSWERS, answer_filename))
+                self.mark(ANSWERS, answer_filename, DONE)
+                Utils.logger.info(up_to_date_message)
+                return None
+            request["cache_key"] = cache_key
+            return request
 
-        answer_text = self.answer_api_client.call_api(final_prompt)
+        stored_text = self.output_store.read(ANSWERS, answer_filename) if trusted else None
+        if stored_text is not None:
+            stored_hash = self.output_store.prompt_hash(ANSWERS, answer_filename)
+            if stored_hash == current_hash:
+                self.mark(ANSWERS, answer_filename, DONE)
+                Utils.logger.info(up_to_date_message)
+                return None
+            if stored_hash is None:
+                # An answer with no recorded prompt is assumed to match the current one.
+                self.output_store.write(ANSWERS, answer_filename, stored_text, final_prompt, fields)
+                self.mark(ANSWERS, answer_filename, DONE)
+                return None
+            Utils.logger.info(f"[Group: {self.group_name}] Changed prompt detected, regenerating answer.")
+        return request
+
+    def store_answer(self, request: Dict[str, Any], answer_text: Optional[str]) -> None:
         if not answer_text:
             Utils.logger.error(
-                f"[Group: {self.group_name}] Failed to generate answer for (seed={q_seed_idx}, instr={instr_idx}, q={question_number})."
+                f"[Group: {self.group_name}] Failed to generate answer for "
+                f"(seed={request['q_seed_idx']}, instr={request['instr_idx']}, q={request['question_number']})."
             )
+            self.mark(ANSWERS, request["answer_name"], FAILED)
             return
-        self.file_manager.write_text(answer_file_path, answer_text)
-        self.file_manager.write_text(answer_debug_path, final_prompt)
-        self.file_manager.write_text(meta_file_path, current_hash)
-        Utils.logger.info(f"[Group: {self.group_name}] Saved answer -> {answer_file_path}")
 
-    def process(self):
-        if not self.resolve_templates():
+        def write():
+            self.output_store.write(ANSWERS, request["answer_name"], answer_text, request["final_prompt"], request["fields"])
+            self.mark(ANSWERS, request["answer_name"], DONE)
+            if request["cache_key"] is not None:
+                self.response_cache.put(request["cache_key"], answer_text)
+            location = self.output_store.location(ANSWERS, request["answer_name"])
+            Utils.logger.info(f"[Group: {self.group_name}] Saved answer -> {location}")
+        self.write_answer(request, write)
+
+    def add_question_list(self) -> Optional[int]:
+        """Numbers a question list for deduplication, in schedule order; None without deduplication."""
+        return self.question_dedup.add_list() if self.question_dedup is not None else None
+
+    def offer_question(
+        self, list_number: Optional[int], q_seed_idx: int, instr_idx: int, question_number: int, question_text: str,
+        on_kept: Callable[[], None]
+    ) -> None:
+        """Calls on_kept() unless an earlier question of the run is nearly identical, in which case no answers are generated."""
+        if self.question_dedup is None:
+            on_kept()
             return
+
+        def on_duplicate(earlier: str):
+            self.question_dedup.record_skipped_calls(len(self.all_answer_instructions))
+            Utils.logger.info(
+                f"[Group: {self.group_name}] Skipping near-duplicate question (seed={q_seed_idx}, instr={instr_idx}, "
+                f"q={question_number}): '{question_text}' ~ '{earlier}'"
+            )
+        self.question_dedup.offer(list_number, question_text, on_kept, on_duplicate)
+
+    def settle_question_list(self, list_number: Optional[int], stored: bool, on_settled: Callable[[], None]) -> None:
+        """Runs on_settled() once every question of the list has been offered and decided."""
+        if self.question_dedup is None:
+            on_settled()
+            return
+        self.question_dedup.settle(list_number, stored, on_settled)
+
+    def generate_answer(
+        self, q_seed_idx: int, instr_idx: int, question_number: int, question_text: str,
+        answer_instruction: str, combined_content: str, window: int = 0
+    ):
+        request = self.prepare_answer(
+            q_seed_idx, instr_idx, question_number, question_text, answer_instruction, combined_content, window
+        )
+        if request is None:
+            return
+        self.mark(ANSWERS, request["answer_name"], IN_FLIGHT)
+        answer_text = self.answer_api_client.call_api(request["final_prompt"], request["prefix"])
+        self.store_answer(request, answer_text)
+
+    async def generate_answer_async(
+        self, q_seed_idx: int, instr_idx: int, question_number: int, question_text: str,
+        answer_instruction: str, combined_content: str, window: int = 0
+    ):
+        request = self.prepare_answer(
+            q_seed_idx, instr_idx, question_number, question_text, answer_instruction, combined_content, window
+        )
+        if request is None:
+            return
+        self.mark(ANSWERS, request["answer_name"], IN_FLIGHT)
+        answer_text = await self.answer_api_client.call_api(request["final_prompt"], request["prefix"])
+        self.store_answer(request, answer_text)
+
+    def prepare_answer_batch(
+        self, items: List[Tuple[int, int, int, str]], answer_instruction: str, combined_content: str, window: int = 0
+    ) -> List[Tuple[Dict[str, Any], str]]:
+        """(request, question) pairs for the (q_seed_idx, instr_idx, question_number, question) items still to answer."""
+        pending = []
+        for q_seed_idx, instr_idx, question_number, question_text in items:
+            request = self.prepare_answer(
+                q_seed_idx, instr_idx, question_number, question_text, answer_instruction, combined_content, window
+            )
+            if request is not None:
+                pending.append((request, question_text))
+        return pending
+
+    def batched_answer_prompt(
+        self, pending: List[Tuple[Dict[str, Any], str]], answer_instruction: str, combined_content: str
+    ) -> str:
+        for request, _ in pending:
+            self.mark(ANSWERS, request["answer_name"], IN_FLIGHT)
+        question_block = AnswerBatcher.question_block([question_text for _, question_text in pending])
+        return self.answer_prompt(question_block, answer_instruction, combined_content)
+
+    def store_answer_batch(
+        self, pending: List[Tuple[Dict[str, Any], str]], response_text: Optional[str], attempt: int
+    ) -> List[Tuple[Dict[str, Any], str]]:
+        """Stores every answer found in a batched response and returns the questions still missing."""
+        answers = AnswerBatcher.parse(response_text, len(pending))
+        missing = []
+        for number, (request, question_text) in enumerate(pending, start=1):
+            if number in answers:
+                self.store_answer(request, answers[number])
+            else:
+                missing.append((request, question_text))
+        if not missing:
+            return missing
+        if attempt < self.answer_batcher.max_attempts:
+            Utils.logger.warning(
+                f"[Group: {self.group_name}] {len(missing)} of {len(pending)} answers missing from a batched response; "
+                f"asking for them again."
+            )
+            return missing
+        for request, _ in missing:
+            self.store_answer(request, None)
+        return []
+
+    def generate_answer_batch(
+        self, items: List[Tuple[int, int, int, str]], answer_instruction: str, combined_content: str, window: int = 0
+    ):
+        pending = self.prepare_answer_batch(items, answer_instruction, combined_content, window)
+        attempt = 0
+        while pending:
+            attempt += 1
+            final_prompt = self.batched_answer_prompt(pending, answer_instruction, combined_content)
+            response_text = self.answer_api_client.call_api(
+                final_prompt, pending[0][0]["prefix"], AnswerBatcher.schema(len(pending))
+            )
+            pending = self.store_answer_batch(pending, response_text, attempt)
+
+    async def generate_answer_batch_async(
+        self, items: List[Tuple[int, int, int, str]], answer_instruction: str, combined_content: str, window: int = 0
+    ):
+        pending = self.prepare_answer_batch(items, answer_instruction, combined_content, window)
+        attempt = 0
+        while pending:
+            attempt += 1
+            final_prompt = self.batched_answer_prompt(pending, answer_instruction, combined_content)
+            response_text = await self.answer_api_client.call_api(
+                final_prompt, pending[0][0]["prefix"], AnswerBatcher.schema(len(pending))
+            )
+            pending = self.store_answer_batch(pending, response_text, attempt)
+
+    def queue_answers(
+        self, scheduler, answer_task: Callable, batch_task: Callable,
+        q_seed_idx: int, instr_idx: int, question_number: int, question_text: str, window: int, content: str
+    ) -> None:
+        """Queues one answer task per answer instruction, or adds the question to the answer batches."""
+        prefix = self.answer_prefixes[window] if self.prefix_grouping else None
+        for answer_instruction in self.all_answer_instructions:
+            self.mark(ANSWERS, self.answer_name(q_seed_idx, instr_idx, question_number, answer_instruction, window), PLANNED)
+            if self.answer_batcher is None:
+                scheduler.submit(
+                    ANSWER_PRIORITY, answer_task,
+                    q_seed_idx, instr_idx, question_number, question_text, answer_instruction, content, window,
+                    prefix=prefix
+                )
+                continue
+            batch = self.answer_batcher.add(
+                (window, answer_instruction), (q_seed_idx, instr_idx, question_number, question_text)
+            )
+            if batch is not None:
+                scheduler.submit(ANSWER_PRIORITY, batch_task, batch, answer_instruction, content, window, prefix=prefix)
+
+    def finish_question_task(self, scheduler, batch_task: Callable) -> None:
+        """After the group's last question task, queues the answer batches that never filled up."""
+        if self.answer_batcher is None or not self.answer_batcher.finish_task():
+            return
+        windows = dict(self.content_windows)
+        for (window, answer_instruction), batch in self.answer_batcher.drain():
+            scheduler.submit(
+                ANSWER_PRIORITY, batch_task, batch, answer_instruction, windows[window], window,
+                prefix=self.answer_prefixes[window] if self.prefix_grouping else None
+            )
+
+    def prepare(self) -> bool:
+        if not self.resolve_templates():
+            return False
         self.collect_instructions_and_seeds()
-        file_list = self.group_config.get("files", [])
+        self.file_list = self.group_config.get("files", [])
         if not self.all_question_seeds or not self.all_question_instructions:
             Utils.logger.warning(f"[Group: {self.group_name}] No question seeds or instructions found.")
-            return
+            return False
 
-        # Build file content (could be slightly different for questions/answers)
-        combined_content_questions = self.generate_file_content(file_list, for_questions=True)
-        combined_content_answers = self.generate_file_content(file_list, for_questions=False)
+        # Build file content; questions and answers for a window both use that window's content.
+        self.content_windows = self.generate_content_windows(self.file_list)
+        self.answer_prefixes = {
+            window: self.answer_prefix_key(content)
+            for window, content in self.content_windows
+        }
+        return True
 
-        # --- Question Generation ---
+    def build_question_tasks(self) -> List[Tuple[int, int, str, str, int, str]]:
         question_tasks = []
-        question_collections = {}  # (q_seed_idx, instr_idx) -> List[str]
-        for q_seed_idx, seed_text in enumerate(self.all_question_seeds, start=1):
-            for instr_idx, instruction in enumerate(self.all_question_instructions, start=1):
-                question_tasks.append((q_seed_idx, instr_idx, seed_text, instruction))
-
-        def handle_question(task):
-            q_seed_idx, instr_idx, seed_text, instruction = task
-            text_block = self.generate_question_task(q_seed_idx, instr_idx, seed_text, instruction, combined_content_questions, file_list)
-            if not text_block:
-                return (q_seed_idx, instr_idx, [])
-            parsed = TextParser.parse_questions(text_block)
-            return (q_seed_idx, instr_idx, parsed)
-
-        inner_workers = self.thread_count if self.thread_count > 1 else 1
-        if inner_workers > 1:
-            with ThreadPoolExecutor(max_workers=inner_workers) as pool:
-                futures = {pool.submit(handle_question, t): t for t in question_tasks}
-                for f in as_completed(futures):
-                    q_seed_idx, instr_idx, q_list = f.result()
-                    question_collections[(q_seed_idx, instr_idx)] = q_list
-        else:
-            for t in question_tasks:
-                q_seed_idx, instr_idx, q_list = handle_question(t)
-                question_collections[(q_seed_idx, instr_idx)] = q_list
-
-        # --- Answer Generation ---
-        answer_tasks = []
-        for (q_seed_idx, instr_idx), q_list in question_collections.items():
-            if not q_list:
+        for window, content in self.content_windows:
+            for q_seed_idx, seed_text in enumerate(self.all_question_seeds, start=1):
+                for instr_idx, instruction in enumerate(self.all_question_instructions, start=1):
+                    question_tasks.append((q_seed_idx, instr_idx, seed_text, instruction, window, content))
+        return question_tasks
+
+    def is_up_to_date(self, kind: str, name: str, final_prompt: str, api_client) -> bool:
+        """Whether prepare_question / prepare_answer would reuse the output, without writing anything."""
+        trusted = self.is_trusted(kind, name)
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(api_client.cache_identity(), final_prompt, self.cache_sample)
+            if self.response_cache.peek(cache_key) is not None:
+                return True
+            return trusted and self.output_store.prompt_hash(kind, name) == Utils.get_hash(final_prompt)
+        if not trusted or self.output_store.read(kind, name) is None:
+            return False
+        stored_hash = self.output_store.prompt_hash(kind, name)
+        return kind == QUESTIONS or stored_hash is None or stored_hash == Utils.get_hash(final_prompt)
+
+    def plan(self, budget: ContextBudget, questions_per_list: float) -> Dict[str, float]:
+        """
+        Counts the requests this group would send and their prompt tokens, without
+        calling the API or writing outputs. Answers are counted exactly for question
+        lists that are already stored, and estimated with questions_per_list for the
+        lists that still have to be generated.
+        """
+        counts = dict.fromkeys((
+            "questions", "question_calls", "question_tokens", "answers", "answers_needed", "answer_calls",
+            "answer_tokens", "stored_lists", "stored_questions"
+        ), 0)
+        # (window, answer instruction) -> [answers still needed, tokens of their questions]
+        needed: Dict[Tuple[int, str], List[float]] = {}
+        for q_seed_idx, instr_idx, seed_text, instruction, window, content in self.build_question_tasks():
+            counts["questions"] += 1
+            name = self.questions_name(q_seed_idx, instr_idx, window)
+            final_prompt = self.question_prompt(seed_text, instruction, content, self.file_list)
+            stored = None
+            if self.is_up_to_date(QUESTIONS, name, final_prompt, self.question_api_client):
+                stored = self.output_store.read(QUESTIONS, name)
+            else:
+                counts["question_calls"] += 1
+                counts["question_tokens"] += budget.count(final_prompt)
+
+            for answer_instruction in self.all_answer_instructions:
+                bucket = needed.setdefault((window, answer_instruction), [0, 0])
+                if stored is None:
+                    # The questions are not known yet; every answer is assumed to be needed.
+                    counts["answers"] += questions_per_list
+                    bucket[0] += questions_per_list
+                    bucket[1] += questions_per_list * ESTIMATED_QUESTION_TOKENS
+                    continue
+                for q_num, q_text in enumerate(TextParser.parse_questions(stored), start=1):
+                    counts["answers"] += 1
+                    answer_prompt = self.answer_prompt(q_text, answer_instruction, content)
+                    answer_name = self.answer_name(q_seed_idx, instr_idx, q_num, answer_instruction, window)
+                    if not self.is_up_to_date(ANSWERS, answer_name, answer_prompt, self.answer_api_client):
+                        bucket[0] += 1
+                        bucket[1] += budget.count(q_text)
+            if stored is not None:
+                counts["stored_lists"] += 1
+                counts["stored_questions"] += len(TextParser.parse_questions(stored))
+
+        # Every answer request repeats the prompt around the question; batching sends it once per batch.
+        windows = dict(self.content_windows)
+        for (window, answer_instruction), (answers, question_tokens) in needed.items():
+            if not answers:
                 continue
-            for q_num, q_text in enumerate(q_list, start=1):
-                for answer_instruction in self.all_answer_instructions:
-                    answer_tasks.append((q_seed_idx, instr_idx, q_num, q_text, answer_instruction))
-
-        def handle_answer(task):
-            q_seed_idx, instr_idx, q_num, q_text, answer_instruction = task
-            self.generate_answer(q_seed_idx, instr_idx, q_num, q_text, answer_instruction, combined_content_answers)
-
-        if inner_workers > 1:
-            with ThreadPoolExecutor(max_workers=inner_workers) as pool:
-                futures = [pool.submit(handle_answer, t) for t in answer_tasks]
-                for f in as_completed(futures):
-                    f.result()
-        else:
-            for t in answer_tasks:
-                handle_answer(t)
\ No newline at end of file
+            base_tokens = budget.count(self.answer_prompt("", answer_instruction, windows[window]))
+            calls = answers
+            if self.answer_batcher is not None:
+                calls = math.ceil(answers / self.answer_batcher.questions_per_prompt)
+                base_tokens += budget.count(AnswerBatcher.question_block([]))
+            counts["answers_needed"] += answers
+            counts["answer_calls"] += calls
+            counts["answer_tokens"] += calls * base_tokens + question_tokens
+        return counts
+
+    def schedule(self, scheduler: WorkScheduler) -> None:
+        """
+        Queues this group's question tasks on a shared scheduler. Each finished (or,
+        when streaming, each parsed) question immediately queues its answer tasks,
+        so there is no barrier between the question and answer phases.
+        """
+        if not self.prepare():
+            return
+        question_tasks = self.build_question_tasks()
+        if self.answer_batcher is not None:
+            self.answer_batcher.start_tasks(len(question_tasks))
+        for task in question_tasks:
+            self.mark(QUESTIONS, self.questions_name(task[0], task[1], task[4]), PLANNED)
+            scheduler.submit(QUESTION_PRIORITY, self.run_question, scheduler, task, self.add_question_list())
+
+    def run_question(
+        self, scheduler: WorkScheduler, task: Tuple[int, int, str, str, int, str], list_number: Optional[int]
+    ) -> None:
+        q_seed_idx, instr_idx, seed_text, instruction, window, content = task
+
+        def on_question(q_num: int, q_text: str):
+            self.offer_question(list_number, q_seed_idx, instr_idx, q_num, q_text, lambda: self.queue_answers(
+                scheduler, self.generate_answer, self.generate_answer_batch,
+                q_seed_idx, instr_idx, q_num, q_text, window, content
+            ))
+
+        stored = False
+        try:
+            if self.question_api_client.stream:
+                stored = bool(self.stream_question_task(
+                    q_seed_idx, instr_idx, seed_text, instruction, content, self.file_list, on_question, window
+                ))
+                return
+            text_block = self.generate_question_task(
+                q_seed_idx, instr_idx, seed_text, instruction, content, self.file_list, window
+            )
+            if not text_block:
+                return
+            stored = True
+            for q_num, q_text in enumerate(TextParser.parse_questions(text_block), start=1):
+                on_question(q_num, q_text)
+        finally:
+            self.settle_question_list(
+                list_number, stored, lambda: self.finish_question_task(scheduler, self.generate_answer_batch)
+            )
+
+    def process(self):
+        scheduler = WorkScheduler(self.thread_count)
+        try:
+            self.schedule(scheduler)
+            scheduler.wait()
+        finally:
+            scheduler.shutdown()
+
+    def schedule_async(self, scheduler: AsyncWorkScheduler) -> None:
+        if not self.prepare():
+            return
+        question_tasks = self.build_question_tasks()
+        if self.answer_batcher is not None:
+            self.answer_batcher.start_tasks(len(question_tasks))
+        for task in question_tasks:
+            self.mark(QUESTIONS, self.questions_name(task[0], task[1], task[4]), PLANNED)
+            scheduler.submit(QUESTION_PRIORITY, self.run_question_async, scheduler, task, self.add_question_list())
+
+    async def run_question_async(
+        self, scheduler: AsyncWorkScheduler, task: Tuple[int, int, str, str, int, str], list_number: Optional[int]
+    ) -> None:
+        q_seed_idx, instr_idx, seed_text, instruction, window, content = task
+
+        def on_question(q_num: int, q_text: str):
+            self.offer_question(list_number, q_seed_idx, instr_idx, q_num, q_text, lambda: self.queue_answers(
+                scheduler, self.generate_answer_async, self.generate_answer_batch_async,
+                q_seed_idx, instr_idx, q_num, q_text, window, content
+            ))
+
+        stored = False
+        try:
+            if self.question_api_client.stream:
+                stored = bool(await self.stream_question_task_async(
+                    q_seed_idx, instr_idx, seed_text, instruction, content, self.file_list, on_question, window
+                ))
+                return
+            text_block = await self.generate_question_task_async(
+                q_seed_idx, instr_idx, seed_text, instruction, content, self.file_list, window
+            )
+            if not text_block:
+                return
+            stored = True
+            for q_num, q_text in enumerate(TextParser.parse_questions(text_block), start=1):
+                on_question(q_num, q_text)
+        finally:
+            self.settle_question_list(
+                list_number, stored, lambda: self.finish_question_task(scheduler, self.generate_answer_batch_async)
+            )
+
+    async def process_async(self):
+        scheduler = AsyncWorkScheduler(self.thread_count)
+        scheduler.start()
+        self.schedule_async(scheduler)
+        await scheduler.wait()
@@ -1,25 +1,55 @@
 import os
-import re
-import yaml
-import argparse
-import requests
-import hashlib
-import logging
-import random
-import time
+import threading
 from pathlib import Path
-from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List, Dict, Tuple
+from SyntheticDataGeneration.ContextBudget import ContextBudget
 from SyntheticDataGeneration.Utils import Utils
 
+# Suffix of the temporary files outputs are written to before being renamed into place.
+TMP_SUFFIX = ".tmp"
+
 class FileManager:
+    """
+    Locates and reads the input files for every file group. One instance is shared
+    by all FileGroupProcessors of a run: build_index() walks base_dir once, and
+    file contents and combined group contents are memoized by (path, mtime, size)
+    so an unchanged file is read once no matter how many groups use it. Token
+    counts per line are memoized the same way, so each file is tokenized once.
+    """
     def __init__(self, base_dir: Path):
         self.base_dir = base_dir
+        self.relative_index: Optional[Dict[str, Path]] = None
+        self.name_index: Optional[Dict[str, Path]] = None
+        self.lock = threading.Lock()
+        self.content_cache: Dict[Path, Tuple[Tuple[int, int], str]] = {}
+        self.combined_cache: Dict[Tuple, str] = {}
+        self.token_cache: Dict[Tuple[Path, str], Tuple[Tuple[int, int], List[int]]] = {}
+
+    def build_index(self) -> None:
+        relative_index = {}
+        name_index = {}
+        for root, dirs, files in os.walk(self.base_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = Path(root) / name
+                relative_index[path.relative_to(self.base_dir).as_posix()] = path
+                # Files referenced by bare name resolve to the first match in a sorted walk.
+                name_index.setdefault(name, path)
+        self.relative_index = relative_index
+        self.name_index = name_index
+        Utils.logger.info(f"Indexed {len(relative_index)} input files under {self.base_dir}")
 
     def find_file(self, relative_path: str) -> Optional[Path]:
+        if self.relative_index is not None:
+            path = self.relative_index.get(Path(relative_path).as_posix())
+            if path is not None:
+                return path
+        # Paths outside the indexed tree, such as ../shared/x.md or absolute paths.
         possible_path = self.base_dir / relative_path
         if possible_path.exists():
             return possible_path
+        if self.name_index is not None:
+            return self.name_index.get(Path(relative_path).name)
         target_name = Path(relative_path).name
         for path in self.base_dir.rglob(target_name):
             if path.is_file():
@@ -30,17 +60,142 @@ class FileManager:
         return file_path.read_text(encoding="utf-8")
 
     def write_text(self, file_path: Path, text: str) -> None:
+        """
+        Writes to a temporary file next to the target and renames it into place, so
+        a run that is killed mid-write never leaves a truncated output behind.
+        """
         file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_text(text, encoding="utf-8")
+        tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}")
+        try:
+            tmp_path.write_text(text, encoding="utf-8")
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    @staticmethod
+    def remove_stale_temp_files(directory: Path) -> None:
+        """Removes temporary files left by a run that stopped between writing and renaming."""
+        for tmp_path in directory.glob(f".*{TMP_SUFFIX}"):
+            tmp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def file_signature(file_path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = file_path.stat()
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read_input_text(self, file_path: Path, signature: Tuple[int, int]) -> str:
+        with self.lock:
+            cached = self.content_cache.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        content = self.read_text(file_path)
+        with self.lock:
+            self.content_cache[file_path] = (signature, content)
+        return content
 
     def build_files_content(self, file_list: List[str], file_header_template: str) -> str:
-        combined = ""
+        located = []
         for rel_path in file_list:
             file_path = self.find_file(rel_path)
-            if file_path and file_path.exists():
-                content = self.read_text(file_path)
+            signature = self.file_signature(file_path) if file_path else None
+            located.append((rel_path, file_path, signature))
+
+        cache_key = (file_header_template, tuple(located))
+        with self.lock:
+            cached = self.combined_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        combined = ""
+        for rel_path, file_path, signature in located:
+            if signature is not None:
+                content = self.read_input_text(file_path, signature)
                 combined += file_header_template.format(file_name=rel_path) + "\n"
                 combined += content + "\n\n"
             else:
                 Utils.logger.warning(f"{rel_path} not found in {self.base_dir} or its subdirectories.")
-        return combined
\ No newline at end of file
+        with self.lock:
+            self.combined_cache[cache_key] = combined
+        return combined
+
+    def line_token_counts(self, file_path: Path, signature: Tuple[int, int], budget: ContextBudget) -> List[int]:
+        """Token count of every line of the file (keepends), computed once per file version and tokenizer."""
+        cache_key = (file_path, budget.name)
+        with self.lock:
+            cached = self.token_cache.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        counts = budget.count_lines(self.read_input_text(file_path, signature).splitlines(keepends=True))
+        with self.lock:
+            self.token_cache[cache_key] = (signature, counts)
+        return counts
+
+    def build_content_windows(self, file_list: List[str], file_header_template: str, budget: ContextBudget) -> List[str]:
+        """
+        Returns the group's file content as one string if it fits in the token
+        budget (identical to build_files_content), otherwise as overlapping windows
+        that each fit. Windows are cut at line boundaries; a file that continues into
+        the next window gets its header again, and the last overlap_tokens worth of
+        lines of each window are repeated at the start of the next one.
+        """
+        units = []  # (rel_path, line, tokens)
+        header_tokens = {}
+        total = 0
+        for rel_path in file_list:
+            file_path = self.find_file(rel_path)
+            signature = self.file_signature(file_path) if file_path else None
+            if signature is None:
+                continue
+            lines = self.read_input_text(file_path, signature).splitlines(keepends=True)
+            counts = self.line_token_counts(file_path, signature, budget)
+            header_tokens[rel_path] = budget.count(file_header_template.format(file_name=rel_path) + "\n")
+            total += header_tokens[rel_path] + sum(counts)
+            units.extend((rel_path, line, tokens) for line, tokens in zip(lines, counts))
+
+        if total <= budget.budget:
+            return [self.build_files_content(file_list, file_header_template)]
+
+        def unit_cost(unit, neighbour) -> int:
+            # A line costs its tokens, plus its file header when it starts a run of that file.
+            return unit[2] + (header_tokens[unit[0]] if neighbour is None or neighbour[0] != unit[0] else 0)
+
+        windows = []
+        current = []
+        current_cost = 0
+        for unit in units:
+            if current and current_cost + unit_cost(unit, current[-1]) > budget.budget:
+                windows.append(current)
+                # Carry the tail of the window over, as long as it stays within overlap_tokens.
+                overlap = []
+                overlap_cost = 0
+                for previous in reversed(current):
+                    # Prepending a line of the same file moves its header up, which is already counted.
+                    previous_cost = unit_cost(previous, overlap[0] if overlap else None)
+                    if overlap_cost + previous_cost > budget.overlap:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_cost += previous_cost
+                current, current_cost = overlap, overlap_cost
+                # A line too long to share a window with the overlap starts a window of its own.
+                if current and current_cost + unit_cost(unit, current[-1]) > budget.budget:
+                    current, current_cost = [], 0
+            current_cost += unit_cost(unit, current[-1] if current else None)
+            current.append(unit)
+        if current:
+            windows.append(current)
+
+        rendered = []
+        for window in windows:
+            content = ""
+            for index, (rel_path, line, _) in enumerate(window):
+                if index == 0 or window[index - 1][0] != rel_path:
+                    if index > 0:
+                        content += "\n\n"
+                    content += file_header_template.format(file_name=rel_path) + "\n"
+                content += line
+            rendered.append(content + "\n\n")
+        return rendered
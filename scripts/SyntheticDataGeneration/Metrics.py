@@ -0,0 +1,298 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Callable, Tuple
+
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_METRICS_CONFIG = {
+    "enabled": True,
+    "prometheus_port": 0,  # Serve Prometheus text metrics on this port while the run lasts; 0 = off.
+    "snapshot_path": "qa_generation_output/metrics.json",  # Relative to output_base_path; null = no snapshots.
+    "snapshot_interval": 30,  # Seconds between JSON snapshots.
+}
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf"))
+
+# Gauges are sampled this often (seconds) to track their peaks between snapshots.
+GAUGE_SAMPLE_INTERVAL = 1.0
+
+# (provider, model, phase)
+Labels = Tuple[str, str, str]
+
+class Histogram:
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating inside the bucket that contains it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if self.bounds[i] != float("inf") else lower * 2 or 1.0
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-2]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "buckets": {("+Inf" if b == float("inf") else str(b)): c for b, c in zip(self.bounds, self.counts)},
+            "p50": round(self.quantile(0.5), 3),
+            "p95": round(self.quantile(0.95), 3),
+            "p99": round(self.quantile(0.99), 3),
+        }
+
+class RunMetrics:
+    """
+    Run-level metrics for generate_qa_data. API clients record every request
+    (latency, outcome, retries and token counts, labelled by provider, model and
+    phase); the engine registers gauges such as queue depth and in-flight
+    requests, sampled every second, and sources such as the response cache
+    stats, read when a snapshot is taken. Snapshots are written as JSON every
+    snapshot_interval seconds and/or served in Prometheus text format, and a
+    summary is logged at the end of the run.
+    """
+    def __init__(self, config: Dict[str, Any], output_base_path: Path):
+        self.config = config
+        self.snapshot_path = output_base_path / config["snapshot_path"] if config["snapshot_path"] else None
+        self.lock = threading.Lock()
+        self.latency: Dict[Labels, Histogram] = defaultdict(Histogram)
+        self.requests: Dict[Tuple[Labels, str], int] = defaultdict(int)  # (labels, outcome) -> count
+        self.retries: Dict[Tuple[Labels, str], int] = defaultdict(int)   # (labels, error kind) -> count
+        self.prompt_tokens: Dict[Labels, int] = defaultdict(int)
+        self.completion_tokens: Dict[Labels, int] = defaultdict(int)
+        self.gauges: Dict[str, Tuple[Callable[[], Any], str]] = {}
+        self.gauge_peaks: Dict[str, float] = {}
+        self.sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self.started = time.monotonic()
+        self.stop_event = threading.Event()
+        self.snapshot_thread: Optional[threading.Thread] = None
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @staticmethod
+    def resolve_config(metrics_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_METRICS_CONFIG)
+        resolved.update(metrics_config or {})
+        return resolved
+
+    @staticmethod
+    def from_config(metrics_config: Optional[Dict[str, Any]], output_base_path: Path) -> Optional["RunMetrics"]:
+        config = RunMetrics.resolve_config(metrics_config)
+        if not config["enabled"]:
+            return None
+        return RunMetrics(config, output_base_path)
+
+    # --- Recording ---
+
+    def record_request(self, labels: Labels, latency: float, outcome: str = "") -> None:
+        """outcome is the error class of a failed attempt, or "" for a success."""
+        with self.lock:
+            self.latency[labels].observe(latency)
+            self.requests[(labels, outcome or "ok")] += 1
+
+    def record_retry(self, labels: Labels, kind: str) -> None:
+        with self.lock:
+            self.retries[(labels, kind)] += 1
+
+    def record_tokens(self, labels: Labels, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+        with self.lock:
+            self.prompt_tokens[labels] += prompt_tokens or 0
+            self.completion_tokens[labels] += completion_tokens or 0
+
+    def add_gauge(self, name: str, read: Callable[[], Any], label: str = "key") -> None:
+        """read() returns a number, or a dict of numbers keyed by the value of the given label."""
+        self.gauges[name] = (read, label)
+
+    def add_source(self, name: str, read: Callable[[], Dict[str, Any]]) -> None:
+        self.sources[name] = read
+
+    # --- Reporting ---
+
+    def sample_gauges(self) -> Dict[str, Any]:
+        values = {}
+        for name, (read, _) in list(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            values[name] = value
+            total = sum(value.values()) if isinstance(value, dict) else value
+            with self.lock:
+                self.gauge_peaks[name] = max(self.gauge_peaks.get(name, 0), total)
+        return values
+
+    def snapshot(self) -> Dict[str, Any]:
+        gauges = self.sample_gauges()
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            groups = []
+            for labels in sorted(set(self.latency) | set(self.prompt_tokens)):
+                provider, model, phase = labels
+                completion = self.completion_tokens[labels]
+                groups.append({
+                    "provider": provider,
+                    "model": model,
+                    "phase": phase,
+                    "requests": {outcome: n for (l, outcome), n in sorted(self.requests.items()) if l == labels},
+                    "retries": {kind: n for (l, kind), n in sorted(self.retries.items()) if l == labels},
+                    "latency_seconds": self.latency[labels].to_dict() if labels in self.latency else None,
+                    "prompt_tokens": self.prompt_tokens[labels],
+                    "completion_tokens": completion,
+                    "completion_tokens_per_second": round(completion / elapsed, 2) if elapsed > 0 else 0.0,
+                })
+            peaks = dict(self.gauge_peaks)
+        sources = {}
+        for name, read in list(self.sources.items()):
+            try:
+                sources[name] = read()
+            except Exception:
+                continue
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": groups,
+            "gauges": gauges,
+            "gauge_peaks": peaks,
+            **sources,
+        }
+
+    def prometheus_text(self) -> str:
+        snapshot = self.snapshot()
+        # Every sample of a metric family must be written in one block, after its TYPE line.
+        families: Dict[str, Tuple[str, List[str]]] = {}
+
+        def add(name: str, kind: str, sample: str) -> None:
+            families.setdefault(name, (kind, []))[1].append(sample)
+
+        for group in snapshot["requests"]:
+            labels = f'provider="{group["provider"]}",model="{group["model"]}",phase="{group["phase"]}"'
+            latency = group["latency_seconds"]
+            if latency is not None:
+                cumulative = 0
+                for bound, count in latency["buckets"].items():
+                    cumulative += count
+                    add("qa_request_latency_seconds", "histogram",
+                        f'qa_request_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                add("qa_request_latency_seconds", "histogram", f"qa_request_latency_seconds_sum{{{labels}}} {latency['sum']}")
+                add("qa_request_latency_seconds", "histogram", f"qa_request_latency_seconds_count{{{labels}}} {latency['count']}")
+            for outcome, count in group["requests"].items():
+                add("qa_requests_total", "counter", f'qa_requests_total{{{labels},outcome="{outcome}"}} {count}')
+            for kind, count in group["retries"].items():
+                add("qa_retries_total", "counter", f'qa_retries_total{{{labels},kind="{kind}"}} {count}')
+            add("qa_prompt_tokens_total", "counter", f"qa_prompt_tokens_total{{{labels}}} {group['prompt_tokens']}")
+            add("qa_completion_tokens_total", "counter", f"qa_completion_tokens_total{{{labels}}} {group['completion_tokens']}")
+        for name, value in snapshot["gauges"].items():
+            if isinstance(value, dict):
+                label = self.gauges[name][1]
+                for key, v in value.items():
+                    add(f"qa_{name}", "gauge", f'qa_{name}{{{label}="{key}"}} {v}')
+            else:
+                add(f"qa_{name}", "gauge", f"qa_{name} {value}")
+        cache = snapshot.get("response_cache")
+        if cache:
+            add("qa_cache_hits_total", "counter", f"qa_cache_hits_total {cache['hits']}")
+            add("qa_cache_misses_total", "counter", f"qa_cache_misses_total {cache['misses']}")
+
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self) -> None:
+        if self.snapshot_path is None:
+            return
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.snapshot_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(self.snapshot(), indent=2), encoding="utf-8")
+        os.replace(temp_path, self.snapshot_path)
+
+    def _snapshot_loop(self) -> None:
+        last_write = time.monotonic()
+        while not self.stop_event.wait(GAUGE_SAMPLE_INTERVAL):
+            if self.snapshot_path is not None and time.monotonic() - last_write >= self.config["snapshot_interval"]:
+                self.write_snapshot()
+                last_write = time.monotonic()
+            else:
+                self.sample_gauges()
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self.stop_event.clear()
+        self.snapshot_thread = threading.Thread(target=self._snapshot_loop, name="metrics-snapshot", daemon=True)
+        self.snapshot_thread.start()
+        if self.config["prometheus_port"]:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.prometheus_text().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("0.0.0.0", self.config["prometheus_port"]), Handler)
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+            Utils.logger.info(f"Serving Prometheus metrics on port {self.config['prometheus_port']}")
+
+    def stop(self) -> None:
+        """Writes the final snapshot and logs the summary."""
+        self.stop_event.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.write_snapshot()
+        self.log_summary()
+
+    def log_summary(self) -> None:
+        snapshot = self.snapshot()
+        Utils.logger.info(f"Run metrics ({snapshot['elapsed_seconds']:.1f}s):")
+        for group in snapshot["requests"]:
+            requests = sum(group["requests"].values())
+            failed = requests - group["requests"].get("ok", 0)
+            retries = sum(group["retries"].values())
+            latency = group["latency_seconds"]
+            latency_text = (
+                f"latency p50 {latency['p50']:.2f}s p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s; "
+                if latency else ""
+            )
+            Utils.logger.info(
+                f"  {group['provider']}/{group['model']} {group['phase']}: {requests} requests ({failed} failed, "
+                f"{retries} retries); {latency_text}{group['prompt_tokens']} prompt / {group['completion_tokens']} "
+                f"completion tokens, {group['completion_tokens_per_second']:.1f} completion tokens/s"
+            )
+        for name, peak in snapshot["gauge_peaks"].items():
+            Utils.logger.info(f"  Peak {name.replace('_', ' ')}: {peak}")
+        if self.snapshot_path is not None:
+            Utils.logger.info(f"  Metrics snapshot written to {self.snapshot_path}")
@@ -0,0 +1,293 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, List, Dict, Any
+
+from SyntheticDataGeneration.FileManager import FileManager
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_OUTPUT_CONFIG = {
+    "backend": "files",       # "files" or "shards"
+    "shard_size_mb": 256,
+    "debug_prompts": "files",  # "files", "dedup" or "off"
+}
+
+QUESTIONS = "questions"
+ANSWERS = "answers"
+
+class PromptStore:
+    """
+    Keeps each distinct prompt once, keyed by its sha256, plus which output it
+    produced. Used instead of a debug file per output, since every prompt of a
+    group repeats the same combined file content.
+    """
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS prompts (hash TEXT PRIMARY KEY, prompt TEXT NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS prompt_refs (kind TEXT NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL, "
+            "PRIMARY KEY (kind, name))"
+        )
+        self.connection.commit()
+
+    def put(self, kind: str, name: str, prompt: str) -> str:
+        prompt_hash = Utils.get_hash(prompt)
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO prompts (hash, prompt) VALUES (?, ?)", (prompt_hash, prompt))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO prompt_refs (kind, name, hash) VALUES (?, ?, ?)", (kind, name, prompt_hash)
+            )
+            self.connection.commit()
+        return prompt_hash
+
+    def prompt_hash(self, kind: str, name: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM prompt_refs WHERE kind = ? AND name = ?", (kind, name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, prompt_hash: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT prompt FROM prompts WHERE hash = ?", (prompt_hash,)).fetchone()
+        return row[0] if row else None
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+class FileOutputStore:
+    """
+    One text file per question list and per answer, as the original layout:
+    questions/, answers/ (with a .meta holding the prompt hash) and debug/.
+    A read_only store creates no directories, for reading while a run writes.
+    """
+    def __init__(self, output_dir: Path, file_manager: FileManager, debug_prompts: str = "files", read_only: bool = False):
+        self.output_dir = output_dir
+        self.file_manager = file_manager
+        self.debug_prompts = "off" if read_only else debug_prompts
+        self.dirs = {QUESTIONS: output_dir / "questions", ANSWERS: output_dir / "answers"}
+        self.debug_dir = output_dir / "debug"
+        if not read_only:
+            for d in list(self.dirs.values()) + [self.debug_dir]:
+                d.mkdir(parents=True, exist_ok=True)
+        self.prompt_store = PromptStore(self.debug_dir / "prompts.sqlite") if self.debug_prompts == "dedup" else None
+
+    def remove_stale_temp_files(self) -> None:
+        """
+        Removes the temporary files of writes cut short by a crash. Only called when a
+        run starts, since the temporary files of a run still in progress look the same.
+        """
+        for d in list(self.dirs.values()) + [self.debug_dir]:
+            FileManager.remove_stale_temp_files(d)
+
+    def path(self, kind: str, name: str) -> Path:
+        return self.dirs[kind] / name
+
+    def location(self, kind: str, name: str) -> str:
+        return str(self.path(kind, name))
+
+    def debug_path(self, kind: str, name: str) -> Path:
+        # questions_{group}_seed{s}_instr{i}.txt -> debug_{group}_seed{s}_instr{i}_questions.txt
+        # answer_{group}_seed{s}_...txt          -> debug_{group}_answer_seed{s}_...txt
+        if kind == QUESTIONS:
+            return self.debug_dir / ("debug_" + name[len("questions_"):-len(".txt")] + "_questions.txt")
+        return self.debug_dir / re.sub(r"^answer_(.+)_seed", r"debug_\1_answer_seed", name)
+
+    def meta_path(self, name: str) -> Path:
+        return self.dirs[ANSWERS] / (name[:-len(".txt")] + ".meta")
+
+    def names(self, kind: str) -> List[str]:
+        return sorted(self.signatures(kind))
+
+    def signatures(self, kind: str) -> Dict[str, str]:
+        """Maps each output name to a string that changes whenever the output is rewritten."""
+        signatures = {}
+        if not self.dirs[kind].is_dir():
+            return signatures
+        with os.scandir(self.dirs[kind]) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    stat = entry.stat()
+                    signatures[entry.name] = f"{stat.st_mtime_ns}:{stat.st_size}"
+        return signatures
+
+    def read(self, kind: str, name: str) -> Optional[str]:
+        path = self.path(kind, name)
+        return self.file_manager.read_text(path) if path.exists() else None
+
+    def prompt_hash(self, kind: str, name: str) -> Optional[str]:
+        """Hash of the prompt the stored output was generated from, if it is known."""
+        if kind == ANSWERS and self.meta_path(name).exists():
+            return self.file_manager.read_text(self.meta_path(name)).strip()
+        if self.prompt_store is not None:
+            return self.prompt_store.prompt_hash(kind, name)
+        debug_path = self.debug_path(kind, name)
+        if kind == QUESTIONS and debug_path.exists():
+            return Utils.get_hash(self.file_manager.read_text(debug_path))
+        return None
+
+    def write(self, kind: str, name: str, text: str, prompt: str, fields: Dict[str, Any]) -> None:
+        self.file_manager.write_text(self.path(kind, name), text)
+        if kind == ANSWERS:
+            self.file_manager.write_text(self.meta_path(name), Utils.get_hash(prompt))
+        if self.debug_prompts == "files":
+            self.file_manager.write_text(self.debug_path(kind, name), prompt)
+        elif self.prompt_store is not None:
+            self.prompt_store.put(kind, name, prompt)
+
+    def sync(self, kind: str, name: str, text: str, prompt: str, fields: Dict[str, Any]) -> None:
+        """Writes the output only if the stored copy is missing or different."""
+        if self.read(kind, name) != text:
+            self.write(kind, name, text, prompt, fields)
+
+    def close(self) -> None:
+        if self.prompt_store is not None:
+            self.prompt_store.close()
+
+class ShardOutputStore:
+    """
+    Appends every question list and answer as one JSON line to rotating shard
+    files (shards/records-00000.jsonl, ...) instead of writing three small files
+    per answer. shards/index.sqlite maps each output name to the shard, offset and
+    length of its latest record, along with its (group, seed, instr, q) and the
+    hash of its prompt. Rewritten outputs append a new record; the index always
+    points at the newest one. A read_only store opens an existing index without
+    changing it.
+    """
+    def __init__(self, output_dir: Path, shard_size_mb: float = 256, debug_prompts: str = "dedup", read_only: bool = False):
+        self.shard_dir = output_dir / "shards"
+        self.shard_size = int(shard_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.shard_file = None
+        index_path = self.shard_dir / "index.sqlite"
+        if read_only:
+            if not index_path.exists():
+                raise FileNotFoundError(f"No output shard index at {index_path}")
+            self.connection = sqlite3.connect(f"{index_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            self.prompt_store = None
+            return
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(index_path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "kind TEXT NOT NULL, name TEXT NOT NULL, group_name TEXT, seed INTEGER, instr INTEGER, question INTEGER, "
+            "shard TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, prompt_hash TEXT, "
+            "PRIMARY KEY (kind, name))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS outputs_question ON outputs(group_name, seed, instr, question)"
+        )
+        self.connection.commit()
+        # Debug prompts are never written as one file per output here; "files" falls back to dedup.
+        self.prompt_store = PromptStore(self.shard_dir / "prompts.sqlite") if debug_prompts != "off" else None
+        shards = sorted(self.shard_dir.glob("records-*.jsonl"))
+        self.shard_number = int(shards[-1].stem.split("-")[1]) if shards else 0
+
+    @staticmethod
+    def exists(output_dir: Path) -> bool:
+        return (output_dir / "shards" / "index.sqlite").exists()
+
+    def remove_stale_temp_files(self) -> None:
+        pass  # Records are appended in place; nothing is written to temporary files.
+
+    def shard_path(self, number: int) -> Path:
+        return self.shard_dir / f"records-{number:05d}.jsonl"
+
+    def location(self, kind: str, name: str) -> str:
+        return f"{self.shard_dir}:{name}"
+
+    def names(self, kind: str) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT name FROM outputs WHERE kind = ? ORDER BY name", (kind,)).fetchall()
+        return [row[0] for row in rows]
+
+    def signatures(self, kind: str) -> Dict[str, str]:
+        # Every rewrite appends a new record, so the record location identifies the content.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT name, shard, offset, length FROM outputs WHERE kind = ?", (kind,)
+            ).fetchall()
+        return {name: f"{shard}:{offset}:{length}" for name, shard, offset, length in rows}
+
+    def read(self, kind: str, name: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT shard, offset, length FROM outputs WHERE kind = ? AND name = ?", (kind, name)
+            ).fetchone()
+        if row is None:
+            return None
+        shard, offset, length = row
+        with open(self.shard_dir / shard, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))["text"]
+
+    def prompt_hash(self, kind: str, name: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT prompt_hash FROM outputs WHERE kind = ? AND name = ?", (kind, name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def write(self, kind: str, name: str, text: str, prompt: str, fields: Dict[str, Any]) -> None:
+        prompt_hash = self.prompt_store.put(kind, name, prompt) if self.prompt_store is not None else Utils.get_hash(prompt)
+        record = {"kind": kind, "name": name, **fields, "prompt_hash": prompt_hash, "text": text}
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            if self.shard_file is None:
+                self.shard_file = open(self.shard_path(self.shard_number), "ab")
+            if self.shard_file.tell() > 0 and self.shard_file.tell() + len(line) > self.shard_size:
+                self.shard_file.close()
+                self.shard_number += 1
+                self.shard_file = open(self.shard_path(self.shard_number), "ab")
+            offset = self.shard_file.tell()
+            self.shard_file.write(line)
+            # The record must be on disk before the index points at it, or a crash could
+            # leave the index pointing at a torn line.
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs "
+                "(kind, name, group_name, seed, instr, question, shard, offset, length, prompt_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, name, fields.get("group"), fields.get("seed"), fields.get("instr"), fields.get("question"),
+                 self.shard_path(self.shard_number).name, offset, len(line), prompt_hash)
+            )
+            self.connection.commit()
+
+    def sync(self, kind: str, name: str, text: str, prompt: str, fields: Dict[str, Any]) -> None:
+        if self.read(kind, name) != text:
+            self.write(kind, name, text, prompt, fields)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.shard_file is not None:
+                self.shard_file.close()
+                self.shard_file = None
+            self.connection.close()
+        if self.prompt_store is not None:
+            self.prompt_store.close()
+
+class OutputStore:
+    """Creates the output backend selected by global.output."""
+    @staticmethod
+    def resolve_config(output_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_OUTPUT_CONFIG)
+        resolved.update(output_config or {})
+        return resolved
+
+    @staticmethod
+    def create(output_dir: Path, file_manager: FileManager, output_config: Optional[Dict[str, Any]] = None):
+        config = OutputStore.resolve_config(output_config)
+        if config["backend"] == "shards":
+            return ShardOutputStore(output_dir, config["shard_size_mb"], config["debug_prompts"])
+        return FileOutputStore(output_dir, file_manager, config["debug_prompts"])
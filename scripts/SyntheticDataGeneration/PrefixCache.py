@@ -0,0 +1,68 @@
+import threading
+from typing import Optional, Dict, Any
+
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_PREFIX_CACHE_CONFIG = {
+    "enabled": True,
+    # How many more requests (relative to its weight) the endpoint holding a prefix
+    # may have in flight than the least busy endpoint before the prefix spills over.
+    "affinity_slack": 2,
+}
+
+class PromptEvalStats:
+    """
+    Collects prompt_eval_count and prompt_eval_duration from Ollama responses.
+    Ollama only evaluates the part of a prompt that is not already in its KV
+    cache, so for each prompt prefix the largest count seen approximates a full
+    evaluation; every request that evaluated fewer tokens reused the cache. The
+    time saved is estimated from the run's average prompt evaluation speed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prefix_tokens: Dict[str, int] = {}
+        self.requests = 0
+        self.evaluated_tokens = 0
+        self.eval_duration_ns = 0
+        self.saved_tokens = 0
+
+    @staticmethod
+    def resolve_config(prefix_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_PREFIX_CACHE_CONFIG)
+        resolved.update(prefix_config or {})
+        return resolved
+
+    def record(self, prefix: Optional[str], result: Dict[str, Any]) -> None:
+        count = result.get("prompt_eval_count")
+        duration = result.get("prompt_eval_duration")
+        if count is None or duration is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.evaluated_tokens += count
+            self.eval_duration_ns += duration
+            if prefix is None:
+                return
+            full = self.prefix_tokens.get(prefix, 0)
+            if count > full:
+                self.prefix_tokens[prefix] = count
+            else:
+                self.saved_tokens += full - count
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "evaluated_tokens": self.evaluated_tokens,
+                "eval_seconds": round(self.eval_duration_ns / 1e9, 3),
+                "reused_prefix_tokens": self.saved_tokens,
+            }
+
+    def log_stats(self) -> None:
+        if not self.requests:
+            return
+        ns_per_token = self.eval_duration_ns / max(self.evaluated_tokens, 1)
+        Utils.logger.info(
+            f"Prompt eval: {self.evaluated_tokens} tokens in {self.eval_duration_ns / 1e9:.1f}s over {self.requests} requests; "
+            f"~{self.saved_tokens} prefix tokens reused from the KV cache, saving ~{self.saved_tokens * ns_per_token / 1e9:.1f}s."
+        )
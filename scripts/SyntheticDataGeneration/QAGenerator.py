@@ -1,12 +1,27 @@
 import os
+import asyncio
+import functools
 from pathlib import Path
-from typing import Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Tuple, Callable
 
+from SyntheticDataGeneration.AnswerBatcher import AnswerBatcher
 from SyntheticDataGeneration.ApiClient import APIClient
+from SyntheticDataGeneration.AsyncApiClient import AsyncAPIClient, AsyncOpenAI, httpx
+from SyntheticDataGeneration.BatchRunner import OpenAIBatchRunner
+from SyntheticDataGeneration.ContextBudget import ContextBudget
+from SyntheticDataGeneration.EndpointPool import EndpointPool
 from SyntheticDataGeneration.FileManager import FileManager
 from SyntheticDataGeneration.FileGroupProcessor import FileGroupProcessor
+from SyntheticDataGeneration.Metrics import RunMetrics
+from SyntheticDataGeneration.OutputStore import OutputStore, QUESTIONS, ANSWERS
+from SyntheticDataGeneration.PrefixCache import PromptEvalStats
+from SyntheticDataGeneration.QuestionDeduplicator import QuestionDeduplicator
+from SyntheticDataGeneration.RateController import ProviderControllerRegistry
+from SyntheticDataGeneration.ResponseCache import ResponseCache
+from SyntheticDataGeneration.TextParser import TextParser
 from SyntheticDataGeneration.Utils import Utils
+from SyntheticDataGeneration.WorkLedger import WorkLedger, IN_FLIGHT
+from SyntheticDataGeneration.WorkScheduler import WorkScheduler, AsyncWorkScheduler, QUESTION_PRIORITY
 
 # Try importing the OpenAI client
 try:
@@ -24,64 +39,467 @@ class QAGeneratorEngine:
         global_config = config.get("global", {})
         base_dir = global_config.get("base_dir", "")
         self.full_base_dir = output_base_path / base_dir
-        self.global_ollama_url = global_config.get("ollama_url", "http://localhost:11434/api/generate")
+        self.http_config = APIClient.resolve_http_config(global_config.get("http"))
+        # Optional: point the OpenAI SDK at a compatible or stand-in server.
+        self.openai_base_url = global_config.get("openai_base_url")
+        self.batch_config = OpenAIBatchRunner.resolve_config(global_config.get("batch"))
+        # One adaptive controller per provider endpoint, shared by both clients and both engines.
+        self.controllers = ProviderControllerRegistry(global_config.get("rate_control"), max(thread_count, 1))
+        # ollama_url may list several Ollama hosts; requests are balanced across them.
+        self.ollama_endpoints = EndpointPool.from_config(
+            global_config.get("ollama_url", "http://localhost:11434/api/generate"),
+            global_config.get("health_check"),
+            self.controllers
+        )
+        self.global_ollama_url = self.ollama_endpoints.endpoints[0].url if self.ollama_endpoints.endpoints else None
+        # Answers sharing their file content are queued together and kept on one endpoint.
+        self.prefix_config = PromptEvalStats.resolve_config(global_config.get("prefix_cache"))
+        if self.prefix_config["enabled"]:
+            self.ollama_endpoints.enable_prefix_affinity(self.prefix_config["affinity_slack"])
+        self.prompt_stats = PromptEvalStats()
+        self.metrics = RunMetrics.from_config(global_config.get("metrics"), output_base_path)
         self.file_groups_config = config.get("file_groups", {})
 
         # Providers configuration
         question_provider_config = config.get("providers", {}).get("question", {})
         answer_provider_config = config.get("providers", {}).get("answer", {})
+        self.question_provider_config = question_provider_config
+        self.answer_provider_config = answer_provider_config
 
         openai_client = None
-        if (question_provider_config.get("provider", "").lower() == "openai" or
-            answer_provider_config.get("provider", "").lower() == "openai"):
+        if self.uses_provider("openai"):
             if OpenAI is None:
                 Utils.logger.error("OpenAI client cannot be initialized because the package is missing.")
             else:
                 api_key = os.environ.get("OPENAI_API_KEY")
-                openai_client = OpenAI(api_key=api_key)
+                # Retries are handled by the provider controller, not the SDK.
+                openai_client = OpenAI(api_key=api_key, base_url=self.openai_base_url, max_retries=0)
 
         self.question_api_client = APIClient(
             provider=question_provider_config.get("provider", ""),
             model=question_provider_config.get("model", ""),
             global_ollama_url=self.global_ollama_url,
-            openai_client=openai_client
+            openai_client=openai_client,
+            http_config=self.http_config,
+            controller=self.get_controller(question_provider_config),
+            endpoints=self.ollama_endpoints,
+            options=question_provider_config.get("options"),
+            keep_alive=question_provider_config.get("keep_alive"),
+            prompt_stats=self.prompt_stats,
+            phase=QUESTIONS,
+            metrics=self.metrics
         )
         self.answer_api_client = APIClient(
             provider=answer_provider_config.get("provider", ""),
             model=answer_provider_config.get("model", ""),
             global_ollama_url=self.global_ollama_url,
-            openai_client=openai_client
+            openai_client=openai_client,
+            http_config=self.http_config,
+            controller=self.get_controller(answer_provider_config),
+            endpoints=self.ollama_endpoints,
+            options=answer_provider_config.get("options"),
+            keep_alive=answer_provider_config.get("keep_alive"),
+            prompt_stats=self.prompt_stats,
+            phase=ANSWERS,
+            metrics=self.metrics
         )
         self.file_manager = FileManager(self.full_base_dir)
+        self.file_manager.build_index()
+
+        self.cache_config = ResponseCache.resolve_config(global_config.get("cache"))
+        self.response_cache = None
+        if self.cache_config["enabled"]:
+            self.response_cache = ResponseCache(output_base_path / self.cache_config["path"], self.cache_config["max_size_mb"])
+        self.output_store = OutputStore.create(
+            output_base_path / "qa_generation_output", self.file_manager, global_config.get("output")
+        )
+        self.question_dedup = QuestionDeduplicator.from_config(global_config.get("question_dedup"))
+        self.context_budget = ContextBudget.from_config(global_config.get("chunking"))
+        self.chunking_config = global_config.get("chunking")
+        self.ledger = WorkLedger.from_config(global_config.get("ledger"), output_base_path)
+        self.answer_batching_config = AnswerBatcher.resolve_config(global_config.get("answer_batching"))
+        self.apply_context_options(self.question_api_client)
+        self.apply_context_options(self.answer_api_client)
 
-    def expand_file_groups(self) -> Dict[str, Dict[str, Any]]:
+    def expand_file_groups(self) -> Dict[str, Tuple[int, Dict[str, Any]]]:
         expanded = {}
         for group_name, g_config in self.file_groups_config.items():
             iterations = g_config.get("iterations", 1)
             for i in range(1, iterations + 1):
                 key = f"{group_name}_{i}"
-                expanded[key] = g_config
+                expanded[key] = (i, g_config)
         return expanded
 
+    def get_controller(self, provider_config: Dict[str, Any]):
+        return self.controllers.get(provider_config.get("provider", "").lower(), self.global_ollama_url)
+
+    def apply_context_options(self, api_client) -> None:
+        # The windows are sized for num_ctx, so it overrides a num_ctx set in the provider options.
+        if self.context_budget is not None and api_client.provider == "ollama":
+            api_client.options["num_ctx"] = self.context_budget.num_ctx
+
+    def uses_provider(self, provider: str) -> bool:
+        return (self.question_provider_config.get("provider", "").lower() == provider or
+                self.answer_provider_config.get("provider", "").lower() == provider)
+
+    def create_processor(
+        self, group_name: str, iteration: int, group_conf: Dict[str, Any], question_api_client, answer_api_client
+    ) -> FileGroupProcessor:
+        # Iterations exist to sample different outputs for the same prompts, so by
+        # default each iteration gets its own cache entries.
+        cache_sample = None if self.cache_config["share_across_iterations"] else str(iteration)
+        return FileGroupProcessor(
+            group_name=group_name,
+            group_config=group_conf,
+            config=self.config,
+            full_base_dir=self.full_base_dir,
+            output_base_path=self.output_base_path,
+            question_api_client=question_api_client,
+            answer_api_client=answer_api_client,
+            thread_count=self.thread_count,
+            file_manager=self.file_manager,
+            response_cache=self.response_cache,
+            cache_sample=cache_sample,
+            output_store=self.output_store,
+            question_dedup=self.question_dedup,
+            context_budget=self.context_budget,
+            prefix_grouping=self.prefix_config["enabled"],
+            ledger=self.ledger,
+            # Each group collects its own batches.
+            answer_batcher=AnswerBatcher.from_config(self.answer_batching_config)
+        )
+
+    def start_health_checks(self) -> None:
+        if self.uses_provider("ollama"):
+            self.ollama_endpoints.start_health_checks()
+
+    def start_metrics(self, api_clients: List[Any], queue_depth: Optional[Callable[[], int]] = None) -> None:
+        if self.metrics is None:
+            return
+        pools = list({id(client.endpoints): client.endpoints for client in api_clients}.values())
+        self.metrics.add_gauge(
+            "in_flight_requests",
+            lambda: {endpoint.url or "openai": endpoint.in_flight for pool in pools for endpoint in pool.endpoints},
+            label="endpoint"
+        )
+        if queue_depth is not None:
+            self.metrics.add_gauge("queue_depth", queue_depth)
+        if self.response_cache is not None:
+            self.metrics.add_source("response_cache", self.response_cache.stats)
+        self.metrics.add_source("prompt_eval", self.prompt_stats.stats)
+        self.metrics.start()
+
+    def close_stores(self) -> None:
+        # Stopped first so the final snapshot still includes the cache stats.
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.question_dedup is not None:
+            self.question_dedup.log_stats()
+        if self.response_cache is not None:
+            self.response_cache.log_stats()
+            self.response_cache.close()
+        self.output_store.close()
+        if self.ledger is not None:
+            self.ledger.close()
+        self.prompt_stats.log_stats()
+
     def run(self):
         expanded_groups = self.expand_file_groups()
+        self.output_store.remove_stale_temp_files()
         total_groups = len(expanded_groups)
         Utils.logger.info(f"Starting processing of {total_groups} file groups with up to {self.thread_count} threads...")
-        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-            futures = []
-            for group_name, group_conf in expanded_groups.items():
-                processor = FileGroupProcessor(
-                    group_name=group_name,
-                    group_config=group_conf,
-                    config=self.config,
-                    full_base_dir=self.full_base_dir,
-                    output_base_path=self.output_base_path,
-                    question_api_client=self.question_api_client,
-                    answer_api_client=self.answer_api_client,
-                    thread_count=self.thread_count,
-                    file_manager=self.file_manager
+        # One shared queue and worker pool for every group, question and answer in the run.
+        scheduler = WorkScheduler(self.thread_count)
+        self.start_health_checks()
+        self.start_metrics([self.question_api_client, self.answer_api_client], scheduler.queue.qsize)
+        try:
+            for group_name, (iteration, group_conf) in expanded_groups.items():
+                processor = self.create_processor(group_name, iteration, group_conf, self.question_api_client, self.answer_api_client)
+                processor.schedule(scheduler)
+            scheduler.wait()
+        finally:
+            scheduler.shutdown()
+            self.question_api_client.close()
+            self.answer_api_client.close()
+            self.ollama_endpoints.stop_health_checks()
+            self.close_stores()
+        Utils.logger.info("All file groups have been processed successfully.")
+
+    def run_async(self):
+        asyncio.run(self._run_async())
+
+    async def _run_async(self):
+        expanded_groups = self.expand_file_groups()
+        self.output_store.remove_stale_temp_files()
+        total_groups = len(expanded_groups)
+        Utils.logger.info(
+            f"Starting async processing of {total_groups} file groups with at most {self.thread_count} requests in flight..."
+        )
+        # One semaphore for the whole run: this is the global in-flight request limit.
+        semaphore = asyncio.Semaphore(max(self.thread_count, 1))
+
+        openai_client = None
+        if self.uses_provider("openai"):
+            if AsyncOpenAI is None:
+                Utils.logger.error("Async OpenAI client cannot be initialized because the package is missing.")
+            else:
+                openai_client = AsyncOpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"), base_url=self.openai_base_url, max_retries=0
                 )
-                futures.append(executor.submit(processor.process))
-            for future in as_completed(futures):
-                future.result()
+
+        http_client = None
+        if self.uses_provider("ollama"):
+            if httpx is None:
+                Utils.logger.error("Async HTTP client cannot be initialized because httpx is missing.")
+            else:
+                http_client = AsyncAPIClient.create_http_client(self.http_config, max(self.thread_count, 1))
+
+        question_api_client = AsyncAPIClient(
+            provider=self.question_provider_config.get("provider", ""),
+            model=self.question_provider_config.get("model", ""),
+            semaphore=semaphore,
+            global_ollama_url=self.global_ollama_url,
+            openai_client=openai_client,
+            http_client=http_client,
+            stream=self.http_config["stream"],
+            idle_timeout=self.http_config["idle_timeout"],
+            controller=self.get_controller(self.question_provider_config),
+            endpoints=self.ollama_endpoints,
+            options=self.question_provider_config.get("options"),
+            keep_alive=self.question_provider_config.get("keep_alive"),
+            prompt_stats=self.prompt_stats,
+            phase=QUESTIONS,
+            metrics=self.metrics
+        )
+        answer_api_client = AsyncAPIClient(
+            provider=self.answer_provider_config.get("provider", ""),
+            model=self.answer_provider_config.get("model", ""),
+            semaphore=semaphore,
+            global_ollama_url=self.global_ollama_url,
+            openai_client=openai_client,
+            http_client=http_client,
+            stream=self.http_config["stream"],
+            idle_timeout=self.http_config["idle_timeout"],
+            controller=self.get_controller(self.answer_provider_config),
+            endpoints=self.ollama_endpoints,
+            options=self.answer_provider_config.get("options"),
+            keep_alive=self.answer_provider_config.get("keep_alive"),
+            prompt_stats=self.prompt_stats,
+            phase=ANSWERS,
+            metrics=self.metrics
+        )
+        self.apply_context_options(question_api_client)
+        self.apply_context_options(answer_api_client)
+        scheduler = AsyncWorkScheduler(self.thread_count)
+        scheduler.start()
+        self.start_health_checks()
+        self.start_metrics([question_api_client, answer_api_client], scheduler.queue.qsize)
+        try:
+            for group_name, (iteration, group_conf) in expanded_groups.items():
+                processor = self.create_processor(group_name, iteration, group_conf, question_api_client, answer_api_client)
+                processor.schedule_async(scheduler)
+            await scheduler.wait()
+        finally:
+            if http_client is not None:
+                await http_client.aclose()
+            if openai_client is not None:
+                await openai_client.close()
+            self.ollama_endpoints.stop_health_checks()
+            self.close_stores()
+        Utils.logger.info("All file groups have been processed successfully.")
+
+    def run_phase_requests(
+        self, phase: str, api_client: APIClient, prompts: List[Tuple[str, str]],
+        schemas: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Dict[str, Optional[str]]:
+        """
+        Runs (custom_id, prompt) pairs through the Batch API, or synchronously for
+        non-OpenAI providers. Prompts with an entry in schemas ask for JSON output.
+        """
+        schemas = schemas or {}
+        if not prompts:
+            return {}
+        if api_client.provider == "openai" and api_client.openai_client is not None:
+            batch_dir = self.output_base_path / "qa_generation_output" / "batches"
+            runner = OpenAIBatchRunner(api_client.openai_client, api_client.model, batch_dir, self.batch_config, self.metrics)
+            Utils.logger.info(f"Submitting {len(prompts)} {phase} requests to the batch API...")
+            return runner.run(phase, prompts, json_output=bool(schemas))
+
+        Utils.logger.warning(
+            f"Batch mode requires the openai provider; generating {len(prompts)} {phase} synchronously with '{api_client.provider}'."
+        )
+        results: Dict[str, Optional[str]] = {}
+
+        def call(custom_id: str, prompt: str):
+            results[custom_id] = api_client.call_api(prompt, schema=schemas.get(custom_id))
+
+        scheduler = WorkScheduler(self.thread_count)
+        try:
+            for custom_id, prompt in prompts:
+                scheduler.submit(QUESTION_PRIORITY, call, custom_id, prompt)
+            scheduler.wait()
+        finally:
+            scheduler.shutdown()
+        return results
+
+    def run_answer_batches(self, batched: Dict[Tuple[Any, int, str], List[Tuple[Dict[str, Any], str]]]) -> None:
+        """
+        Sends the batched answer prompts of every group as one phase, then asks again
+        for the answers missing from the responses, up to max_attempts phases.
+        """
+        attempt = 0
+        while batched:
+            attempt += 1
+            prompts, schemas, sent = [], {}, {}
+            for (processor, window, answer_instruction), pending in batched.items():
+                content = dict(processor.content_windows)[window]
+                for chunk in processor.answer_batcher.chunks(pending):
+                    custom_id = f"{chunk[0][0]['answer_name']}_batch{attempt}"
+                    prompts.append((custom_id, processor.batched_answer_prompt(chunk, answer_instruction, content)))
+                    schemas[custom_id] = AnswerBatcher.schema(len(chunk))
+                    sent[custom_id] = ((processor, window, answer_instruction), chunk)
+            results = self.run_phase_requests("answers", self.answer_api_client, prompts, schemas)
+            batched = {}
+            for custom_id, (key, chunk) in sent.items():
+                missing = key[0].store_answer_batch(chunk, results.get(custom_id), attempt)
+                if missing:
+                    batched.setdefault(key, []).extend(missing)
+
+    def run_batch(self):
+        """
+        Offline mode: all question prompts go out as one batch job, the results are
+        written to the questions dir, then all answer prompts go out as a second job.
+        """
+        expanded_groups = self.expand_file_groups()
+        self.output_store.remove_stale_temp_files()
+        Utils.logger.info(f"Starting batch processing of {len(expanded_groups)} file groups...")
+        processors = []
+        for group_name, (iteration, group_conf) in expanded_groups.items():
+            processor = self.create_processor(group_name, iteration, group_conf, self.question_api_client, self.answer_api_client)
+            if processor.prepare():
+                processors.append(processor)
+
+        self.start_health_checks()
+        self.start_metrics([self.question_api_client, self.answer_api_client])
+        try:
+            # --- Questions ---
+            # [processor, question request, question text, dedup list number], in schedule order
+            question_blocks = []
+            pending = {}
+            for processor in processors:
+                for q_seed_idx, instr_idx, seed_text, instruction, window, content in processor.build_question_tasks():
+                    request = processor.prepare_question(
+                        q_seed_idx, instr_idx, seed_text, instruction, content, processor.file_list, window
+                    )
+                    block = [processor, request, request["existing_text"], processor.add_question_list()]
+                    question_blocks.append(block)
+                    if request["existing_text"] is None:
+                        processor.mark(QUESTIONS, request["questions_name"], IN_FLIGHT)
+                        pending[request["questions_name"]] = block
+            results = self.run_phase_requests(
+                "questions", self.question_api_client,
+                [(custom_id, block[1]["final_prompt"]) for custom_id, block in pending.items()]
+            )
+            for custom_id, block in pending.items():
+                block[2] = block[0].store_questions(block[1], results.get(custom_id))
+
+            # --- Answers ---
+            pending = {}
+            batched = {}  # (processor, window, answer instruction) -> [(request, question)]
+
+            def queue_answers(processor, question_request, q_num, q_text):
+                for answer_instruction in processor.all_answer_instructions:
+                    request = processor.prepare_answer(
+                        question_request["q_seed_idx"], question_request["instr_idx"], q_num, q_text,
+                        answer_instruction, question_request["content"], question_request["window"]
+                    )
+                    if request is None:
+                        continue
+                    if processor.answer_batcher is not None:
+                        key = (processor, question_request["window"], answer_instruction)
+                        batched.setdefault(key, []).append((request, q_text))
+                        continue
+                    processor.mark(ANSWERS, request["answer_name"], IN_FLIGHT)
+                    pending[request["answer_name"]] = (processor, request)
+
+            # Lists are settled in schedule order, so deduplication keeps the same questions as the other modes.
+            for processor, question_request, question_text, list_number in question_blocks:
+                for q_num, q_text in enumerate(TextParser.parse_questions(question_text or ""), start=1):
+                    processor.offer_question(
+                        list_number, question_request["q_seed_idx"], question_request["instr_idx"], q_num, q_text,
+                        functools.partial(queue_answers, processor, question_request, q_num, q_text)
+                    )
+                processor.settle_question_list(list_number, bool(question_text), lambda: None)
+
+            results = self.run_phase_requests(
+                "answers", self.answer_api_client,
+                [(custom_id, request["final_prompt"]) for custom_id, (_, request) in pending.items()]
+            )
+            for custom_id, (processor, request) in pending.items():
+                processor.store_answer(request, results.get(custom_id))
+            self.run_answer_batches(batched)
+        finally:
+            self.question_api_client.close()
+            self.answer_api_client.close()
+            self.ollama_endpoints.stop_health_checks()
+            self.close_stores()
         Utils.logger.info("All file groups have been processed successfully.")
+
+    def plan(self, questions_per_list: float) -> Dict[str, float]:
+        """
+        Expands file_groups x iterations x seeds x instructions and logs how many
+        requests the run would send and roughly how many prompt tokens they hold,
+        without calling any API. Up-to-date outputs are not counted.
+        """
+        chunking_config = dict(self.chunking_config or {})
+        chunking_config["enabled"] = True
+        budget = self.context_budget or ContextBudget.from_config(chunking_config)
+        totals: Dict[str, float] = {}
+        try:
+            for group_name, (iteration, group_conf) in self.expand_file_groups().items():
+                processor = self.create_processor(group_name, iteration, group_conf, self.question_api_client, self.answer_api_client)
+                if not processor.prepare():
+                    continue
+                counts = processor.plan(budget, questions_per_list)
+                for key, value in counts.items():
+                    totals[key] = totals.get(key, 0) + value
+                Utils.logger.info(
+                    f"[Plan] {group_name}: {counts['question_calls']}/{counts['questions']} question requests, "
+                    f"{counts['answer_calls']:.0f} answer requests for {counts['answers_needed']:.0f}/{counts['answers']:.0f} answers to send."
+                )
+        finally:
+            self.question_api_client.close()
+            self.answer_api_client.close()
+            if self.response_cache is not None:
+                self.response_cache.close()
+            self.output_store.close()
+            if self.ledger is not None:
+                self.ledger.close()
+        if not totals:
+            Utils.logger.info("[Plan] No file groups to process.")
+            return totals
+
+        Utils.logger.info(
+            f"[Plan] Questions: {totals['question_calls']} of {totals['questions']} requests to send, "
+            f"~{totals['question_tokens']:,.0f} prompt tokens."
+        )
+        Utils.logger.info(
+            f"[Plan] Answers: ~{totals['answers_needed']:,.0f} of ~{totals['answers']:,.0f} to generate "
+            f"in ~{totals['answer_calls']:,.0f} requests, "
+            f"~{totals['answer_tokens']:,.0f} prompt tokens."
+        )
+        Utils.logger.info(
+            f"[Plan] Total: ~{totals['question_calls'] + totals['answer_calls']:,.0f} requests, "
+            f"~{totals['question_tokens'] + totals['answer_tokens']:,.0f} prompt tokens (counted with {budget.name})."
+        )
+        pending_lists = totals["questions"] - totals["stored_lists"]
+        if pending_lists:
+            observed = (
+                f"; stored lists average {totals['stored_questions'] / totals['stored_lists']:.1f}"
+                if totals["stored_lists"] else ""
+            )
+            Utils.logger.info(
+                f"[Plan] Answers for the {pending_lists} question lists not generated yet assume "
+                f"{questions_per_list:g} questions per list{observed}. Near-duplicate questions are not excluded."
+            )
+        return totals
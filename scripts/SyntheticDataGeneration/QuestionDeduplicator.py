@@ -0,0 +1,171 @@
+import random
+import re
+import threading
+import zlib
+from collections import defaultdict
+from typing import Optional, List, Dict, Any, Set, Tuple, Callable
+
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_DEDUP_CONFIG = {
+    "enabled": False,
+    "threshold": 0.8,   # Jaccard similarity of word shingles at which a question counts as a duplicate.
+    "shingle_size": 3,
+    "num_perm": 64,
+    "bands": 16,
+}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+class QuestionDeduplicator:
+    """
+    Finds near-duplicate questions across every group of a run. Each question is
+    normalized (lowercase, punctuation stripped), split into word shingles and
+    MinHashed; LSH banding narrows the comparison to likely matches, which are
+    then confirmed with the exact Jaccard similarity of their shingle sets.
+
+    Question lists are numbered in the order they are scheduled, and a question
+    is kept unless it nearly duplicates an earlier question of its own list or a
+    kept question of a stored list numbered before it. The outcome therefore does
+    not depend on the order requests finish in, and a resumed run keeps the same
+    questions as the run before it. A list's questions join the run-wide index
+    only once the list is stored, so a list whose stream failed suppresses
+    nothing; the questions of a list are decided once every list before it has
+    been settled, and wait until then.
+    """
+    def __init__(self, threshold: float, shingle_size: int, num_perm: int, bands: int):
+        self.threshold = threshold
+        self.shingle_size = max(shingle_size, 1)
+        self.bands = max(min(bands, num_perm), 1)
+        self.rows = max(num_perm // self.bands, 1)
+        # Fixed seed: the same question always gets the same signature.
+        rng = random.Random(1)
+        self.permutations = [
+            (rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(self.bands * self.rows)
+        ]
+        self.lock = threading.Lock()
+        self.buckets: List[Dict[Tuple[int, ...], List[int]]] = [defaultdict(list) for _ in range(self.bands)]
+        self.questions: List[Tuple[str, Set[str]]] = []
+        # Lists that are not settled and registered yet, by number; "current" is the lowest of them.
+        self.lists: Dict[int, Dict[str, Any]] = {}
+        self.next_list = 0
+        self.current = 0
+        self.checked = 0
+        self.duplicates = 0
+        self.skipped_calls = 0
+
+    @staticmethod
+    def resolve_config(dedup_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_DEDUP_CONFIG)
+        resolved.update(dedup_config or {})
+        return resolved
+
+    @staticmethod
+    def from_config(dedup_config: Optional[Dict[str, Any]]) -> Optional["QuestionDeduplicator"]:
+        config = QuestionDeduplicator.resolve_config(dedup_config)
+        if not config["enabled"]:
+            return None
+        return QuestionDeduplicator(config["threshold"], config["shingle_size"], config["num_perm"], config["bands"])
+
+    def shingles(self, text: str) -> Set[str]:
+        words = re.sub(r"[^\w\s]", " ", text.lower()).split()
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, shingles: Set[str]) -> List[int]:
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+        return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes) for a, b in self.permutations]
+
+    @staticmethod
+    def jaccard(a: Set[str], b: Set[str]) -> float:
+        return len(a & b) / len(a | b) if a or b else 1.0
+
+    def add_list(self) -> int:
+        """Numbers a question list; lists must be added in the same order on every run."""
+        with self.lock:
+            number = self.next_list
+            self.next_list += 1
+            self.lists[number] = {"pending": [], "kept": [], "stored": None, "on_settled": None}
+            return number
+
+    def offer(
+        self, list_number: int, question: str, on_kept: Callable[[], None], on_duplicate: Callable[[str], None]
+    ) -> None:
+        """
+        Decides whether a question of the list is kept, calling on_kept() or
+        on_duplicate(earlier question). Questions must be offered in list order.
+        The callbacks run later, from the thread that settles the last earlier
+        list, when that list is still open.
+        """
+        shingles = self.shingles(question)
+        signature = self.signature(shingles)
+        band_keys = [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+        entry = (question, shingles, band_keys, on_kept, on_duplicate)
+        with self.lock:
+            state = self.lists[list_number]
+            if list_number != self.current:
+                state["pending"].append(entry)
+                return
+            action = self.decide(state, entry)
+        action()
+
+    def settle(self, list_number: int, stored: bool, on_settled: Callable[[], None]) -> None:
+        """
+        Marks a list as finished. A stored list's kept questions join the index;
+        a list that was not stored drops its waiting questions. on_settled() runs
+        once every question of the list has been decided.
+        """
+        with self.lock:
+            state = self.lists[list_number]
+            state["stored"] = stored
+            state["on_settled"] = on_settled
+            actions = []
+            while self.current in self.lists and self.lists[self.current]["stored"] is not None:
+                state = self.lists.pop(self.current)
+                if state["stored"]:
+                    for question, shingles, band_keys in state["kept"]:
+                        self.register(question, shingles, band_keys)
+                actions.append(state["on_settled"])
+                self.current += 1
+                following = self.lists.get(self.current)
+                if following is not None:
+                    if following["stored"] is not False:
+                        actions.extend(self.decide(following, entry) for entry in following["pending"])
+                    following["pending"] = []
+        for action in actions:
+            action()
+
+    def decide(self, state: Dict[str, Any], entry: Tuple) -> Callable[[], None]:
+        """Called with the lock held; returns the callback to run once it is released."""
+        question, shingles, band_keys, on_kept, on_duplicate = entry
+        self.checked += 1
+        candidates = set()
+        for band, key in enumerate(band_keys):
+            candidates.update(self.buckets[band].get(key, ()))
+        earlier_questions = [self.questions[index] for index in sorted(candidates)]
+        earlier_questions.extend((kept[0], kept[1]) for kept in state["kept"])
+        for earlier, earlier_shingles in earlier_questions:
+            if self.jaccard(shingles, earlier_shingles) >= self.threshold:
+                self.duplicates += 1
+                return lambda: on_duplicate(earlier)
+        state["kept"].append((question, shingles, band_keys))
+        return on_kept
+
+    def register(self, question: str, shingles: Set[str], band_keys: List[Tuple[int, ...]]) -> None:
+        index = len(self.questions)
+        self.questions.append((question, shingles))
+        for band, key in enumerate(band_keys):
+            self.buckets[band][key].append(index)
+
+    def record_skipped_calls(self, count: int) -> None:
+        with self.lock:
+            self.skipped_calls += count
+
+    def log_stats(self) -> None:
+        Utils.logger.info(
+            f"Question dedup: {self.duplicates} of {self.checked} questions were near-duplicates; "
+            f"skipped {self.skipped_calls} answer calls."
+        )
@@ -0,0 +1,247 @@
+import random
+import threading
+import time
+from typing import Optional, Dict, Any
+
+from SyntheticDataGeneration.Utils import Utils
+
+# Error classes used to decide how a failed request affects the provider.
+FATAL = "fatal"              # Bad request, auth, unknown model: retrying cannot help.
+THROTTLED = "throttled"      # 429: the provider asked us to slow down.
+OVERLOADED = "overloaded"    # 5xx, 408 and read timeouts: the endpoint is saturated.
+UNAVAILABLE = "unavailable"  # Connection refused or connect timeout: the endpoint is down.
+RETRYABLE = "retryable"      # Anything else.
+
+DEFAULT_RATE_CONTROL_CONFIG = {
+    "enabled": True,
+    "initial_concurrency": None,  # None starts at the maximum (--threads).
+    "min_concurrency": 1,
+    "requests_per_second": 0,  # 0 disables the token bucket.
+    "burst": 10,
+    "latency_target": 0,       # Seconds; 0 disables latency-driven decreases.
+    "failure_threshold": 5,
+    "reset_timeout": 30,
+    "max_retries": 5,
+    "backoff_factor": 1,
+}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now: float) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on requests in flight. Until the first congestion signal the limit
+    grows by one per success (slow start); after that it grows by one per full
+    window of successes and halves on congestion, at most once per round trip.
+    """
+    def __init__(self, initial: Optional[int], min_limit: int, max_limit: int):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        if initial is None:
+            initial = self.max_limit
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self.slow_start = True
+        self.last_decrease = 0.0
+
+    def try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def release(self, started_at: float, congested: bool) -> None:
+        self.in_flight -= 1
+        if congested:
+            # Requests started before the last decrease saw the old limit; ignore them.
+            if started_at >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = time.monotonic()
+                self.slow_start = False
+        elif self.slow_start:
+            self.limit = min(self.max_limit, self.limit + 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and blocks every worker
+    until reset_timeout has passed. A single probe is then let through: success
+    closes the breaker, failure re-opens it with a doubled timeout.
+    """
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+
+    def wait_time(self, now: float) -> float:
+        if self.opened_at is None:
+            return 0.0
+        remaining = self.opened_at + self.reset_timeout - now
+        if remaining > 0:
+            return remaining
+        if self.probe_in_flight:
+            return min(self.reset_timeout, 1.0)
+        return 0.0
+
+    def on_admit(self) -> None:
+        # Past the reset timeout the next admitted request is the half-open probe.
+        if self.opened_at is not None:
+            self.probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            Utils.logger.info("Circuit breaker closed; endpoint is responding again.")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self, now: float) -> None:
+        self.failures += 1
+        if self.opened_at is not None and self.probe_in_flight:
+            self.reset_timeout = min(self.reset_timeout * 2, self.base_reset_timeout * 8)
+            self.opened_at = now
+            self.probe_in_flight = False
+            Utils.logger.warning(f"Circuit breaker probe failed; pausing requests for {self.reset_timeout:.0f}s.")
+        elif self.opened_at is None and self.failures >= self.failure_threshold:
+            self.opened_at = now
+            Utils.logger.warning(
+                f"Circuit breaker opened after {self.failures} consecutive failures; "
+                f"pausing requests for {self.reset_timeout:.0f}s."
+            )
+
+class ProviderController:
+    """
+    Admission control shared by every client that talks to one provider endpoint:
+    circuit breaker, provider-wide pause on 429, token bucket and AIMD concurrency.
+    """
+    def __init__(self, name: str, config: Dict[str, Any], max_concurrency: int):
+        self.name = name
+        self.enabled = config["enabled"]
+        self.max_retries = config["max_retries"]
+        self.backoff_factor = config["backoff_factor"]
+        self.latency_target = config["latency_target"]
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.bucket = TokenBucket(config["requests_per_second"], config["burst"])
+        self.limiter = AdaptiveConcurrencyLimiter(config["initial_concurrency"], config["min_concurrency"], max_concurrency)
+        self.breaker = CircuitBreaker(config["failure_threshold"], config["reset_timeout"])
+
+    @staticmethod
+    def resolve_config(rate_control_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_RATE_CONTROL_CONFIG)
+        resolved.update(rate_control_config or {})
+        return resolved
+
+    @staticmethod
+    def classify_error(error: BaseException) -> str:
+        status = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None)
+        if status == 429:
+            return THROTTLED
+        if status == 408 or (status is not None and status >= 500):
+            return OVERLOADED
+        if status is not None and 400 <= status < 500:
+            return FATAL
+        # requests, httpx and openai use different exception classes; match on names.
+        names = {cls.__name__ for cls in type(error).__mro__}
+        if "ConnectTimeout" in names:
+            return UNAVAILABLE
+        if any("Timeout" in name for name in names):
+            return OVERLOADED
+        if names & {"ConnectError", "ConnectionError", "APIConnectionError"}:
+            return UNAVAILABLE
+        return RETRYABLE
+
+    @staticmethod
+    def retry_after(error: BaseException) -> Optional[float]:
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    def try_acquire(self) -> float:
+        """Admits one request and returns 0, or returns how long to wait before asking again."""
+        if not self.enabled:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            wait = self.breaker.wait_time(now)
+            if wait > 0:
+                return wait
+            if not self.limiter.try_acquire():
+                return 0.05
+            wait = self.bucket.try_acquire(now)
+            if wait > 0:
+                self.limiter.in_flight -= 1
+                return wait
+            self.breaker.on_admit()
+            return 0.0
+
+    def release(self, started_at: float, error: Optional[BaseException] = None) -> str:
+        """Records the outcome of an admitted request and returns its error class ("" on success)."""
+        kind = self.classify_error(error) if error is not None else ""
+        if not self.enabled:
+            return kind
+        with self.lock:
+            now = time.monotonic()
+            latency = now - started_at
+            slow = bool(self.latency_target) and latency > self.latency_target
+            congested = kind in (THROTTLED, OVERLOADED, UNAVAILABLE) or slow
+            self.limiter.release(started_at, congested)
+            # Overload is handled by the limiter; only an unreachable endpoint trips the breaker.
+            if kind == UNAVAILABLE:
+                self.breaker.record_failure(now)
+            else:
+                self.breaker.record_success()
+            if kind == THROTTLED:
+                pause = self.retry_after(error) or self.backoff_factor
+                # Pause every worker, not just this one, so retries do not arrive in sync.
+                self.paused_until = max(self.paused_until, now + pause)
+        return kind
+
+    def backoff_time(self, attempt: int) -> float:
+        # Full jitter keeps workers that failed together from retrying together.
+        return random.uniform(0, self.backoff_factor * (2 ** attempt))
+
+class ProviderControllerRegistry:
+    """Hands out one ProviderController per provider endpoint for the whole run."""
+    def __init__(self, config: Optional[Dict[str, Any]], max_concurrency: int):
+        self.config = ProviderController.resolve_config(config)
+        self.max_concurrency = max_concurrency
+        self.controllers: Dict[str, ProviderController] = {}
+        self.lock = threading.Lock()
+
+    def get(self, provider: str, endpoint: Optional[str] = None) -> ProviderController:
+        name = f"{provider}:{endpoint}" if provider == "ollama" else provider
+        with self.lock:
+            if name not in self.controllers:
+                self.controllers[name] = ProviderController(name, self.config, self.max_concurrency)
+            return self.controllers[name]
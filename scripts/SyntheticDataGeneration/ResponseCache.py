@@ -0,0 +1,123 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_CACHE_CONFIG = {
+    "enabled": True,
+    "path": "qa_generation_output/response_cache.sqlite",
+    "max_size_mb": 1024,
+    "share_across_iterations": False,
+}
+
+class ResponseCache:
+    """
+    Content-addressed store of model responses in a single SQLite file. Keys are
+    the sha256 of (provider, model, options, prompt[, sample]), so any change to a
+    prompt or its generation settings is a miss. Least recently used entries are
+    evicted once the stored responses exceed max_size_mb.
+    """
+    def __init__(self, path: Path, max_size_mb: float):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.connection.commit()
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def resolve_config(cache_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_CACHE_CONFIG)
+        resolved.update(cache_config or {})
+        return resolved
+
+    @staticmethod
+    def make_key(identity: Dict[str, Any], prompt: str, sample: Optional[str] = None) -> str:
+        key_material = json.dumps(
+            {"identity": identity, "prompt_hash": Utils.get_hash(prompt), "sample": sample},
+            sort_keys=True
+        )
+        return Utils.get_hash(key_material)
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def peek(self, key: str) -> Optional[str]:
+        """Like get, but leaves the hit counters and the eviction order alone."""
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str) -> None:
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            self.total_size += size - (previous[0] if previous else 0)
+            if self.total_size > self.max_size:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self) -> None:
+        # Evict down to 90% of the budget so eviction does not run on every put.
+        target = int(self.max_size * 0.9)
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        for key, size in rows:
+            if self.total_size <= target:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_size -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_mb": self.total_size / (1024 * 1024),
+            }
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        Utils.logger.info(
+            f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.1%} hit rate), {stats['evictions']} evictions, "
+            f"{stats['entries']} entries, {stats['size_mb']:.1f} MB"
+        )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -1,26 +1,57 @@
-import os
 import re
-import yaml
-import argparse
-import requests
-import hashlib
-import logging
-import random
-import time
-from pathlib import Path
-from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List, Iterable, Iterator
 
 class TextParser:
+    @staticmethod
+    def parse_question_line(line: str) -> Optional[str]:
+        stripped = line.strip()
+        if not stripped:
+            return None
+        cleaned = re.sub(r'^[\d\.\-\+\*]+\s*', '', stripped)
+        cleaned = re.sub(r'\*+', '', cleaned).strip()
+        if '?' in cleaned:
+            return cleaned
+        return None
+
     @staticmethod
     def parse_questions(question_text: str) -> List[str]:
         questions = []
         for line in question_text.splitlines():
-            stripped = line.strip()
-            if not stripped:
-                continue
-            cleaned = re.sub(r'^[\d\.\-\+\*]+\s*', '', stripped)
-            cleaned = re.sub(r'\*+', '', cleaned).strip()
-            if '?' in cleaned:
-                questions.append(cleaned)
-        return questions
\ No newline at end of file
+            question = TextParser.parse_question_line(line)
+            if question:
+                questions.append(question)
+        return questions
+
+    @staticmethod
+    def parse_questions_incremental(fragments: Iterable[str]) -> Iterator[str]:
+        """
+        Incremental version of parse_questions for streamed responses. Each question
+        is yielded as soon as its line is complete; the concatenated fragments yield
+        exactly the same questions, in the same order, as parse_questions.
+        """
+        parser = QuestionStreamParser()
+        for fragment in fragments:
+            yield from parser.feed(fragment)
+        yield from parser.finish()
+
+class QuestionStreamParser:
+    """Push-style parser behind TextParser.parse_questions_incremental, usable from async code."""
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, fragment: str) -> List[str]:
+        self.pending += fragment
+        lines = self.pending.splitlines(keepends=True)
+        # The last line is still being written unless it ends with a line break.
+        self.pending = lines.pop() if lines and lines[-1].splitlines() == [lines[-1]] else ""
+        questions = []
+        for line in lines:
+            question = TextParser.parse_question_line(line)
+            if question:
+                questions.append(question)
+        return questions
+
+    def finish(self) -> List[str]:
+        question = TextParser.parse_question_line(self.pending)
+        self.pending = ""
+        return [question] if question else []
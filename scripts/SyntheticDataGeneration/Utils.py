@@ -1,15 +1,6 @@
-import os
-import re
-import yaml
-import argparse
-import requests
 import hashlib
 import logging
-import random
-import time
-from pathlib import Path
 from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Utility Class ---
 class Utils:
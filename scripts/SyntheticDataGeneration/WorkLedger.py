@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple
+
+from SyntheticDataGeneration.Utils import Utils
+
+DEFAULT_LEDGER_CONFIG = {
+    "enabled": True,
+    "path": "qa_generation_output/ledger.jsonl",  # Relative to output_base_path
+}
+
+PLANNED = "planned"      # Queued; no API call made yet.
+IN_FLIGHT = "in_flight"  # The API call was started.
+DONE = "done"            # The output was written, or an up-to-date output was reused.
+FAILED = "failed"        # The API call returned nothing.
+
+# The ledger is rewritten with one line per output once it holds this many times more lines.
+COMPACT_RATIO = 4
+COMPACT_MIN_LINES = 10000
+
+class WorkLedger:
+    """
+    Append-only JSONL record of the state of every question list and answer
+    request. Each state change is one line, written in a single call and flushed,
+    so a crash can at most cut the last line short; it is skipped on load. The
+    states loaded at startup describe the previous runs: an output whose last
+    request was in flight or failed is not trusted on resume, since it was being
+    replaced when the run stopped.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.previous, lines = WorkLedger.load(path)
+        self.current: Dict[Tuple[str, str], str] = {}
+        interrupted = sum(1 for state in self.previous.values() if state in (IN_FLIGHT, FAILED))
+        if interrupted:
+            Utils.logger.info(
+                f"Work ledger: {interrupted} requests were in flight or failed when the last run stopped; "
+                f"their outputs will be regenerated."
+            )
+        if lines >= COMPACT_MIN_LINES and lines > COMPACT_RATIO * len(self.previous):
+            self.compact()
+
+    @staticmethod
+    def resolve_config(ledger_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = dict(DEFAULT_LEDGER_CONFIG)
+        resolved.update(ledger_config or {})
+        return resolved
+
+    @staticmethod
+    def from_config(ledger_config: Optional[Dict[str, Any]], output_base_path: Path) -> Optional["WorkLedger"]:
+        config = WorkLedger.resolve_config(ledger_config)
+        if not config["enabled"]:
+            return None
+        return WorkLedger(output_base_path / config["path"])
+
+    @staticmethod
+    def load(path: Path) -> Tuple[Dict[Tuple[str, str], str], int]:
+        """Replays the ledger; returns the last state of each output and the number of lines read."""
+        states = {}
+        lines = 0
+        if not path.exists():
+            return states, lines
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    states[(record["kind"], record["name"])] = record["state"]
+                except (ValueError, KeyError):
+                    continue  # A line cut short by a crash
+        return states, lines
+
+    @staticmethod
+    def ends_with_newline(path: Path) -> bool:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def compact(self) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for (kind, name), state in self.previous.items():
+                f.write(json.dumps({"kind": kind, "name": name, "state": state}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def state(self, kind: str, name: str) -> Optional[str]:
+        key = (kind, name)
+        with self.lock:
+            return self.current.get(key, self.previous.get(key))
+
+    def trusts(self, kind: str, name: str) -> bool:
+        """False if the previous run stopped while this output was being regenerated."""
+        return self.previous.get((kind, name)) not in (IN_FLIGHT, FAILED)
+
+    def mark(self, kind: str, name: str, state: str) -> None:
+        key = (kind, name)
+        line = json.dumps({"kind": kind, "name": name, "state": state, "time": round(time.time(), 3)}) + "\n"
+        with self.lock:
+            if self.current.get(key, self.previous.get(key)) == state:
+                return
+            self.current[key] = state
+            if self.file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+                if self.file.tell() > 0 and not WorkLedger.ends_with_newline(self.path):
+                    # Start after the line a crash cut short instead of continuing it.
+                    self.file.write("\n")
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,115 @@
+import asyncio
+import itertools
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from SyntheticDataGeneration.Utils import Utils
+
+ANSWER_PRIORITY = 0
+QUESTION_PRIORITY = 1
+_STOP_PRIORITY = float("inf")
+
+class PrefixOrder:
+    """Ranks prefix keys by first submission; tasks without a prefix share rank 0 and stay FIFO."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ranks: Dict[str, int] = {}
+
+    def rank(self, prefix: Optional[str]) -> int:
+        if prefix is None:
+            return 0
+        with self.lock:
+            return self.ranks.setdefault(prefix, len(self.ranks) + 1)
+
+class WorkScheduler:
+    """
+    A fixed pool of worker threads fed by one priority queue shared by every file
+    group of a run. Tasks may submit further tasks while running (a finished
+    question block fans out its answers). Answers are taken before questions, so
+    a new question block only starts once the answers already queued have been
+    picked up, and finished answers are written while later groups are still
+    generating questions. Every question task is queued up front; only the
+    answer tasks are submitted as the run goes.
+
+    Tasks submitted with a prefix key (answers whose prompts start with the same
+    file content) are taken in the order their prefix was first seen, so requests
+    sharing a prefix run together while it is still in the model's KV cache.
+    """
+    def __init__(self, worker_count: int):
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.prefix_order = PrefixOrder()
+        self.errors: List[BaseException] = []
+        self.errors_lock = threading.Lock()
+        self.workers = [
+            threading.Thread(target=self._worker, name=f"qa-worker-{i}", daemon=True)
+            for i in range(max(worker_count, 1))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, priority: int, fn: Callable[..., Any], *args: Any, prefix: Optional[str] = None) -> None:
+        self.queue.put((priority, self.prefix_order.rank(prefix), next(self.sequence), fn, args))
+
+    def _worker(self) -> None:
+        while True:
+            priority, _, _, fn, args = self.queue.get()
+            try:
+                if priority == _STOP_PRIORITY:
+                    return
+                fn(*args)
+            except Exception as e:
+                Utils.logger.error(f"Task {getattr(fn, '__name__', fn)} failed: {e}")
+                with self.errors_lock:
+                    self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def wait(self) -> None:
+        """Blocks until every submitted task, including tasks submitted by tasks, has finished."""
+        self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def shutdown(self) -> None:
+        for _ in self.workers:
+            self.queue.put((_STOP_PRIORITY, 0, next(self.sequence), None, ()))
+        for worker in self.workers:
+            worker.join()
+
+class AsyncWorkScheduler:
+    """Asyncio counterpart of WorkScheduler: worker coroutines draining one priority queue."""
+    def __init__(self, worker_count: int):
+        self.worker_count = max(worker_count, 1)
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.sequence = itertools.count()
+        self.prefix_order = PrefixOrder()
+        self.errors: List[BaseException] = []
+        self.workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def submit(self, priority: int, coro_fn: Callable[..., Any], *args: Any, prefix: Optional[str] = None) -> None:
+        self.queue.put_nowait((priority, self.prefix_order.rank(prefix), next(self.sequence), coro_fn, args))
+
+    async def _worker(self) -> None:
+        while True:
+            priority, _, _, coro_fn, args = await self.queue.get()
+            try:
+                await coro_fn(*args)
+            except Exception as e:
+                Utils.logger.error(f"Task {getattr(coro_fn, '__name__', coro_fn)} failed: {e}")
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    async def wait(self) -> None:
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        if self.errors:
+            raise self.errors[0]
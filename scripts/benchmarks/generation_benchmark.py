@@ -0,0 +1,295 @@
+"""
+End-to-end benchmark: runs QAGeneratorEngine against the stand-in LLM server for
+every combination of thread count, files per group and iterations, and records
+requests/sec, wall-clock time, peak memory and file-system operations to a JSON
+baseline. Pass --compare with an earlier baseline to see the change per case.
+
+    python benchmarks/generation_benchmark.py --threads 4,16 --files 1,4 --iterations 1,3 --delay 0.05
+    python benchmarks/generation_benchmark.py --output after.json --compare before.json
+
+Prompts, instructions and the file group settings come from --config; only the
+input files, iterations, endpoints and output location are replaced. Peak memory
+is the process's resident set size, sampled during each case; --trace_memory also
+records the peak of Python allocations (tracemalloc), which slows the pipeline
+down noticeably. File-system operations are counted with an audit hook and only
+include paths under the case's output directory.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from SyntheticDataGeneration.QAGenerator import QAGeneratorEngine  # noqa: E402
+from SyntheticDataGeneration.Utils import Utils  # noqa: E402
+from benchmarks.mock_ollama_server import add_server_arguments, server_from_arguments  # noqa: E402
+
+# Try importing psutil for the resident set size; /proc is used without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RSS_SAMPLE_INTERVAL = 0.05
+
+FS_EVENTS = {
+    "os.mkdir": "mkdir",
+    "os.rename": "rename",  # Also raised by os.replace
+    "os.remove": "remove",
+    "os.listdir": "listdir",
+    "os.scandir": "scandir",
+}
+
+
+class FileOpCounter:
+    """Counts opens, renames, removals and directory listings under one root, via sys.addaudithook."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root: Optional[str] = None
+        self.counts: Dict[str, int] = {}
+        sys.addaudithook(self.hook)
+
+    def start(self, root: Path) -> None:
+        with self.lock:
+            self.root = os.path.abspath(root)
+            self.counts = {}
+
+    def stop(self) -> Dict[str, int]:
+        with self.lock:
+            self.root = None
+            return dict(sorted(self.counts.items()))
+
+    def hook(self, event: str, args) -> None:
+        if self.root is None or (event != "open" and event not in FS_EVENTS) or not args:
+            return
+        path = args[0]
+        if not isinstance(path, (str, bytes, os.PathLike)):
+            return  # An already open file descriptor
+        if not os.path.abspath(os.fsdecode(path)).startswith(self.root):
+            return
+        if event == "open":
+            mode = args[1] if len(args) > 1 and isinstance(args[1], str) else "r"
+            name = "open_read" if mode.strip("bt") == "r" else "open_write"
+        else:
+            name = FS_EVENTS[event]
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class MemorySampler:
+    """Tracks the peak resident set size of this process while running."""
+    def __init__(self):
+        self.process = psutil.Process() if psutil is not None else None
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def rss(self) -> Optional[int]:
+        if self.process is not None:
+            return self.process.memory_info().rss
+        try:
+            with open("/proc/self/statm", "rb") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def start(self) -> None:
+        self.peak = self.rss() or 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, self.rss() or 0)
+
+    def stop(self) -> Optional[float]:
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss() or 0)
+        return round(self.peak / 2**20, 1) if self.peak else None
+
+
+def parse_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def write_inputs(input_dir: Path, groups: int, files_per_group: int, file_kb: int) -> Dict[str, List[str]]:
+    """Writes synthetic source files and returns the file list of each group."""
+    input_dir.mkdir(parents=True, exist_ok=True)
+    line = "value = compute(value) + 1  # placeholder line of source code\n"
+    body = line * max(file_kb * 1024 // len(line), 1)
+    group_files = {}
+    for g in range(groups):
+        names = []
+        for f in range(files_per_group):
+            name = f"group{g}_file{f}.py"
+            (input_dir / name).write_text(f"# {name}\n{body}", encoding="utf-8")
+            names.append(name)
+        group_files[f"Bench{g}"] = names
+    return group_files
+
+
+def build_config(base_config: Dict[str, Any], args: argparse.Namespace, server, group_files: Dict[str, List[str]],
+                 iterations: int) -> Dict[str, Any]:
+    config = dict(base_config)
+    global_config = dict(base_config.get("global", {}))
+    global_config.update({
+        "base_dir": "input",
+        "output_dir": "qa_generation_output",
+        "ollama_url": server.url,
+        "openai_base_url": server.openai_base_url,
+    })
+    global_config["health_check"] = {**global_config.get("health_check", {}), "enabled": False}
+    config["global"] = global_config
+    config["providers"] = {
+        phase: {"provider": args.provider, "model": "bench"} for phase in ("question", "answer")
+    }
+    template = next(iter(base_config["file_groups"].values()))
+    config["file_groups"] = {
+        name: {**template, "files": files, "iterations": iterations} for name, files in group_files.items()
+    }
+    return config
+
+
+def run_case(base_config: Dict[str, Any], args: argparse.Namespace, server, fs_counter: FileOpCounter,
+             engine_name: str, threads: int, files_per_group: int, iterations: int) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="qa_bench_") as tmp:
+        root = Path(tmp)
+        group_files = write_inputs(root / "input", args.groups, files_per_group, args.file_kb)
+        config = build_config(base_config, args, server, group_files, iterations)
+        before = server.stats()
+
+        memory = MemorySampler()
+        memory.start()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        fs_counter.start(root)
+        start = time.perf_counter()
+        engine = QAGeneratorEngine(config, root, threads)
+        if engine_name == "async":
+            engine.run_async()
+        else:
+            engine.run()
+        wall = time.perf_counter() - start
+        fs_ops = fs_counter.stop()
+        peak_rss_mb = memory.stop()
+        peak_traced_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 2) if tracemalloc.is_tracing() else None
+
+        after = server.stats()
+        served = {key: after[key] - before[key] for key in ("requests", "completed", "errors", "throttled")}
+        return {
+            "engine": engine_name,
+            "threads": threads,
+            "groups": args.groups,
+            "files_per_group": files_per_group,
+            "iterations": iterations,
+            **served,
+            "wall_seconds": round(wall, 3),
+            "requests_per_sec": round(served["completed"] / wall, 2) if wall > 0 else 0.0,
+            "peak_rss_mb": peak_rss_mb,
+            "peak_traced_mb": peak_traced_mb,
+            "fs_ops": fs_ops,
+            "fs_ops_total": sum(fs_ops.values()),
+            "server_peak_in_flight": after["peak_in_flight"],
+        }
+
+
+def case_key(case: Dict[str, Any]) -> tuple:
+    return tuple(case[k] for k in ("engine", "threads", "groups", "files_per_group", "iterations"))
+
+
+def print_case(case: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+    line = (
+        f"{case['engine']:<7} threads={case['threads']:<3} files={case['files_per_group']:<3} "
+        f"iterations={case['iterations']:<3} {case['completed']:>5} requests in {case['wall_seconds']:7.2f}s "
+        f"-> {case['requests_per_sec']:8.1f} req/s, {case['peak_rss_mb'] or 0:6.1f} MB peak RSS, "
+        f"{case['fs_ops_total']} fs ops"
+    )
+    if case["errors"] or case["throttled"]:
+        line += f" ({case['errors']} errors, {case['throttled']} throttled)"
+    if previous and previous.get("requests_per_sec"):
+        change = case["requests_per_sec"] / previous["requests_per_sec"] - 1
+        line += f" [{change:+.1%} req/s vs baseline]"
+    print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark QAGeneratorEngine against a stand-in LLM server.")
+    parser.add_argument("--config", default=str(Path(__file__).resolve().parent.parent / "generate_qa_config.yaml"),
+                        help="Config that prompts, instructions and the file group template are taken from")
+    parser.add_argument("--engines", default="threads", help="Comma-separated engines: threads, async")
+    parser.add_argument("--threads", default="4,16", help="Comma-separated thread counts")
+    parser.add_argument("--files", default="1,4", help="Comma-separated files per group")
+    parser.add_argument("--iterations", default="1,3", help="Comma-separated iteration counts")
+    parser.add_argument("--groups", type=int, default=4, help="File groups per run")
+    parser.add_argument("--file_kb", type=int, default=4, help="Size of each input file")
+    parser.add_argument("--provider", choices=["ollama", "openai"], default="ollama")
+    parser.add_argument("--output", default="generation_benchmark.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results to compare requests/sec against")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Also record peak Python allocations with tracemalloc (slows the run down)")
+    parser.add_argument("--log_level", default="CRITICAL", help="Pipeline log level; simulated failures log errors")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    # Per-request log lines would dominate the measurement.
+    Utils.logger.setLevel(args.log_level.upper())
+    logging.getLogger().setLevel(args.log_level.upper())
+    if args.provider == "openai":
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+    base_config = yaml.safe_load(Path(args.config).read_text(encoding="utf-8"))
+    previous = {}
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        previous = {case_key(case): case for case in baseline.get("cases", [])}
+
+    server = server_from_arguments(args).start()
+    fs_counter = FileOpCounter()
+    if args.trace_memory:
+        tracemalloc.start()
+    cases = []
+    try:
+        for engine_name, threads, files_per_group, iterations in itertools.product(
+            [e.strip() for e in args.engines.split(",") if e.strip()],
+            parse_list(args.threads), parse_list(args.files), parse_list(args.iterations)
+        ):
+            case = run_case(base_config, args, server, fs_counter, engine_name, threads, files_per_group, iterations)
+            print_case(case, previous.get(case_key(case)))
+            cases.append(case)
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+        server.stop()
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "provider": args.provider,
+        "file_kb": args.file_kb,
+        "server": server.settings(),
+        "cases": cases,
+    }
+    Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
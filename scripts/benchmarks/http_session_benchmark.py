@@ -0,0 +1,64 @@
+"""
+Micro-benchmark: bare requests.post (one TCP connection per call) against the
+pooled session used by APIClient, both hitting a local stand-in Ollama server.
+
+    python benchmarks/http_session_benchmark.py --requests 2000 --threads 8
+"""
+
+import argparse
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from SyntheticDataGeneration.ApiClient import APIClient  # noqa: E402
+from SyntheticDataGeneration.Utils import Utils  # noqa: E402
+from benchmarks.mock_ollama_server import MockOllamaServer  # noqa: E402
+
+
+def run(label: str, call, total: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda _: call(), range(total)))
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if not r)
+    rate = total / elapsed
+    print(f"{label:<22} {total} requests in {elapsed:6.2f}s -> {rate:8.1f} req/s ({failures} failed)")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare bare requests.post with APIClient's pooled session.")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per variant")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent callers")
+    parser.add_argument("--delay", type=float, default=0.0, help="Simulated server latency in seconds")
+    args = parser.parse_args()
+
+    # Per-request log lines would dominate the measurement.
+    Utils.logger.setLevel(logging.WARNING)
+
+    server = MockOllamaServer(delay=args.delay).start()
+    payload = {"model": "bench", "prompt": "ping", "stream": False, "options": {}}
+    try:
+        def bare_call():
+            response = requests.post(server.url, json=payload, timeout=60)
+            response.raise_for_status()
+            return response.json().get("response")
+
+        client = APIClient("ollama", "bench", global_ollama_url=server.url, http_config={"pool_size": args.threads})
+
+        before = run("requests.post", bare_call, args.requests, args.threads)
+        after = run("APIClient (pooled)", lambda: client.call_api("ping"), args.requests, args.threads)
+        client.close()
+        print(f"Speed-up: {after / before:.2f}x")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+A local stand-in LLM server, used by the benchmarks. It speaks both APIs the
+pipeline uses:
+
+    POST /api/generate          Ollama, streamed (NDJSON) or not
+    POST /v1/chat/completions   OpenAI-compatible, streamed (SSE) or not
+    GET  /                      Ollama's "is running" check, used by the health checker
+    GET  /stats                 request counters since the server started
+
+Question prompts get a short numbered list, every other prompt a single line
+(see mock_completion), or a JSON object of answers when the request asks for
+JSON output. Each response waits for a latency drawn from a fixed,
+uniform or lognormal distribution, plus the completion's tokens at
+tokens_per_sec. A share of requests can fail with 500 or be throttled with 429
+and Retry-After, and requests over max_concurrency are throttled as well. It
+speaks HTTP/1.1 so that clients can reuse connections.
+
+    python benchmarks/mock_ollama_server.py --port 11434 --delay 0.2 --tokens_per_sec 50 --rate_limit_rate 0.05
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Tuple, Dict, Any
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+def mock_completion(prompt: str, json_output: bool = False) -> str:
+    """
+    A numbered question list for question prompts, a one-line answer for everything
+    else, or with json_output one answer per question of a batched answer prompt.
+    """
+    if json_output:
+        match = re.search(r"following (\d+) questions", prompt)
+        count = int(match.group(1)) if match else 1
+        return json.dumps({str(i): f"This is generated answer {i}." for i in range(1, count + 1)})
+    if "output format" in prompt:
+        # Questions differ per prompt so that caching and deduplication behave as with a real model.
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        return "\n".join(f"{i}. What does part {i} of {digest} do?" for i in range(1, 4))
+    return "This is a generated answer."
+
+
+def count_tokens(text: str) -> int:
+    """Word counts stand in for token counts."""
+    return len(text.split())
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Like Ollama's Go server: without this, keep-alive connections stall on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers: Dict[str, str] = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_chunked(self, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.stats())
+        else:
+            data = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.startswith("/v1/chat/completions"):
+            messages = request.get("messages") or [{}]
+            prompt = messages[-1].get("content", "")
+            respond = self.respond_openai
+        elif self.path.startswith("/api/generate"):
+            prompt = request.get("prompt", "")
+            respond = self.respond_ollama
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        status = self.server.admit()
+        if status == 429:
+            self.send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                           {"Retry-After": f"{self.server.retry_after:g}"})
+            return
+        try:
+            time.sleep(self.server.sample_latency())
+            if status == 500:
+                self.send_json(500, {"error": {"message": "Simulated server error", "type": "server_error"}})
+                return
+            json_output = bool(request.get("format") or request.get("response_format"))
+            respond(request, prompt, mock_completion(prompt, json_output))
+        finally:
+            self.server.finish(status)
+
+    def respond_ollama(self, request: dict, prompt: str, text: str) -> None:
+        usage = {
+            "prompt_eval_count": count_tokens(prompt),
+            "eval_count": count_tokens(text),
+            "prompt_eval_duration": 1_000_000,
+            "eval_duration": int(self.server.generation_time(text) * 1e9),
+        }
+        if not request.get("stream"):
+            time.sleep(self.server.generation_time(text))
+            self.send_json(200, {"model": request.get("model", ""), "response": text, "done": True, **usage})
+            return
+        self.start_chunked("application/x-ndjson")
+        for piece in self.server.pieces(text):
+            self.write_chunk((json.dumps({"response": piece, "done": False}) + "\n").encode("utf-8"))
+        self.write_chunk((json.dumps({"response": "", "done": True, **usage}) + "\n").encode("utf-8"))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def respond_openai(self, request: dict, prompt: str, text: str) -> None:
+        model = request.get("model", "")
+        created = int(time.time())
+        usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not request.get("stream"):
+            time.sleep(self.server.generation_time(text))
+            self.send_json(200, {
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": usage,
+            })
+            return
+
+        def event(choices: list, extra: Dict[str, Any] = None) -> bytes:
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created,
+                     "model": model, "choices": choices, **(extra or {})}
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        self.start_chunked("text/event-stream")
+        for piece in self.server.pieces(text):
+            self.write_chunk(event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+        self.write_chunk(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.write_chunk(event([], {"usage": usage}))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        delay: float = 0.0,
+        distribution: str = "fixed",
+        jitter: float = 0.0,
+        tokens_per_sec: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        max_concurrency: int = 0,
+        retry_after: float = 1.0,
+        seed: int = None
+    ):
+        """
+        delay is the mean latency before the first token. jitter is the spread:
+        +/- jitter seconds for uniform, the sigma of the underlying normal for
+        lognormal. tokens_per_sec 0 returns the whole completion at once.
+        max_concurrency 0 admits any number of requests in flight.
+        """
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{distribution}'; use one of {LATENCY_DISTRIBUTIONS}")
+        super().__init__(address, MockOllamaHandler)
+        self.delay = delay
+        self.distribution = distribution
+        self.jitter = jitter
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "completed": 0, "errors": 0, "throttled": 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            "delay": self.delay, "distribution": self.distribution, "jitter": self.jitter,
+            "tokens_per_sec": self.tokens_per_sec, "error_rate": self.error_rate,
+            "rate_limit_rate": self.rate_limit_rate, "max_concurrency": self.max_concurrency,
+            "retry_after": self.retry_after,
+        }
+
+    def admit(self) -> int:
+        """Counts a new request and decides its outcome: 200, 500 or 429."""
+        with self.lock:
+            self.counters["requests"] += 1
+            roll = self.random.random()
+            if roll < self.rate_limit_rate or 0 < self.max_concurrency <= self.in_flight:
+                self.counters["throttled"] += 1
+                return 429
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return 500 if roll < self.rate_limit_rate + self.error_rate else 200
+
+    def finish(self, status: int) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            self.counters["completed" if status == 200 else "errors"] += 1
+
+    def sample_latency(self) -> float:
+        if self.delay <= 0:
+            return 0.0
+        with self.lock:
+            if self.distribution == "uniform":
+                return max(self.random.uniform(self.delay - self.jitter, self.delay + self.jitter), 0.0)
+            if self.distribution == "lognormal":
+                # Scaled so the mean stays at delay; a few requests take much longer than the rest.
+                return self.delay * self.random.lognormvariate(-self.jitter ** 2 / 2, self.jitter)
+        return self.delay
+
+    def generation_time(self, text: str) -> float:
+        return count_tokens(text) / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+    def pieces(self, text: str):
+        """Yields the completion a few words at a time, paced at tokens_per_sec."""
+        words = text.split(" ")
+        step = max(math.ceil(len(words) / 8), 1)
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+            time.sleep(self.generation_time(piece))
+            yield piece
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**self.counters, "in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    @property
+    def openai_base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOllamaServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--delay", type=float, default=0.0, help="Mean latency before the first token, in seconds")
+    parser.add_argument("--distribution", choices=LATENCY_DISTRIBUTIONS, default="fixed", help="Latency distribution")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Latency spread: +/- seconds for uniform, sigma for lognormal")
+    parser.add_argument("--tokens_per_sec", type=float, default=0.0, help="Generation speed; 0 = instant")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--max_concurrency", type=int, default=0, help="Requests in flight beyond this get 429; 0 = no limit")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency and failure draws")
+
+
+def server_from_arguments(args: argparse.Namespace, address: Tuple[str, int] = ("127.0.0.1", 0)) -> MockOllamaServer:
+    return MockOllamaServer(
+        address, delay=args.delay, distribution=args.distribution, jitter=args.jitter,
+        tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        max_concurrency=args.max_concurrency, retry_after=args.retry_after, seed=args.seed
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a stand-in Ollama / OpenAI-compatible server.")
+    parser.add_argument("--port", type=int, default=11434)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_arguments(args, ("127.0.0.1", args.port))
+    print(f"Stand-in LLM server listening on {server.url} (Ollama) and {server.openai_base_url} (OpenAI)")
+    server.serve_forever()
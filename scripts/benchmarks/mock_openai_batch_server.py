@@ -0,0 +1,184 @@
+"""
+A local stand-in for the parts of the OpenAI API used by --engine batch:
+
+    POST /v1/files                 upload the batch input JSONL
+    POST /v1/batches               create a batch
+    GET  /v1/batches/{id}          poll a batch
+    GET  /v1/files/{id}/content    download the batch output
+
+A batch reports "in_progress" for the first `polls_until_done` polls and is then
+completed with one canned response per request (see mock_completion). Point the
+engine at it with `global.openai_base_url: http://127.0.0.1:<port>/v1`.
+
+    python benchmarks/mock_openai_batch_server.py --port 8001
+"""
+
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.mock_ollama_server import mock_completion  # noqa: E402
+
+
+class MockBatchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, data: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status: int, body: dict) -> None:
+        self.send_body(status, json.dumps(body).encode("utf-8"))
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        if self.path == "/v1/files":
+            self.create_file()
+        elif self.path == "/v1/batches":
+            self.create_batch(json.loads(self.read_body()))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            self.retrieve_batch(parts[2])
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            content = self.server.files.get(parts[2])
+            if content is None:
+                self.send_json(404, {"error": {"message": "No such file"}})
+            else:
+                self.send_body(200, content, "application/octet-stream")
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def create_file(self):
+        # Multipart upload: reuse the email parser rather than pulling in a dependency.
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        message = BytesParser(policy=HTTP).parsebytes(header + self.read_body())
+        content = b""
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True)
+        file_id = self.server.store_file(content)
+        self.send_json(200, {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": "batch.jsonl", "purpose": "batch", "status": "processed",
+        })
+
+    def create_batch(self, request: dict):
+        batch_id = f"batch_{next(self.server.ids)}"
+        self.server.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+            "created_at": int(time.time()), "status": "validating", "polls": 0,
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.send_json(200, self.public(self.server.batches[batch_id]))
+
+    def retrieve_batch(self, batch_id: str):
+        batch = self.server.batches.get(batch_id)
+        if batch is None:
+            self.send_json(404, {"error": {"message": "No such batch"}})
+            return
+        batch["polls"] += 1
+        if batch["status"] != "completed":
+            if batch["polls"] > self.server.polls_until_done:
+                self.complete(batch)
+            else:
+                batch["status"] = "in_progress"
+        self.send_json(200, self.public(batch))
+
+    def complete(self, batch: dict) -> None:
+        lines = []
+        for line in self.server.files[batch["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            prompt = request["body"]["messages"][-1]["content"]
+            completion = mock_completion(prompt, "response_format" in request["body"])
+            # Word counts stand in for token counts.
+            usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(completion.split())}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            lines.append(json.dumps({
+                "id": f"response_{next(self.server.ids)}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}}],
+                        "usage": usage,
+                    },
+                },
+                "error": None,
+            }))
+        batch["output_file_id"] = self.server.store_file(("\n".join(lines) + "\n").encode("utf-8"))
+        batch["request_counts"] = {"total": len(lines), "completed": len(lines), "failed": 0}
+        batch["status"] = "completed"
+        self.server.requests_served += len(lines)
+
+    @staticmethod
+    def public(batch: dict) -> dict:
+        return {k: v for k, v in batch.items() if k != "polls"}
+
+
+class MockBatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), polls_until_done: int = 1):
+        super().__init__(address, MockBatchHandler)
+        self.polls_until_done = polls_until_done
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.batches = {}
+        self.requests_served = 0
+        self.files_lock = threading.Lock()
+
+    def store_file(self, content: bytes) -> str:
+        with self.files_lock:
+            file_id = f"file-{next(self.ids)}"
+            self.files[file_id] = content
+        return file_id
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockBatchServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a stand-in OpenAI batch server.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--polls_until_done", type=int, default=1, help="Polls that report in_progress before completing")
+    args = parser.parse_args()
+    server = MockBatchServer(("127.0.0.1", args.port), polls_until_done=args.polls_until_done)
+    print(f"Stand-in OpenAI batch server listening on {server.base_url}")
+    server.serve_forever()
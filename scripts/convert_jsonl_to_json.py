@@ -1,64 +1,184 @@
+import os
 import json
 import argparse
+from collections import Counter
+from multiprocessing import Pool
 
-def convert_jsonl(input_file, output_file):
-    conversations_list = []
-    
-    # Define a mapping from input roles to the desired output roles.
-    role_map = {
-        "system": "system",
-        "user": "human",
-        "assistant": "gpt"
-    }
-    
-    with open(input_file, "r", encoding="utf-8") as fin:
-        for line in fin:
+# Define a mapping from input roles to the desired output roles.
+ROLE_MAP = {
+    "system": "system",
+    "user": "human",
+    "assistant": "gpt"
+}
+
+# Reasons a row is dropped, in the order they are checked.
+DROP_RULES = {
+    "invalid_json": "line is not valid JSON",
+    "not_an_object": "line is not a JSON object",
+    "invalid_message": "a message is not an object",
+    "no_messages": "no user or assistant messages",
+    "odd_message_count": "user and assistant messages do not form complete pairs",
+    "not_alternating": "messages do not strictly alternate user, assistant",
+}
+
+# Decoding errors printed; the rest are only counted.
+MAX_PRINTED_ERRORS = 10
+
+def convert_conversation(data):
+    """
+    Converts one ShareGPT-style row. Returns (conversation, None) for a valid row,
+    or (None, rule) naming the DROP_RULES entry it failed.
+    """
+    if not isinstance(data, dict):
+        return None, "not_an_object"
+
+    # Extract messages and convert their roles
+    converted_messages = []
+    for message in data.get("messages", []):
+        if not isinstance(message, dict):
+            return None, "invalid_message"
+        role = message.get("role", "")
+        content = message.get("content", "")
+        new_role = ROLE_MAP.get(role, role)
+        converted_messages.append({"from": new_role, "value": content})
+
+    # Filter out only "human" and "gpt" messages for alternating check.
+    filtered_messages = [msg for msg in converted_messages if msg["from"] in {"human", "gpt"}]
+
+    # Validate that the conversation strictly alternates:
+    # - Must start with a "human" message.
+    # - Must have an even number of messages (to form complete pairs).
+    # - Every even-indexed message must be from "human" and every odd-indexed from "gpt".
+    if not filtered_messages:
+        return None, "no_messages"
+    if len(filtered_messages) % 2 != 0:
+        return None, "odd_message_count"
+    for i, msg in enumerate(filtered_messages):
+        expected = "human" if i % 2 == 0 else "gpt"
+        if msg["from"] != expected:
+            return None, "not_alternating"
+
+    # Note: This output includes only the alternating messages.
+    return {"conversations": filtered_messages}, None
+
+def convert_range(input_file, start, end, fout, output_format, indent):
+    """
+    Converts the lines that start in the byte range [start, end) of input_file and
+    writes them to fout as they are read. In "json" format the conversations are
+    separated by commas but not wrapped in brackets, so ranges can be joined.
+    Returns (conversations written, drop counts per rule, first decoding errors).
+    """
+    kept = 0
+    drops = Counter()
+    errors = []
+    with open(input_file, "rb") as fin:
+        if start > 0:
+            # The line running into this range belongs to the previous one.
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            offset = fin.tell()
+            line = fin.readline()
+            if not line:
+                break
             line = line.strip()
             if not line:
                 continue  # skip empty lines
             try:
                 # Load each line as a JSON object
                 data = json.loads(line)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON for line: {line}\nError: {e}")
+            except ValueError as e:
+                drops["invalid_json"] += 1
+                if len(errors) < MAX_PRINTED_ERRORS:
+                    errors.append(f"Error decoding JSON for the line at byte {offset}: {e}")
                 continue
-            
-            # Extract messages and convert their roles
-            messages = data.get("messages", [])
-            converted_messages = []
-            for message in messages:
-                role = message.get("role", "")
-                content = message.get("content", "")
-                new_role = role_map.get(role, role)
-                converted_messages.append({"from": new_role, "value": content})
-            
-            # Filter out only "human" and "gpt" messages for alternating check.
-            filtered_messages = [msg for msg in converted_messages if msg["from"] in {"human", "gpt"}]
-            
-            # Validate that the conversation strictly alternates:
-            # - Must start with a "human" message.
-            # - Must have an even number of messages (to form complete pairs).
-            # - Every even-indexed message must be from "human" and every odd-indexed from "gpt".
-            if not filtered_messages or len(filtered_messages) % 2 != 0:
-                continue  # Toss out conversation if it does not have complete alternating pairs.
-            
-            valid = True
-            for i, msg in enumerate(filtered_messages):
-                expected = "human" if i % 2 == 0 else "gpt"
-                if msg["from"] != expected:
-                    valid = False
-                    break
-            
-            if not valid:
-                # Skip this conversation if it doesn't strictly alternate
+
+            conversation, rule = convert_conversation(data)
+            if conversation is None:
+                drops[rule] += 1
                 continue
-            
-            # Append the validated conversation. Note: This output includes only the alternating messages.
-            conversations_list.append({"conversations": filtered_messages})
-    
-    # Write the list of valid conversations to the output JSON file.
+
+            if output_format == "jsonl":
+                fout.write(json.dumps(conversation, ensure_ascii=False) + "\n")
+            else:
+                if kept:
+                    fout.write(",\n")
+                fout.write(json.dumps(conversation, indent=indent, ensure_ascii=False))
+            kept += 1
+    return kept, drops, errors
+
+def convert_part(task):
+    """Pool worker: converts one byte range into its own part file."""
+    input_file, start, end, part_file, output_format, indent = task
+    with open(part_file, "w", encoding="utf-8") as fout:
+        return convert_range(input_file, start, end, fout, output_format, indent)
+
+def byte_ranges(input_file, count):
+    """Splits input_file into count byte ranges of about the same size."""
+    size = os.path.getsize(input_file)
+    bounds = [size * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(count) if bounds[i] < bounds[i + 1]]
+
+def copy_file(src_path, fout, chunk_size=1024 * 1024):
+    with open(src_path, "r", encoding="utf-8") as src:
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                return
+            fout.write(data)
+
+def convert_jsonl(input_file, output_file, output_format="json", workers=1, indent=None):
+    """
+    Converts a JSONL file of ShareGPT-style messages, streaming the conversations
+    to output_file instead of collecting them first. "json" writes one JSON array,
+    "jsonl" one conversation per line. With workers > 1 the input is split into
+    byte ranges that are converted in separate processes and joined in order, so
+    the output is the same. Returns (conversations written, drop counts per rule).
+    """
+    kept = 0
+    drops = Counter()
+    errors = []
+    ranges = byte_ranges(input_file, max(workers, 1))
     with open(output_file, "w", encoding="utf-8") as fout:
-        json.dump(conversations_list, fout, indent=4, ensure_ascii=False)
+        if output_format == "json":
+            fout.write("[\n")
+
+        if workers <= 1 or len(ranges) <= 1:
+            kept, drops, errors = convert_range(input_file, 0, os.path.getsize(input_file), fout, output_format, indent)
+        else:
+            part_files = [f"{output_file}.part{i}" for i in range(len(ranges))]
+            tasks = [
+                (input_file, start, end, part_file, output_format, indent)
+                for (start, end), part_file in zip(ranges, part_files)
+            ]
+            try:
+                with Pool(processes=min(workers, len(tasks))) as pool:
+                    for part_file, (part_kept, part_drops, part_errors) in zip(part_files, pool.imap(convert_part, tasks)):
+                        if part_kept:
+                            if kept and output_format == "json":
+                                fout.write(",\n")
+                            copy_file(part_file, fout)
+                        kept += part_kept
+                        drops.update(part_drops)
+                        errors.extend(part_errors)
+            finally:
+                for part_file in part_files:
+                    if os.path.exists(part_file):
+                        os.remove(part_file)
+
+        if output_format == "json":
+            fout.write("\n]\n" if kept else "]\n")
+
+    for error in errors[:MAX_PRINTED_ERRORS]:
+        print(error)
+    return kept, drops
+
+def print_report(kept, drops, output_file):
+    total = kept + sum(drops.values())
+    print(f"Converted {kept} of {total} conversations to {output_file}.")
+    for rule, description in DROP_RULES.items():
+        if drops[rule]:
+            print(f"  Dropped {drops[rule]}: {description} ({rule})")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -66,6 +186,13 @@ if __name__ == "__main__":
     )
     parser.add_argument("input_file", help="Path to the input JSONL file")
     parser.add_argument("output_file", help="Path to the output JSON file")
+    parser.add_argument("--format", choices=["json", "jsonl"], default="json",
+                        help="json: one JSON array; jsonl: one conversation per line (also read by torchtune's json source)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes that convert byte ranges of the input in parallel")
+    parser.add_argument("--indent", type=int, default=None,
+                        help="Pretty-print each conversation in json format; by default each takes one line")
     args = parser.parse_args()
-    
-    convert_jsonl(args.input_file, args.output_file)
+
+    kept, drops = convert_jsonl(args.input_file, args.output_file, args.format, args.workers, args.indent)
+    print_report(kept, drops, args.output_file)
@@ -17,7 +17,13 @@ from SyntheticDataGeneration.Utils import Utils
 def main() -> None:
     parser = argparse.ArgumentParser(description="Generate QA data for LLM fine-tuning.")
     parser.add_argument("--config", default="generate_qa_config.yaml", help="Path to configuration YAML file")
-    parser.add_argument("--threads", type=int, default=8, help="Max workers for processing all tasks")
+    parser.add_argument("--threads", type=int, default=8, help="Max workers for processing all tasks (max in-flight requests with --engine async)")
+    parser.add_argument("--engine", choices=["threads", "async", "batch"], default="threads",
+                        help="Execution engine: a thread pool, a single asyncio event loop, or offline OpenAI batch jobs")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only count the requests and prompt tokens the run would need; no API calls are made")
+    parser.add_argument("--questions_per_list", type=float, default=5,
+                        help="With --plan, questions assumed per question list that has not been generated yet")
     args = parser.parse_args()
 
     config_path = Path(args.config)
@@ -28,7 +34,14 @@ def main() -> None:
     config = yaml.safe_load(config_path.read_text(encoding="utf-8"))
     output_base_path = Path(config.get("global", {}).get("output_base_path", "/var/kolo_data"))
     engine = QAGeneratorEngine(config, output_base_path, args.threads)
-    engine.run()
+    if args.plan:
+        engine.plan(args.questions_per_list)
+    elif args.engine == "async":
+        engine.run_async()
+    elif args.engine == "batch":
+        engine.run_batch()
+    else:
+        engine.run()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
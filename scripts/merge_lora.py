@@ -1,13 +1,54 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.pytorch_utils import Conv1D
+from peft import LoraConfig, PeftModel
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+import torch
+import glob
+import json
+import math
 import os
+import re
+import shutil
+import struct
+import tempfile
 import argparse
 
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+ADAPTER_CONFIG_NAMES = ["adapter_config.json", "adapter.config.invalidateCauseHuggingFaceABitch"]
+# Copied next to the merged weights by the streaming engine.
+MODEL_FILES = ["config.json", "generation_config.json"]
+
+# safetensors dtype names, and the bytes per element of each.
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8",
+    torch.uint8: "U8", torch.bool: "BOOL",
+}
+DTYPE_SIZES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+FLOAT_DTYPES = {"F64", "F32", "F16", "BF16"}
+OUTPUT_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--lora_model", type=str, required=True)
     parser.add_argument("--merged_model", type=str, required=True)
     # Optional quantization parameter; if provided, a separate model file is created.
     parser.add_argument("--quantization", type=str, default="")
+    parser.add_argument("--engine", choices=["streaming", "transformers"], default="streaming",
+                        help="streaming: merge one tensor at a time from memory-mapped safetensors; "
+                             "transformers: load the whole model (and merge the adapter with PEFT when --base_model is given) "
+                             "and save it again")
+    parser.add_argument("--base_model", type=str, default="",
+                        help="Base model folder or Hugging Face Hub id to merge the adapter in --lora_model into. "
+                             "Without it, the full weights in --lora_model are used as they are (torchtune saves them "
+                             "already merged)")
+    parser.add_argument("--dtype", choices=["auto"] + list(OUTPUT_DTYPES), default="auto",
+                        help="Streaming engine output dtype; auto keeps the dtype of each weight")
+    parser.add_argument("--max_shard_size_mb", type=int, default=5000, help="Streaming engine output shard size")
+    parser.add_argument("--verify", action="store_true",
+                        help="Also merge with PEFT (or, without --base_model, the transformers engine) and check that "
+                             "every tensor matches (small models only)")
     return parser.parse_args()
 
 def rename_adapter_config(lora_model_path):
@@ -43,21 +84,307 @@ def create_modelfile(file_path, from_line):
     except Exception as e:
         print(f"Error creating modelfile at {file_path}: {e}")
 
+def weight_files(model_dir):
+    """The safetensors files holding a model's weights, in the order of its index when there is one."""
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in dict.fromkeys(weight_map.values())]
+    return sorted(
+        path for path in glob.glob(os.path.join(model_dir, "*.safetensors"))
+        if os.path.basename(path) != ADAPTER_WEIGHTS
+    )
+
+def load_adapter_config(lora_model_path):
+    # The config may already have been renamed by rename_adapter_config.
+    for name in ADAPTER_CONFIG_NAMES:
+        path = os.path.join(lora_model_path, name)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+    raise FileNotFoundError(f"No adapter config found in '{lora_model_path}'")
+
+def resolve_model_dir(model):
+    """A local folder is used as it is; anything else is a Hugging Face Hub id, downloaded once into the cache."""
+    if os.path.isdir(model):
+        return model
+    return snapshot_download(model, allow_patterns=["*.json", "*.safetensors", "*.model", "*.txt"])
+
+def check_output_dir(merged_output, *sources):
+    """The output folder is cleared of old weights, so it must not be a folder the merge reads from."""
+    output = os.path.realpath(merged_output)
+    for source in sources:
+        if source and os.path.realpath(source) == output:
+            raise ValueError(f"--merged_model '{merged_output}' is the same folder as the input '{source}'; "
+                             "choose a separate output folder.")
+
+def check_unquantized(model_dir):
+    """Adapters are merged into the stored weights, which a quantized model does not keep as floats."""
+    config_path = os.path.join(model_dir, "config.json")
+    if not os.path.exists(config_path):
+        return
+    with open(config_path, "r", encoding="utf-8") as f:
+        quantization = json.load(f).get("quantization_config")
+    if quantization:
+        raise ValueError(
+            f"'{model_dir}' is a quantized model ({quantization.get('quant_method', 'unknown method')}); an adapter can "
+            "only be merged into unquantized weights. Pass the original model as --base_model, for example "
+            "unsloth/Llama-3.2-1B-Instruct instead of unsloth/Llama-3.2-1B-Instruct-bnb-4bit."
+        )
+
+def conv1d_weights(model_dir):
+    """
+    Names of the weights stored transposed, as (in_features, out_features), by
+    transformers' Conv1D layers. PEFT decides fan_in_fan_out by the layer type
+    and ignores the adapter config, so the merge does the same. The model is
+    built on the meta device, so no weights are allocated.
+    """
+    config = AutoConfig.from_pretrained(model_dir)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+    return {f"{name}.weight" for name, module in model.named_modules() if isinstance(module, Conv1D)}
+
+def pattern_value(patterns, module, default):
+    # Same matching as PEFT's rank_pattern and alpha_pattern.
+    for key, value in (patterns or {}).items():
+        if re.fullmatch(rf"(.*\.)?{key}", module):
+            return value
+    return default
+
+def adapter_layers(lora_model_path):
+    """
+    Maps each base weight name to the (lora_A name, lora_B name, scale) that
+    update it, for an adapter saved in PEFT format.
+    """
+    config = load_adapter_config(lora_model_path)
+    if config.get("use_dora"):
+        raise ValueError("DoRA adapters cannot be merged by the streaming engine; use --engine transformers.")
+    with safe_open(os.path.join(lora_model_path, ADAPTER_WEIGHTS), framework="pt") as f:
+        names = list(f.keys())
+    layers = {}
+    for name in names:
+        match = re.fullmatch(r"base_model\.model\.(.+)\.lora_A(?:\.default)?\.weight", name)
+        if match is None:
+            if ".lora_B" not in name:
+                raise ValueError(f"Unsupported adapter weight '{name}'; only LoRA A/B matrices can be merged.")
+            continue
+        module = match.group(1)
+        rank = pattern_value(config.get("rank_pattern"), module, config["r"])
+        alpha = pattern_value(config.get("alpha_pattern"), module, config["lora_alpha"])
+        scale = alpha / (math.sqrt(rank) if config.get("use_rslora") else rank)
+        layers[f"{module}.weight"] = (name, name.replace(".lora_A", ".lora_B"), scale)
+    return layers
+
+def plan_shards(entries, max_shard_bytes):
+    """Splits (name, dtype, shape, nbytes) entries, in order, into shards of at most max_shard_bytes."""
+    shards = [[]]
+    size = 0
+    for entry in entries:
+        if shards[-1] and size + entry[3] > max_shard_bytes:
+            shards.append([])
+            size = 0
+        shards[-1].append(entry)
+        size += entry[3]
+    return shards
+
+def write_shard(path, entries, load_tensor):
+    """
+    Writes a safetensors file one tensor at a time. The header is built from the
+    planned dtypes and shapes, so no tensor has to be held until the end.
+    """
+    header = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for name, dtype, shape, nbytes in entries:
+        header[name] = {"dtype": dtype, "shape": shape, "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)  # Tensor data starts 8-byte aligned.
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, dtype, shape, nbytes in entries:
+            tensor = load_tensor(name)
+            if SAFETENSORS_DTYPES[tensor.dtype] != dtype or list(tensor.shape) != shape:
+                raise ValueError(f"Tensor '{name}' does not match its planned dtype and shape.")
+            data = tensor.contiguous().reshape(-1).view(torch.uint8)
+            f.write(memoryview(data.numpy()))
+            del tensor, data
+
+def streaming_merge(source_dir, merged_output, adapter_dir=None, dtype=None, max_shard_bytes=5000 * 2**20):
+    """
+    Writes the weights of source_dir to merged_output without loading the model:
+    each tensor is read from the memory-mapped shards, updated with
+    W + (B @ A) * scale when an adapter layer targets it, cast to dtype and
+    written out before the next one is read. The update is computed in float32
+    and added to W in float32 before W's own dtype is restored, as PEFT merges
+    on CPU, so the result matches PeftModel.merge_and_unload exactly.
+    """
+    files = weight_files(source_dir)
+    if not files:
+        raise FileNotFoundError(f"No safetensors weights found in '{source_dir}'")
+    check_output_dir(merged_output, source_dir, adapter_dir)
+    if adapter_dir:
+        check_unquantized(source_dir)
+    layers = adapter_layers(adapter_dir) if adapter_dir else {}
+    transposed = conv1d_weights(source_dir) if layers else set()
+    adapter = safe_open(os.path.join(adapter_dir, ADAPTER_WEIGHTS), framework="pt") if adapter_dir else None
+    handles = {path: safe_open(path, framework="pt") for path in files}
+    output_dtype = SAFETENSORS_DTYPES[dtype] if dtype is not None else None
+
+    location = {}
+    entries = []
+    for path, handle in handles.items():
+        for name in handle.keys():
+            tensor_slice = handle.get_slice(name)
+            source_dtype = tensor_slice.get_dtype()
+            out = output_dtype if output_dtype and source_dtype in FLOAT_DTYPES else source_dtype
+            shape = list(tensor_slice.get_shape())
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            location[name] = path
+            entries.append((name, out, shape, numel * DTYPE_SIZES[out]))
+    unmatched = set(layers) - set(location)
+    if unmatched:
+        raise KeyError(f"Adapter layers without a base weight: {sorted(unmatched)[:5]}")
+
+    def load_tensor(name):
+        tensor = handles[location[name]].get_tensor(name)
+        if name in layers:
+            if not tensor.is_floating_point():
+                raise ValueError(f"Base weight '{name}' is stored as {tensor.dtype}; adapters can only be merged into float weights.")
+            lora_a_name, lora_b_name, scale = layers[name]
+            lora_a = adapter.get_tensor(lora_a_name).float()
+            lora_b = adapter.get_tensor(lora_b_name).float()
+            delta = (lora_b @ lora_a) * scale
+            # Not in place: the tensor may share the read-only memory map.
+            tensor = (tensor.float() + (delta.T if name in transposed else delta)).to(tensor.dtype)
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        return tensor
+
+    # Written next to merged_output and moved in once complete, so a failed merge
+    # leaves the weights of an earlier one in place.
+    merged_output = os.path.abspath(merged_output)
+    os.makedirs(os.path.dirname(merged_output), exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".merge_", dir=os.path.dirname(merged_output))
+    try:
+        shards = plan_shards(entries, max_shard_bytes)
+        weight_map = {}
+        for number, shard in enumerate(shards, start=1):
+            shard_name = "model.safetensors" if len(shards) == 1 else f"model-{number:05d}-of-{len(shards):05d}.safetensors"
+            write_shard(os.path.join(staging, shard_name), shard, load_tensor)
+            weight_map.update({entry[0]: shard_name for entry in shard})
+            print(f"Wrote {shard_name} ({len(shard)} tensors)")
+        if len(shards) > 1:
+            index = {"metadata": {"total_size": sum(entry[3] for entry in entries)}, "weight_map": weight_map}
+            with open(os.path.join(staging, "model.safetensors.index.json"), "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=2)
+
+        for name in MODEL_FILES:
+            path = os.path.join(source_dir, name)
+            if os.path.exists(path):
+                shutil.copyfile(path, os.path.join(staging, name))
+        if dtype is not None:
+            config_path = os.path.join(staging, "config.json")
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            config["torch_dtype"] = str(dtype).replace("torch.", "")
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(config, f, indent=2)
+
+        os.makedirs(merged_output, exist_ok=True)
+        # Weights of an earlier merge would otherwise be mixed with the new ones.
+        for old in glob.glob(os.path.join(merged_output, "model*.safetensors*")):
+            os.remove(old)
+        for name in os.listdir(staging):
+            os.replace(os.path.join(staging, name), os.path.join(merged_output, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print(f"Merged {len(layers)} adapter layers into {len(entries)} tensors.")
+
+def transformers_merge(lora_model, merged_output):
+    # Merge LoRA model into a base model and save the merged model.
+    base_model = AutoModelForCausalLM.from_pretrained(lora_model)
+    base_model.save_pretrained(merged_output)
+
+def peft_merge(base_model, lora_model, merged_output):
+    """Reference merge for --verify: PEFT applies the adapter to the base model in its stored dtype."""
+    model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype="auto")
+    # The adapter config may have been renamed, so it is passed in rather than found by PEFT.
+    config = LoraConfig.from_peft_type(**load_adapter_config(lora_model))
+    model = PeftModel.from_pretrained(model, lora_model, config=config).merge_and_unload()
+    model.save_pretrained(merged_output)
+
+def verify_merge(merged_output, reference_output):
+    """
+    Compares two merged models tensor by tensor; True if every tensor is
+    identical once the reference is cast to the dtype of the merged output.
+    """
+    merged = {name: path for path in weight_files(merged_output) for name in safe_open(path, framework="pt").keys()}
+    reference = {name: path for path in weight_files(reference_output) for name in safe_open(path, framework="pt").keys()}
+    ok = True
+    for name in sorted(set(merged) ^ set(reference)):
+        print(f"Verify: '{name}' is only in {'the streaming' if name in merged else 'the reference'} output.")
+        ok = False
+    for name in sorted(set(merged) & set(reference)):
+        with safe_open(merged[name], framework="pt") as f:
+            tensor = f.get_tensor(name)
+        with safe_open(reference[name], framework="pt") as f:
+            expected = f.get_tensor(name)
+        # The transformers engine loads float32 by default, and --dtype casts the output.
+        if not torch.equal(tensor, expected.to(tensor.dtype)):
+            print(f"Verify: '{name}' differs ({tensor.dtype} vs {expected.dtype}).")
+            ok = False
+    print(f"Verify: {len(set(merged) & set(reference))} tensors compared, {'all identical' if ok else 'differences found'}.")
+    return ok
+
 def main():
     args = get_args()
 
     # Rename the adapter configuration file (if present).
     rename_adapter_config(args.lora_model)
 
-    # Merge LoRA model into a base model and save the merged model.
-    base_model = AutoModelForCausalLM.from_pretrained(args.lora_model)
-    tokenizer = AutoTokenizer.from_pretrained(args.lora_model)
-
     merged_output = args.merged_model
-    base_model.save_pretrained(merged_output)
+    base_model = resolve_model_dir(args.base_model) if args.base_model else ""
+    check_output_dir(merged_output, args.lora_model, base_model)
+    if base_model:
+        check_unquantized(base_model)
+        if args.engine == "streaming" and not weight_files(base_model):
+            raise SystemExit(f"No safetensors weights found for --base_model '{args.base_model}' in '{base_model}'.")
+    elif args.engine == "streaming" and not weight_files(args.lora_model):
+        print("No safetensors weights found; falling back to the transformers engine.")
+        args.engine = "transformers"
+    if args.engine == "streaming":
+        streaming_merge(
+            base_model or args.lora_model, merged_output,
+            adapter_dir=args.lora_model if base_model else None,
+            dtype=OUTPUT_DTYPES.get(args.dtype),
+            max_shard_bytes=args.max_shard_size_mb * 2**20,
+        )
+    elif base_model:
+        peft_merge(base_model, args.lora_model, merged_output)
+    else:
+        transformers_merge(args.lora_model, merged_output)
+    # An adapter folder may not include the tokenizer; the base model's is the same.
+    has_tokenizer = os.path.exists(os.path.join(args.lora_model, "tokenizer_config.json"))
+    tokenizer = AutoTokenizer.from_pretrained(args.lora_model if has_tokenizer or not base_model else base_model)
     tokenizer.save_pretrained(merged_output)
     print(f"Model saved to {merged_output}")
 
+    if args.verify and args.engine == "streaming":
+        reference_output = tempfile.mkdtemp(prefix="merge_reference_", dir=os.path.dirname(os.path.abspath(merged_output)))
+        try:
+            if base_model:
+                peft_merge(base_model, args.lora_model, reference_output)
+            else:
+                transformers_merge(args.lora_model, reference_output)
+            if not verify_merge(merged_output, reference_output):
+                raise SystemExit(1)
+        finally:
+            shutil.rmtree(reference_output, ignore_errors=True)
+
     # Get the parent directory (one level higher than merged_output)
     parent_dir = os.path.dirname(merged_output)
 
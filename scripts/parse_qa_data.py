@@ -1,97 +1,270 @@
 import os
 import json
 import re
-import glob
+import argparse
+import tempfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+from SyntheticDataGeneration.FileManager import FileManager
+from SyntheticDataGeneration.OutputStore import FileOutputStore, ShardOutputStore, QUESTIONS, ANSWERS
 from SyntheticDataGeneration.TextParser import TextParser
 from SyntheticDataGeneration.Utils import Utils  # Import the Utils class with the logger
 
 # Adjust these paths as needed.
 BASE_OUTPUT_DIR = "/var/kolo_data/qa_generation_output"
-QUESTIONS_DIR = os.path.join(BASE_OUTPUT_DIR, "questions")
-ANSWERS_DIR = os.path.join(BASE_OUTPUT_DIR, "answers")
 OUTPUT_FILE = "/app/data.jsonl"
 
-def pair_questions_and_answers():
+# Naming convention (file names, or record names in the shard index):
+#   - Questions: questions_{group_name}_seed{q_seed_idx}_instr{instr_idx}.txt
+#   - Answers:   answer_{group_name}_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{hash}.txt
+QUESTIONS_FILE_PATTERN = re.compile(r"questions_(.+)_seed(\d+)_instr(\d+)\.txt")
+ANSWER_FILE_PATTERN = re.compile(r"answer_(.+)_seed(\d+)_instr(\d+)_q(\d+)_.*\.txt")
+
+AnswerKey = Tuple[str, str, str, int]
+
+def open_output_store(input_dir: str, backend: str):
+    """
+    Opens the generation output read-only; "auto" prefers shards when a shard index
+    exists. Nothing is created or removed, so it is safe while a run is writing.
     """
-    Looks for all question files in the QUESTIONS_DIR and then for each question,
-    pairs it with the corresponding answer files from ANSWERS_DIR.
+    output_dir = Path(input_dir)
+    if backend == "shards" or (backend == "auto" and ShardOutputStore.exists(output_dir)):
+        Utils.logger.info(f"Reading QA output shards from {output_dir / 'shards'}")
+        return ShardOutputStore(output_dir, read_only=True)
+    return FileOutputStore(output_dir, FileManager(output_dir), read_only=True)
 
-    Assumes the new naming convention:
-      - Questions: questions_{group_name}_seed{q_seed_idx}_instr{instr_idx}.txt
-      - Answers:   answer_{group_name}_seed{q_seed_idx}_instr{instr_idx}_q{question_number}_{hash}.txt
+def index_answers(answer_names: List[str]) -> Dict[AnswerKey, List[str]]:
+    """
+    Maps (group_name, q_seed_idx, instr_idx, question_number) to the answer names
+    for that question, so pairing never scans the answers again.
+    """
+    index: Dict[AnswerKey, List[str]] = defaultdict(list)
+    for name in sorted(answer_names):
+        m = ANSWER_FILE_PATTERN.fullmatch(name)
+        if m:
+            index[(m.group(1), m.group(2), m.group(3), int(m.group(4)))].append(name)
+    Utils.logger.info(f"Indexed {sum(len(names) for names in index.values())} answers")
+    return index
 
-    If there are multiple answer files for a given question, each answer is saved as its own QA pair.
+def pair_question_file(
+    store, q_filename: str, answer_index: Dict[AnswerKey, List[str]]
+) -> Optional[Tuple[str, int, List[dict]]]:
     """
-    qa_pairs = []
-    group_stats = {}  # { identifier: {'questions': count, 'answers': count} }
+    Pairs every question in one question file with its answers. Returns
+    (identifier, question count, QA pairs), or None if the name is not a question file.
+    If there are multiple answers for a given question, each answer is its own QA pair.
+    """
+    m = QUESTIONS_FILE_PATTERN.fullmatch(q_filename)
+    if not m:
+        Utils.logger.warning(f"Skipping file with unexpected format: {q_filename}")
+        return None
 
-    # Process each question file.
-    for q_filename in os.listdir(QUESTIONS_DIR):
-        q_filepath = os.path.join(QUESTIONS_DIR, q_filename)
-        Utils.logger.info(f"Processing question file: {q_filepath}")
+    group_name, q_seed_idx, instr_idx = m.group(1), m.group(2), m.group(3)
+    identifier = f"{group_name}_seed{q_seed_idx}_instr{instr_idx}"
+    questions = TextParser.parse_questions(store.read(QUESTIONS, q_filename))
 
-        # Expect filenames like: questions_{group_name}_seed{q_seed_idx}_instr{instr_idx}.txt
-        m = re.match(r"questions_(.+)_seed(\d+)_instr(\d+)\.txt", q_filename)
-        if not m:
-            Utils.logger.warning(f"Skipping file with unexpected format: {q_filename}")
+    qa_pairs = []
+    for idx, question in enumerate(questions, start=1):
+        answer_names = answer_index.get((group_name, q_seed_idx, instr_idx, idx))
+        if not answer_names:
+            Utils.logger.warning(f"No answer file found for identifier {identifier}, question {idx}.")
             continue
+        for answer_name in answer_names:
+            qa_pairs.append({
+                "messages": [
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": store.read(ANSWERS, answer_name).strip()}
+                ]
+            })
+    return identifier, len(questions), qa_pairs
+
+def pair_questions_and_answers(
+    store, workers: int = 1, q_filenames: Optional[List[str]] = None,
+    answer_index: Optional[Dict[AnswerKey, List[str]]] = None
+) -> Iterator[Tuple[str, int, List[dict]]]:
+    """
+    Yields (identifier, question count, QA pairs) for each question file, in name
+    order. With workers > 1 the files are read by a thread pool; results are still
+    yielded in order so the output is the same. At most 2 * workers files are read
+    ahead of the one being yielded, so memory does not grow with the corpus.
+    """
+    if answer_index is None:
+        answer_index = index_answers(store.names(ANSWERS))
+    if q_filenames is None:
+        q_filenames = store.names(QUESTIONS)
+    Utils.logger.info(f"Pairing {len(q_filenames)} question files with up to {workers} workers...")
+
+    if workers <= 1:
+        for q_filename in q_filenames:
+            result = pair_question_file(store, q_filename, answer_index)
+            if result is not None:
+                yield result
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        names = iter(q_filenames)
+        in_flight = deque()
+        for name in names:
+            in_flight.append(executor.submit(pair_question_file, store, name, answer_index))
+            if len(in_flight) >= 2 * workers:
+                break
+        while in_flight:
+            result = in_flight.popleft().result()
+            name = next(names, None)
+            if name is not None:
+                in_flight.append(executor.submit(pair_question_file, store, name, answer_index))
+            if result is not None:
+                yield result
+
+def load_manifest(manifest_path: str, output_file: str) -> Dict[str, Any]:
+    """
+    Loads the manifest of a previous incremental run. It is discarded (forcing a
+    full rebuild) if the output file was modified after the manifest was written.
+    """
+    empty = {"output_size": 0, "output_mtime_ns": 0, "units": {}}
+    if not os.path.exists(manifest_path) or not os.path.exists(output_file):
+        return empty
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    stat = os.stat(output_file)
+    if manifest.get("output_size") != stat.st_size or manifest.get("output_mtime_ns") != stat.st_mtime_ns:
+        Utils.logger.warning(f"{output_file} changed since the last incremental run; rebuilding it.")
+        return empty
+    return manifest
 
-        group_name = m.group(1)
-        q_seed_idx = m.group(2)
-        instr_idx = m.group(3)
-        identifier = f"{group_name}_seed{q_seed_idx}_instr{instr_idx}"
-
-        # Read file content and extract questions using TextParser.
-        with open(q_filepath, 'r', encoding='utf-8') as f:
-            file_content = f.read()
-        questions = TextParser.parse_questions(file_content)
-        Utils.logger.info(f"Found {len(questions)} questions in file: {q_filename}")
-
-        # Initialize stats for this identifier.
-        group_stats[identifier] = {'questions': len(questions), 'answers': 0}
-
-        # For each question, look for the corresponding answer files using a glob pattern.
-        # Expected answer file format: answer_{group_name}_seed{q_seed_idx}_instr{instr_idx}_q{idx}_{hash}.txt
-        for idx, question in enumerate(questions, start=1):
-            Utils.logger.info(f"Processing question {idx} in file: {q_filename}")
-            pattern = os.path.join(
-                ANSWERS_DIR,
-                f"answer_{group_name}_seed{q_seed_idx}_instr{instr_idx}_q{idx}_*.txt"
-            )
-            matching_files = glob.glob(pattern)
-            if not matching_files:
-                Utils.logger.warning(f"No answer file found for identifier {identifier}, question {idx}.")
-                continue
-
-            for answer_filepath in matching_files:
-                Utils.logger.info(f"Processing answer file: {answer_filepath} for question {idx} in file: {q_filename}")
-                with open(answer_filepath, 'r', encoding='utf-8') as af:
-                    answer = af.read().strip()
-                # Each answer file gets its own Q&A pair.
-                qa_pair = {
-                    "messages": [
-                        {"role": "user", "content": question},
-                        {"role": "assistant", "content": answer}
-                    ]
-                }
-                qa_pairs.append(qa_pair)
-                group_stats[identifier]['answers'] += 1
-
-    return qa_pairs, group_stats
+def save_manifest(manifest_path: str, manifest: Dict[str, Any]) -> None:
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+def copy_range(src, dst, offset: int, length: int, chunk_size: int = 1024 * 1024) -> None:
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+def assemble_incremental(store, output_file: str, workers: int) -> Dict[str, Dict[str, int]]:
+    """
+    Updates output_file in place. The manifest maps each question file to a
+    fingerprint of its own and its answers' signatures (mtime and size, or shard
+    location) and to the byte range of the records it produced. Only question
+    files whose fingerprint changed are re-read. The file is truncated at the
+    first record that changed; unchanged records after that point are copied
+    back, and the re-paired records are appended.
+    """
+    manifest_path = output_file + ".manifest.json"
+    manifest = load_manifest(manifest_path, output_file)
+    old_units = manifest["units"]
+
+    question_signatures = {
+        name: signature for name, signature in store.signatures(QUESTIONS).items()
+        if QUESTIONS_FILE_PATTERN.fullmatch(name)
+    }
+    answer_signatures = store.signatures(ANSWERS)
+    answer_index = index_answers(list(answer_signatures))
+
+    answers_by_question: Dict[Tuple[str, str, str], List[AnswerKey]] = defaultdict(list)
+    for key in answer_index:
+        answers_by_question[key[:3]].append(key)
+
+    def fingerprint(q_filename: str) -> str:
+        # Covers every answer of this file, since answers for any question number may appear later.
+        m = QUESTIONS_FILE_PATTERN.fullmatch(q_filename)
+        answers = sorted(
+            (name, answer_signatures[name])
+            for key in answers_by_question.get((m.group(1), m.group(2), m.group(3)), [])
+            for name in answer_index[key]
+        )
+        return Utils.get_hash(json.dumps([q_filename, question_signatures[q_filename], answers]))
+
+    fingerprints = {name: fingerprint(name) for name in question_signatures}
+    changed = sorted(name for name, fp in fingerprints.items() if old_units.get(name, {}).get("fingerprint") != fp)
+    removed = [name for name in old_units if name not in fingerprints]
+    Utils.logger.info(
+        f"Incremental: {len(fingerprints) - len(changed)} question files unchanged, "
+        f"{len(changed)} new or changed, {len(removed)} removed."
+    )
+
+    stale = set(changed) | set(removed)
+    cut = min((old_units[name]["offset"] for name in stale if name in old_units), default=manifest["output_size"])
+    # Unchanged records after the cut are moved down to close the gaps.
+    kept_tail = sorted(
+        (unit["offset"], name) for name, unit in old_units.items() if name not in stale and unit["offset"] >= cut
+    )
+
+    units = {name: unit for name, unit in old_units.items() if name not in stale and unit["offset"] < cut}
+    with open(output_file, 'r+b' if os.path.exists(output_file) else 'w+b') as out_f, tempfile.TemporaryFile() as tail_f:
+        for offset, name in kept_tail:
+            copy_range(out_f, tail_f, offset, old_units[name]["length"])
+        out_f.seek(cut)
+        out_f.truncate()
+        tail_offset = 0
+        for offset, name in kept_tail:
+            units[name] = dict(old_units[name], offset=out_f.tell())
+            copy_range(tail_f, out_f, tail_offset, old_units[name]["length"])
+            tail_offset += old_units[name]["length"]
+
+        results = pair_questions_and_answers(store, workers, q_filenames=changed, answer_index=answer_index)
+        for q_filename, (identifier, question_count, qa_pairs) in zip(changed, results):
+            offset = out_f.tell()
+            for pair in qa_pairs:
+                out_f.write((json.dumps(pair, ensure_ascii=False) + "\n").encode("utf-8"))
+            units[q_filename] = {
+                "fingerprint": fingerprints[q_filename],
+                "identifier": identifier,
+                "offset": offset,
+                "length": out_f.tell() - offset,
+                "questions": question_count,
+                "answers": len(qa_pairs),
+            }
+        output_size = out_f.tell()
+
+    output_mtime_ns = os.stat(output_file).st_mtime_ns
+    save_manifest(manifest_path, {"output_size": output_size, "output_mtime_ns": output_mtime_ns, "units": units})
+    return {
+        unit["identifier"]: {'questions': unit["questions"], 'answers': unit["answers"]}
+        for _, unit in sorted(units.items())
+    }
 
 def main():
-    qa_pairs, group_stats = pair_questions_and_answers()
-    
-    if not qa_pairs:
+    parser = argparse.ArgumentParser(description="Pair generated questions and answers into a JSONL training file.")
+    parser.add_argument("--input_dir", default=BASE_OUTPUT_DIR, help="QA generation output directory")
+    parser.add_argument("--output_file", default=OUTPUT_FILE, help="Path of the JSONL file to write")
+    parser.add_argument("--workers", type=int, default=1, help="Threads used to read question and answer files")
+    parser.add_argument("--backend", choices=["auto", "files", "shards"], default="auto",
+                        help="Read text files or output shards; auto uses shards when a shard index exists")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-read new or changed question and answer files and patch the output in place")
+    args = parser.parse_args()
+
+    store = open_output_store(args.input_dir, args.backend)
+
+    # Pairs are written as they are produced rather than collected in memory first.
+    group_stats = {}  # { identifier: {'questions': count, 'answers': count} }
+    try:
+        if args.incremental:
+            group_stats = assemble_incremental(store, args.output_file, args.workers)
+        else:
+            with open(args.output_file, 'w', encoding='utf-8') as out_f:
+                for identifier, question_count, qa_pairs in pair_questions_and_answers(store, args.workers):
+                    group_stats[identifier] = {'questions': question_count, 'answers': len(qa_pairs)}
+                    for pair in qa_pairs:
+                        out_f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+    finally:
+        store.close()
+    total_pairs = sum(stats['answers'] for stats in group_stats.values())
+
+    if not total_pairs:
         Utils.logger.info("No QA pairs found.")
         return
 
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as out_f:
-        for pair in qa_pairs:
-            json_line = json.dumps(pair, ensure_ascii=False)
-            out_f.write(json_line + "\n")
-
     # Log summary statistics.
     total_questions = 0
     total_answers = 0
@@ -102,7 +275,7 @@ def main():
         Utils.logger.info(f"  Identifier '{identifier}': {stats['questions']} questions, {stats['answers']} answers processed.")
 
     Utils.logger.info(f"Total: {total_questions} questions and {total_answers} answers processed.")
-    Utils.logger.info(f"Total QA pairs saved to {OUTPUT_FILE}: {len(qa_pairs)}")
+    Utils.logger.info(f"Total QA pairs saved to {args.output_file}: {total_pairs}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,131 @@
+"""
+CPU tests for the streaming engine of merge_lora.py: an adapter merged one
+tensor at a time must match PEFT's merge_and_unload exactly. Run from the
+scripts folder:
+    python -m pytest -q tests
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merge_lora import peft_merge, streaming_merge, verify_merge  # noqa: E402
+
+TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+
+def save_tiny_llama(path, dtype):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=48, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=64,
+    )
+    LlamaForCausalLM(config).to(dtype).save_pretrained(path)
+
+
+def save_adapter(base_path, path, **lora_kwargs):
+    """Saves an adapter with random A and B, so that merging it changes every target weight."""
+    torch.manual_seed(1)
+    model = LlamaForCausalLM.from_pretrained(base_path, torch_dtype="auto")
+    config = LoraConfig(r=4, lora_alpha=8, target_modules=TARGET_MODULES, init_lora_weights=False, **lora_kwargs)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # fan_in_fan_out is reset for nn.Linear layers.
+        get_peft_model(model, config).save_pretrained(path)
+
+
+class StreamingMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="merge_lora_test_")
+        self.base = os.path.join(self.tmp, "base")
+        self.adapter = os.path.join(self.tmp, "adapter")
+        self.merged = os.path.join(self.tmp, "merged")
+        self.reference = os.path.join(self.tmp, "reference")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def assert_matches_peft(self, dtype, output_dtype=None, **lora_kwargs):
+        save_tiny_llama(self.base, dtype)
+        save_adapter(self.base, self.adapter, **lora_kwargs)
+        streaming_merge(self.base, self.merged, adapter_dir=self.adapter, dtype=output_dtype)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            peft_merge(self.base, self.adapter, self.reference)
+        self.assertTrue(verify_merge(self.merged, self.reference))
+        # The adapter really changed the weights.
+        self.assertFalse(verify_merge(self.base, self.reference))
+
+    def test_matches_peft(self):
+        for dtype in (torch.float32, torch.bfloat16, torch.float16):
+            with self.subTest(dtype=dtype):
+                self.assert_matches_peft(dtype)
+
+    def test_rank_and_alpha_patterns_with_rslora(self):
+        self.assert_matches_peft(
+            torch.bfloat16,
+            rank_pattern={"layers.0.self_attn.q_proj": 8, "down_proj": 2},
+            alpha_pattern={"v_proj": 32},
+            use_rslora=True,
+        )
+
+    def test_fan_in_fan_out_is_ignored_for_linear_layers(self):
+        # Llama uses nn.Linear everywhere, so PEFT merges as if fan_in_fan_out were False.
+        self.assert_matches_peft(torch.bfloat16, fan_in_fan_out=True)
+
+    def test_output_dtype(self):
+        self.assert_matches_peft(torch.float32, output_dtype=torch.bfloat16)
+
+    def test_rejects_quantized_base(self):
+        save_tiny_llama(self.base, torch.float32)
+        save_adapter(self.base, self.adapter)
+        config_path = os.path.join(self.base, "config.json")
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        config["quantization_config"] = {"quant_method": "bitsandbytes", "load_in_4bit": True}
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        with self.assertRaisesRegex(ValueError, "quantized"):
+            streaming_merge(self.base, self.merged, adapter_dir=self.adapter)
+
+    def test_refuses_to_write_into_an_input_folder(self):
+        save_tiny_llama(self.base, torch.float32)
+        save_adapter(self.base, self.adapter)
+        for output in (self.base, self.adapter):
+            with self.subTest(output=output):
+                with self.assertRaisesRegex(ValueError, "same folder"):
+                    streaming_merge(self.base, output, adapter_dir=self.adapter)
+        self.assertTrue(os.path.exists(os.path.join(self.base, "model.safetensors")))
+
+    def test_failed_merge_keeps_the_previous_output(self):
+        save_tiny_llama(self.base, torch.float32)
+        save_adapter(self.base, self.adapter)
+        streaming_merge(self.base, self.merged, adapter_dir=self.adapter)
+        with open(os.path.join(self.merged, "model.safetensors"), "rb") as f:
+            previous = f.read()
+        with mock.patch("merge_lora.write_shard", side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                streaming_merge(self.base, self.merged, adapter_dir=self.adapter)
+        with open(os.path.join(self.merged, "model.safetensors"), "rb") as f:
+            self.assertEqual(f.read(), previous)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ["adapter", "base", "merged"])
+
+    def test_rejects_dora(self):
+        save_tiny_llama(self.base, torch.float32)
+        save_adapter(self.base, self.adapter, use_dora=True)
+        with self.assertRaisesRegex(ValueError, "DoRA"):
+            streaming_merge(self.base, self.merged, adapter_dir=self.adapter)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Tests for the order of QuestionDeduplicator decisions. Run from the scripts folder:
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SyntheticDataGeneration.QuestionDeduplicator import QuestionDeduplicator  # noqa: E402
+
+QUESTION = "What does the merge engine write to the output folder?"
+REPHRASED = "what does the merge engine write to the output folder"
+OTHER = "How is the learning rate scheduled during warmup?"
+
+
+class QuestionDeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.dedup = QuestionDeduplicator(threshold=0.8, shingle_size=3, num_perm=64, bands=16)
+        self.kept = []
+        self.skipped = []
+        self.settled = []
+
+    def offer(self, list_number, question):
+        self.dedup.offer(
+            list_number, question,
+            lambda: self.kept.append((list_number, question)),
+            lambda earlier: self.skipped.append((list_number, question)),
+        )
+
+    def settle(self, list_number, stored=True):
+        self.dedup.settle(list_number, stored, lambda: self.settled.append(list_number))
+
+    def test_earlier_list_wins_whatever_order_lists_finish_in(self):
+        first, second = self.dedup.add_list(), self.dedup.add_list()
+        # The second list finishes first; its questions wait for the first list.
+        self.offer(second, REPHRASED)
+        self.settle(second)
+        self.assertEqual((self.kept, self.settled), ([], []))
+        self.offer(first, QUESTION)
+        self.settle(first)
+        self.assertEqual(self.kept, [(first, QUESTION)])
+        self.assertEqual(self.skipped, [(second, REPHRASED)])
+        self.assertEqual(self.settled, [first, second])
+
+    def test_duplicates_within_a_list(self):
+        only = self.dedup.add_list()
+        self.offer(only, QUESTION)
+        self.offer(only, OTHER)
+        self.offer(only, REPHRASED)
+        self.settle(only)
+        self.assertEqual(self.kept, [(only, QUESTION), (only, OTHER)])
+        self.assertEqual(self.skipped, [(only, REPHRASED)])
+
+    def test_list_that_was_not_stored_suppresses_nothing(self):
+        failed, later = self.dedup.add_list(), self.dedup.add_list()
+        self.offer(failed, QUESTION)  # Streamed, then the stream failed.
+        self.settle(failed, stored=False)
+        self.offer(later, REPHRASED)
+        self.settle(later)
+        self.assertEqual(self.kept, [(failed, QUESTION), (later, REPHRASED)])
+        self.assertEqual(self.skipped, [])
+
+    def test_waiting_questions_of_a_failed_list_are_dropped(self):
+        first, failed = self.dedup.add_list(), self.dedup.add_list()
+        self.offer(failed, OTHER)
+        self.settle(failed, stored=False)
+        self.settle(first)
+        self.assertEqual(self.kept, [])
+        self.assertEqual(self.settled, [first, failed])
+
+
+if __name__ == "__main__":
+    unittest.main()
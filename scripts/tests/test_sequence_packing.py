@@ -0,0 +1,112 @@
+"""
+CPU tests for sequence_packing.py with a tiny randomly initialised Llama model.
+Run from the scripts folder:
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import unittest
+
+import torch
+from datasets import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sequence_packing import IGNORE_INDEX, ISOLATION_TOLERANCE, PackedCollator, check_isolation, pack_dataset  # noqa: E402
+
+VOCAB_SIZE = 64
+
+
+def tiny_llama(attn_implementation: str) -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=64,
+        attention_dropout=0.1, attn_implementation=attn_implementation,
+    )
+    return LlamaForCausalLM(config)
+
+
+def packed_row(*conversations):
+    ids, positions = [], []
+    for conversation in conversations:
+        ids.extend(conversation)
+        positions.extend(range(len(conversation)))
+    return {"input_ids": ids, "position_ids": positions}
+
+
+class PackedCollatorTest(unittest.TestCase):
+    def test_mask_is_block_diagonal_and_causal(self):
+        batch = PackedCollator(pad_token_id=0)([packed_row([5, 6], [7, 8, 9]), packed_row([3])])
+        visible = batch["attention_mask"] == 0
+        self.assertEqual(tuple(visible.shape), (2, 1, 5, 5))
+        expected = torch.tensor([
+            [1, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0],
+            [0, 0, 1, 0, 0],
+            [0, 0, 1, 1, 0],
+            [0, 0, 1, 1, 1],
+        ], dtype=torch.bool)
+        self.assertTrue(torch.equal(visible[0, 0], expected))
+        # Padding neither attends nor is attended to.
+        self.assertTrue(visible[1, 0, 0, 0])
+        self.assertFalse(visible[1, 0, 1:].any())
+        self.assertFalse(visible[1, 0, :, 1:].any())
+
+    def test_labels_skip_padding_and_conversation_starts(self):
+        batch = PackedCollator(pad_token_id=0)([packed_row([5, 6], [7, 8, 9]), packed_row([3, 4])])
+        self.assertEqual(batch["labels"][0].tolist(), [IGNORE_INDEX, 6, IGNORE_INDEX, 8, 9])
+        self.assertEqual(batch["labels"][1].tolist(), [IGNORE_INDEX, 4, IGNORE_INDEX, IGNORE_INDEX, IGNORE_INDEX])
+
+    def test_mask_uses_collator_dtype(self):
+        batch = PackedCollator(pad_token_id=0, dtype=torch.bfloat16)([packed_row([5, 6])])
+        self.assertEqual(batch["attention_mask"].dtype, torch.bfloat16)
+
+    def test_pack_dataset_restarts_positions(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5], [6]], "length": [3, 2, 1]})
+        packed = pack_dataset(dataset, max_seq_length=4)
+        rows = sorted(zip(packed["input_ids"], packed["position_ids"]))
+        self.assertEqual(rows, [([1, 2, 3, 6], [0, 1, 2, 0]), ([4, 5], [0, 1])])
+
+
+class ConversationIsolationTest(unittest.TestCase):
+    def conversation_logits(self, model, first):
+        second = [11, 12, 13, 14, 15, 16]
+        batch = PackedCollator(pad_token_id=0)([packed_row(first, second)])
+        batch.pop("labels")
+        with torch.no_grad():
+            return model(**batch).logits[0, len(first):]
+
+    def test_second_conversation_ignores_the_first(self):
+        for attn_implementation in ("eager", "sdpa"):
+            with self.subTest(attn_implementation=attn_implementation):
+                model = tiny_llama(attn_implementation).eval()
+                before = self.conversation_logits(model, [1, 2, 3, 4])
+                after = self.conversation_logits(model, [40, 41, 42, 43])
+                alone = self.conversation_logits(model, [])
+                torch.testing.assert_close(before, after)
+                torch.testing.assert_close(before, alone)
+
+    def test_check_isolation(self):
+        for attn_implementation in ("eager", "sdpa"):
+            with self.subTest(attn_implementation=attn_implementation):
+                model = tiny_llama(attn_implementation)
+                self.assertLess(check_isolation(model, PackedCollator(pad_token_id=0), VOCAB_SIZE), 1e-5)
+                self.assertTrue(model.training)
+
+    def test_check_isolation_detects_a_shared_mask(self):
+        class SharedMaskCollator(PackedCollator):
+            # Causal over the whole packed row, as the collator used to be.
+            def __call__(self, features):
+                batch = super().__call__(features)
+                batch["attention_mask"] = torch.ones_like(batch["input_ids"])
+                return batch
+
+        model = tiny_llama("sdpa")
+        self.assertGreater(check_isolation(model, SharedMaskCollator(pad_token_id=0), VOCAB_SIZE), ISOLATION_TOLERANCE)
+
+
+if __name__ == "__main__":
+    unittest.main()
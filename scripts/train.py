@@ -22,15 +22,35 @@ Description:
         --quantization       Quantization type e.g. (q4_k_m)
         --weight_decay       Weight Decay.
         --use_checkpoint     Use latest checkpoint or start over.
+        --packing            Pack whole conversations into max_seq_length sequences.
+        --group_by_length    Batch examples of similar token length together.
+        --num_proc           Worker processes used to tokenize and prepare the dataset.
+        --cache_dir          Where tokenized datasets are cached; reused when nothing changed.
+        --no_cache           Tokenize the dataset without reading or writing the cache.
+        --streaming          Stream JSONL shards (--train_data may be a directory or glob); needs --max_steps.
+        --shuffle_buffer     Conversations held in the shuffle buffer when streaming.
+        --max_steps          Training steps to run; overrides --epochs.
+        --profile            Record step time, tokens/sec and memory per step to throughput.csv/.json.
+        --profile_steps      Also record a torch.profiler trace for these steps, e.g. 10-12.
 """
 
 import argparse
+import json
+import os
 
 from unsloth import FastLanguageModel, is_bfloat16_supported
 from unsloth.chat_templates import get_chat_template
-from datasets import load_dataset
+import torch
 from trl import SFTTrainer
 from transformers import TrainingArguments
+from transformers.trainer_utils import get_last_checkpoint
+
+from sequence_packing import (
+    ISOLATION_TOLERANCE, PackedCollator, check_isolation, pack_dataset, padding_report, print_padding_report,
+    selected_mode,
+)
+from training_data import StreamingConversations, load_tokenized_dataset, resolve_data_files
+from training_profiler import ThroughputProfiler, parse_step_window
 
 
 def parse_arguments():
@@ -55,30 +75,43 @@ def parse_arguments():
     parser.add_argument("--quantization", type=str, default="", help="Quantization type e.g. (q4_k_m)")
     parser.add_argument("--weight_decay", type=float, default=0.0, help="Weight Decay")
     parser.add_argument("--use_checkpoint", action="store_true", help="Use latest checkpoint or start over")
+    parser.add_argument("--packing", action="store_true", help="Pack whole conversations into max_seq_length sequences")
+    parser.add_argument("--group_by_length", action="store_true", help="Batch examples of similar token length together")
+    parser.add_argument("--num_proc", type=int, default=2, help="Worker processes used to tokenize and prepare the dataset")
+    parser.add_argument("--cache_dir", type=str, default="/var/kolo_data/unsloth/tokenized_cache",
+                        help="Where tokenized datasets are cached")
+    parser.add_argument("--no_cache", action="store_true", help="Tokenize the dataset without reading or writing the cache")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Stream JSONL shards instead of loading the dataset; --train_data may be a directory or glob")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="Conversations held in the shuffle buffer when streaming")
+    parser.add_argument("--max_steps", type=int, default=-1, help="Training steps to run; overrides --epochs")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record step time, tokens/sec and memory per step to throughput.csv/.json in the output directory")
+    parser.add_argument("--profile_steps", type=str, default="",
+                        help="Also record a torch.profiler trace for these steps, e.g. 10-12 (implies --profile)")
 
 
-    return parser.parse_args()
-
+    args = parser.parse_args()
+    if args.streaming and args.max_steps <= 0:
+        parser.error("--streaming needs --max_steps, since the length of a stream is not known")
+    if args.streaming and (args.packing or args.group_by_length):
+        parser.error("--packing and --group_by_length need the whole dataset and cannot be used with --streaming")
+    try:
+        args.profile_steps = parse_step_window(args.profile_steps)
+    except ValueError as e:
+        parser.error(str(e))
+    args.profile = args.profile or args.profile_steps is not None
+    return args
 
-def formatting_prompts_func(examples, tokenizer):
-    """
-    Formats the prompts from the dataset by applying the chat template
-    and tokenizing the resulting texts.
 
-    Args:
-        examples (dict): A dictionary with a key "messages" containing conversation data.
-        tokenizer: The tokenizer that includes the chat template method.
+def trained_examples(output_dir, batch_size):
+    """Examples the last checkpoint in output_dir has trained on, or 0 without one."""
+    checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+    if checkpoint is None:
+        return 0
+    with open(os.path.join(checkpoint, "trainer_state.json"), "r", encoding="utf-8") as f:
+        return json.load(f)["global_step"] * batch_size
 
-    Returns:
-        dict: A dictionary with tokenized texts under the key "text".
-    """
-    convos = examples["messages"]
-    # Apply the chat template to each conversation without tokenizing yet.
-    texts = [tokenizer.apply_chat_template(convo, tokenize=False, add_generation_prompt=False)
-             for convo in convos]
-    # Tokenize the texts.
-    tokenized_texts = tokenizer(texts, padding=False, truncation=True, add_special_tokens=False)
-    return {"text": texts, "input_ids": tokenized_texts["input_ids"]}
 
 def main():
     args = parse_arguments()
@@ -109,20 +142,52 @@ def main():
     # Update the tokenizer with the chosen chat template.
     tokenizer = get_chat_template(tokenizer, chat_template=args.chat_template)
 
-    # Data Preparation: Load dataset and format the prompts.
-    dataset = load_dataset("json", data_files=args.train_data, split="train")
-    # Use a lambda to pass the tokenizer into our formatting function.
-    dataset = dataset.map(lambda ex: formatting_prompts_func(ex, tokenizer=tokenizer), batched=True)
+    volume_output_dir = f"/var/kolo_data/unsloth/{args.output_dir}"
+
+    data_collator = None
+    if args.streaming:
+        # Conversations are tokenized as training reaches them, in --num_proc background workers.
+        # On resume the stream skips what the checkpoint trained on, in place of the Trainer's own skipping.
+        files = resolve_data_files(args.train_data)
+        skip_examples = trained_examples(volume_output_dir, args.batch_size) if args.use_checkpoint else 0
+        dataset = StreamingConversations(
+            files, tokenizer, args.max_seq_length, args.batch_size,
+            shuffle_buffer=args.shuffle_buffer, seed=args.seed, skip_examples=skip_examples,
+        )
+        print(f"Streaming {len(files)} training data files; skipping {skip_examples} already trained examples.")
+    else:
+        # Data Preparation: Load the dataset and format the prompts, or reuse the cached result.
+        dataset = load_tokenized_dataset(
+            args.train_data, tokenizer, args.max_seq_length,
+            num_proc=args.num_proc, cache_dir=None if args.no_cache else args.cache_dir,
+        )
 
-    print("Sample data:", dataset[0])
+        print("Sample data:", dataset[0])
 
-    volume_output_dir = f"/var/kolo_data/unsloth/{args.output_dir}"
+        # Compare padding with and without packing and length grouping before training.
+        report = padding_report(dataset["length"], args.max_seq_length, args.batch_size, args.seed)
+        print_padding_report(report, args.batch_size, args.max_seq_length, selected_mode(args.packing, args.group_by_length))
+
+        if args.packing:
+            dataset = pack_dataset(dataset, args.max_seq_length)
+            dtype = torch.bfloat16 if is_bfloat16_supported() else torch.float16
+            data_collator = PackedCollator(tokenizer.pad_token_id, dtype)
+            # Packed conversations are kept apart only by the attention mask, so make sure the model uses it.
+            change = check_isolation(model, data_collator, model.config.vocab_size)
+            if change > ISOLATION_TOLERANCE:
+                raise RuntimeError(
+                    f"--packing: the logits of a packed conversation changed by {change:.1%} when the conversation "
+                    "before it changed, so this model's training forward pass does not apply the per-conversation "
+                    "attention mask. Train without --packing, or use --group_by_length to reduce padding."
+                )
+            print(f"Packed conversations into {len(dataset)} sequences of up to {args.max_seq_length} tokens.")
 
     # Configure training arguments.
     training_args = TrainingArguments(
         per_device_train_batch_size=args.batch_size,
         warmup_steps=args.warmup_steps,
         num_train_epochs=args.epochs,
+        max_steps=args.max_steps,
         learning_rate=args.learning_rate,
         fp16=not is_bfloat16_supported(),
         bf16=is_bfloat16_supported(),
@@ -134,10 +199,22 @@ def main():
         weight_decay=args.weight_decay,
         lr_scheduler_type=args.scheduler_type,
         seed=args.seed,
+        group_by_length=args.group_by_length,
+        length_column_name="length",  # Precomputed token lengths, so the sampler does not re-read every example.
+        dataloader_num_workers=args.num_proc if args.streaming else 0,
+        ignore_data_skip=args.streaming,
         output_dir=volume_output_dir,
         report_to="none",  # Disable reporting to third-party tools like WandB.
     )
 
+    callbacks = []
+    if args.profile:
+        profiler_config = {key: getattr(args, key) for key in (
+            "base_model", "batch_size", "lora_rank", "lora_alpha", "max_seq_length",
+            "packing", "group_by_length", "streaming", "num_proc",
+        )}
+        callbacks.append(ThroughputProfiler(volume_output_dir, profiler_config, args.profile_steps))
+
     # Set up the trainer.
     trainer = SFTTrainer(
         model=model,
@@ -145,9 +222,11 @@ def main():
         train_dataset=dataset,
         dataset_text_field="input_ids",
         max_seq_length=args.max_seq_length,
-        dataset_num_proc=2,
-        packing=False,
+        dataset_num_proc=args.num_proc,
+        packing=False,  # Packing, when enabled, is done above so conversations are never split.
+        data_collator=data_collator,
         args=training_args,
+        callbacks=callbacks,
     )
 
     # Train the model.
@@ -0,0 +1,213 @@
+"""
+Description:
+    Loads the training data for train.py as a tokenized dataset. The chat
+    template is applied and the conversations are tokenized once; the result is
+    saved in Arrow format under a key made from the data file, the tokenizer, the
+    chat template and max_seq_length. Later runs with the same inputs, such as the
+    runs of a hyperparameter sweep, memory-map the saved dataset instead of
+    tokenizing again.
+
+    For corpora larger than memory, StreamingConversations reads sharded JSONL
+    input one line at a time through a shuffle buffer and tokenizes each
+    conversation only when the trainer asks for it, in DataLoader worker
+    processes. Its order depends only on the files and the seed, so a resumed
+    run can skip exactly the examples the checkpoint has already trained on.
+"""
+
+import glob
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import torch
+from datasets import Dataset, load_dataset, load_from_disk
+
+# Part of every cache key; bump it when the tokenized format changes.
+CACHE_VERSION = 1
+
+
+def formatting_prompts_func(examples, tokenizer, max_seq_length):
+    """
+    Formats the prompts from the dataset by applying the chat template
+    and tokenizing the resulting texts.
+
+    Args:
+        examples (dict): A dictionary with a key "messages" containing conversation data.
+        tokenizer: The tokenizer that includes the chat template method.
+        max_seq_length (int): Conversations are truncated to this many tokens.
+
+    Returns:
+        dict: A dictionary with the tokens under "input_ids" and the token counts under "length".
+    """
+    convos = examples["messages"]
+    # Apply the chat template to each conversation without tokenizing yet.
+    texts = [tokenizer.apply_chat_template(convo, tokenize=False, add_generation_prompt=False)
+             for convo in convos]
+    # Tokenize the texts.
+    tokenized_texts = tokenizer(texts, padding=False, truncation=True, max_length=max_seq_length,
+                                add_special_tokens=False)
+    input_ids = tokenized_texts["input_ids"]
+    return {"input_ids": input_ids, "length": [len(ids) for ids in input_ids]}
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of the vocabulary, merges and normalization rules, so a changed tokenizer gets a new key."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        definition = backend.to_str()
+    else:
+        definition = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()
+
+
+def cache_key(train_data, tokenizer, max_seq_length):
+    parts = {
+        "version": CACHE_VERSION,
+        "data": file_digest(train_data),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "chat_template": tokenizer.chat_template,
+        "max_seq_length": max_seq_length,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def tokenize_dataset(train_data, tokenizer, max_seq_length, num_proc):
+    dataset = load_dataset("json", data_files=train_data, split="train")
+    return dataset.map(
+        formatting_prompts_func,
+        batched=True,
+        num_proc=num_proc if num_proc > 1 else None,
+        fn_kwargs={"tokenizer": tokenizer, "max_seq_length": max_seq_length},
+        remove_columns=dataset.column_names,  # Only the tokens are kept for training.
+    )
+
+
+def load_tokenized_dataset(train_data, tokenizer, max_seq_length, num_proc=2, cache_dir=None) -> Dataset:
+    """
+    Returns the dataset with "input_ids" and "length" columns, from cache_dir when
+    it was tokenized before with the same inputs. Without cache_dir it is always
+    tokenized and nothing is saved.
+    """
+    if not cache_dir:
+        return tokenize_dataset(train_data, tokenizer, max_seq_length, num_proc)
+
+    path = Path(cache_dir) / cache_key(train_data, tokenizer, max_seq_length)
+    if path.exists():
+        print(f"Loading tokenized dataset from cache: {path}")
+        return load_from_disk(str(path))
+
+    dataset = tokenize_dataset(train_data, tokenizer, max_seq_length, num_proc)
+    # Saved next to the final location and renamed, so an interrupted save is never loaded.
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset.save_to_disk(str(tmp_path), num_proc=num_proc if num_proc > 1 else None)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another run saved the same key first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f"Saved tokenized dataset to cache: {path}")
+    return load_from_disk(str(path))
+
+
+def resolve_data_files(train_data) -> List[str]:
+    """A directory means every .jsonl file in it; a pattern is expanded; anything else is one file."""
+    if os.path.isdir(train_data):
+        files = sorted(glob.glob(os.path.join(train_data, "**", "*.jsonl"), recursive=True))
+    elif any(char in train_data for char in "*?["):
+        files = sorted(glob.glob(train_data, recursive=True))
+    else:
+        files = [train_data]
+    if not files:
+        raise FileNotFoundError(f"No training data files match {train_data}")
+    return files
+
+
+class StreamingConversations(torch.utils.data.IterableDataset):
+    """
+    Yields {"input_ids": [...]} for the conversations of a set of JSONL files,
+    over and over, so the number of steps is set by max_steps. Each pass shuffles
+    the file order and passes the lines through a shuffle buffer, both seeded
+    with the seed and the pass number.
+
+    Examples are handed to DataLoader workers one batch at a time, in turn, which
+    is the order the DataLoader collects them in, so the stream is the same for
+    any number of workers. The first skip_examples examples are read but not
+    tokenized, so resuming does not repeat the tokenization of trained examples.
+    """
+    def __init__(self, files: List[str], tokenizer, max_seq_length: int, batch_size: int,
+                 shuffle_buffer: int = 10000, seed: int = 0, skip_examples: int = 0):
+        self.files = files
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        self.shuffle_buffer = max(shuffle_buffer, 1)
+        self.seed = seed
+        self.skip_examples = skip_examples
+
+    def lines(self, rng: random.Random) -> Iterator[bytes]:
+        files = list(self.files)
+        rng.shuffle(files)
+        for path in files:
+            with open(path, "rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+
+    def shuffled_lines(self, epoch: int) -> Iterator[bytes]:
+        rng = random.Random(self.seed * 1000003 + epoch)
+        buffer: List[bytes] = []
+        for line in self.lines(rng):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(line)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], line = line, buffer[i]
+            yield line
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def conversations(self) -> Iterator[list]:
+        """Every valid conversation of every pass, in stream order."""
+        for epoch in itertools.count():
+            found = False
+            for line in self.shuffled_lines(epoch):
+                try:
+                    messages = json.loads(line).get("messages")
+                except (ValueError, AttributeError):
+                    continue  # Not a JSON object
+                if messages:
+                    found = True
+                    yield messages
+            if not found:
+                return
+
+    def tokenize(self, messages: list) -> Dict[str, List[int]]:
+        features = formatting_prompts_func({"messages": [messages]}, self.tokenizer, self.max_seq_length)
+        return {"input_ids": features["input_ids"][0]}
+
+    def __iter__(self) -> Iterator[Dict[str, List[int]]]:
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        for index, messages in enumerate(self.conversations()):
+            if index < self.skip_examples:
+                continue
+            if (index - self.skip_examples) // self.batch_size % num_workers != worker_id:
+                continue
+            yield self.tokenize(messages)
@@ -0,0 +1,222 @@
+"""
+Description:
+    Throughput profiler for train.py. ThroughputProfiler is a Trainer callback
+    that records, for every optimizer step:
+        step_seconds         Wall time from the end of the previous step, leaving
+                             out the logging and checkpoint saves that follow it
+        dataloader_seconds   Time spent waiting for the next batch
+        optimizer_seconds    Time spent in the optimizer step, or empty when this
+                             version of transformers does not report it
+        real_tokens          Tokens that are not padding
+        padded_tokens        All tokens, padding included
+        real_tokens_per_sec / padded_tokens_per_sec
+        peak_device_mb       Peak GPU memory allocated during the step
+        peak_host_mb         Peak resident memory of the process so far
+
+    Steps are appended to throughput.csv as they finish, and throughput.json
+    holds the per-step records and a summary once training ends, including the
+    seconds per million real tokens used to compare configurations. Optionally a
+    torch.profiler trace is recorded for a window of steps.
+"""
+
+import csv
+import json
+import os
+import resource
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import TrainerCallback
+
+# Steps left out of the summary while kernels are compiled and memory pools grow.
+WARMUP_STEPS = 2
+
+CSV_FIELDS = [
+    "step", "step_seconds", "dataloader_seconds", "optimizer_seconds", "real_tokens", "padded_tokens",
+    "real_tokens_per_sec", "padded_tokens_per_sec", "peak_device_mb", "peak_host_mb",
+]
+
+
+def parse_step_window(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parses "start-end" (or a single step) into an inclusive step window."""
+    if not value:
+        return None
+    start, _, end = value.partition("-")
+    window = (int(start), int(end or start))
+    if window[0] < 1 or window[1] < window[0]:
+        raise ValueError(f"Invalid step window {value!r}; expected start-end with 1 <= start <= end")
+    return window
+
+
+def peak_host_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ThroughputProfiler(TrainerCallback):
+    """
+    Trainer callback that writes per-step throughput to output_dir. Tokens are
+    counted by a forward pre-hook on the model, so any data collator works; the
+    counts are summed on the device and read once per step.
+    """
+    def __init__(self, output_dir: str, config: Optional[Dict[str, Any]] = None,
+                 profile_steps: Optional[Tuple[int, int]] = None):
+        self.output_dir = output_dir
+        self.config = config or {}
+        self.profile_steps = profile_steps
+        self.cuda = torch.cuda.is_available()
+        self.records: List[Dict[str, Any]] = []
+        self.csv_file = None
+        self.csv_writer = None
+        self.hook = None
+        self.profiler = None
+        self.real_tokens: List[torch.Tensor] = []
+        self.padded_tokens = 0
+        self.last_step_end = 0.0
+        self.step_begin = 0.0
+        self.optimizer_begin = None
+        self.optimizer_seconds: Optional[float] = None
+
+    def sync(self) -> None:
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def count_tokens(self, module, args, kwargs) -> None:
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        attention_mask = kwargs.get("attention_mask")
+        self.padded_tokens += input_ids.numel()
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # Additive mask from PackedCollator: a real token can attend to at least itself.
+            self.real_tokens.append((attention_mask == 0).any(dim=-1).sum())
+        elif attention_mask is not None:
+            self.real_tokens.append(attention_mask.sum())
+        else:
+            self.real_tokens.append(torch.tensor(input_ids.numel()))
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.csv_file = open(os.path.join(self.output_dir, "throughput.csv"), "w", newline="", encoding="utf-8")
+        self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=CSV_FIELDS)
+        self.csv_writer.writeheader()
+        if model is not None:
+            self.hook = model.register_forward_pre_hook(self.count_tokens, with_kwargs=True)
+        self.last_step_end = time.perf_counter()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_begin = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        step = state.global_step + 1
+        if self.profile_steps and step == self.profile_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self.sync()
+        self.optimizer_begin = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self.optimizer_begin is None:
+            return  # Older versions of transformers only call this hook.
+        self.sync()
+        self.optimizer_seconds = (self.optimizer_seconds or 0.0) + time.perf_counter() - self.optimizer_begin
+        self.optimizer_begin = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.sync()
+        now = time.perf_counter()
+        step_seconds = now - self.last_step_end
+        real_tokens = int(torch.stack([t.to("cpu") for t in self.real_tokens]).sum()) if self.real_tokens else 0
+        record = {
+            "step": state.global_step,
+            "step_seconds": round(step_seconds, 4),
+            "dataloader_seconds": round(self.step_begin - self.last_step_end, 4),
+            "optimizer_seconds": round(self.optimizer_seconds, 4) if self.optimizer_seconds is not None else None,
+            "real_tokens": real_tokens,
+            "padded_tokens": self.padded_tokens,
+            "real_tokens_per_sec": round(real_tokens / step_seconds, 1) if step_seconds > 0 else 0.0,
+            "padded_tokens_per_sec": round(self.padded_tokens / step_seconds, 1) if step_seconds > 0 else 0.0,
+            "peak_device_mb": round(torch.cuda.max_memory_allocated() / 2**20, 1) if self.cuda else None,
+            "peak_host_mb": round(peak_host_mb(), 1),
+        }
+        self.records.append(record)
+        self.csv_writer.writerow(record)
+        self.csv_file.flush()
+
+        if self.profiler is not None and state.global_step >= self.profile_steps[1]:
+            self.stop_profiler()
+        self.real_tokens = []
+        self.padded_tokens = 0
+        self.optimizer_seconds = None
+        self.last_step_end = time.perf_counter()
+
+    # The Trainer logs, evaluates and saves checkpoints after on_step_end and before
+    # it fetches the next batch; the next step is timed from the end of that work.
+    def on_log(self, args, state, control, **kwargs):
+        self.last_step_end = time.perf_counter()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.last_step_end = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        self.last_step_end = time.perf_counter()
+
+    def stop_profiler(self) -> None:
+        self.profiler.stop()
+        start, end = self.profile_steps
+        trace_path = os.path.join(self.output_dir, f"profiler_trace_steps_{start}-{end}.json")
+        self.profiler.export_chrome_trace(trace_path)
+        sort_by = "cuda_time_total" if self.cuda else "cpu_time_total"
+        with open(os.path.join(self.output_dir, f"profiler_summary_steps_{start}-{end}.txt"), "w", encoding="utf-8") as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        print(f"torch.profiler trace for steps {start}-{end} written to {trace_path}")
+        self.profiler = None
+
+    def summary(self) -> Dict[str, Any]:
+        steps = self.records[WARMUP_STEPS:] or self.records
+        if not steps:
+            return {}
+        seconds = sum(r["step_seconds"] for r in steps)
+        real = sum(r["real_tokens"] for r in steps)
+        padded = sum(r["padded_tokens"] for r in steps)
+        device_peaks = [r["peak_device_mb"] for r in self.records if r["peak_device_mb"] is not None]
+        optimizer = [r["optimizer_seconds"] for r in steps if r["optimizer_seconds"] is not None]
+        return {
+            "steps": len(self.records),
+            "summarized_steps": len(steps),
+            "mean_step_seconds": round(seconds / len(steps), 4),
+            "mean_dataloader_seconds": round(sum(r["dataloader_seconds"] for r in steps) / len(steps), 4),
+            "mean_optimizer_seconds": round(sum(optimizer) / len(optimizer), 4) if optimizer else None,
+            "real_tokens_per_sec": round(real / seconds, 1) if seconds > 0 else 0.0,
+            "padded_tokens_per_sec": round(padded / seconds, 1) if seconds > 0 else 0.0,
+            "padding_ratio": round(1 - real / padded, 4) if padded else 0.0,
+            "seconds_per_million_real_tokens": round(seconds / real * 1e6, 2) if real else None,
+            "peak_device_mb": max(device_peaks) if device_peaks else None,
+            "peak_host_mb": round(peak_host_mb(), 1),
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.stop_profiler()  # Training ended inside the window.
+        if self.hook is not None:
+            self.hook.remove()
+            self.hook = None
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "throughput.json"), "w", encoding="utf-8") as f:
+            json.dump({"config": self.config, "summary": summary, "steps": self.records}, f, indent=2)
+        if summary:
+            print(
+                f"Throughput: {summary['real_tokens_per_sec']:.0f} real tokens/sec "
+                f"({summary['padding_ratio']:.1%} padding), {summary['mean_step_seconds']:.3f}s per step, "
+                f"{summary['mean_dataloader_seconds']:.3f}s waiting for data, "
+                f"{summary['seconds_per_million_real_tokens']}s per million real tokens."
+            )
@@ -23,6 +23,15 @@ param (
     [string]$Quantization,
     [double]$WeightDecay,
     [switch]$UseCheckpoint,
+    [switch]$Packing,
+    [switch]$GroupByLength,
+    [int]$NumProc,
+    [switch]$NoCache,
+    [switch]$Streaming,
+    [int]$ShuffleBuffer,
+    [int]$MaxSteps,
+    [switch]$Profile,
+    [string]$ProfileSteps,
     [switch]$FastTransfer
 )
 
@@ -47,6 +56,15 @@ if ($OutputDir) { Write-Host "OutputDir: $OutputDir" }
 if ($Quantization) { Write-Host "Quantization: $Quantization" }
 if ($WeightDecay) { Write-Host "WeightDecay: $WeightDecay" }
 if ($UseCheckpoint) { Write-Host "UseCheckpoint: Enabled" } else { Write-Host "UseCheckpoint: Disabled" }
+if ($Packing) { Write-Host "Packing: Enabled" }
+if ($GroupByLength) { Write-Host "GroupByLength: Enabled" }
+if ($NumProc) { Write-Host "NumProc: $NumProc" }
+if ($NoCache) { Write-Host "NoCache: Enabled" }
+if ($Streaming) { Write-Host "Streaming: Enabled" }
+if ($ShuffleBuffer) { Write-Host "ShuffleBuffer: $ShuffleBuffer" }
+if ($MaxSteps) { Write-Host "MaxSteps: $MaxSteps" }
+if ($Profile) { Write-Host "Profile: Enabled" }
+if ($ProfileSteps) { Write-Host "ProfileSteps: $ProfileSteps" }
 if ($FastTransfer) { Write-Host "FastTransfer: Enabled (HF_HUB_ENABLE_HF_TRANSFER=1)" } else { Write-Host "FastTransfer: Disabled (HF_HUB_ENABLE_HF_TRANSFER=0)" }
 # Define container name
 $ContainerName = "kolo_container"
@@ -82,6 +100,15 @@ if ($OutputDir) { $command += " --output_dir '$OutputDir'" }
 if ($Quantization) { $command += " --quantization '$Quantization'" }
 if ($WeightDecay) { $command += " --weight_decay '$WeightDecay'" }
 if ($UseCheckpoint) { $command += " --use_checkpoint" }
+if ($Packing) { $command += " --packing" }
+if ($GroupByLength) { $command += " --group_by_length" }
+if ($NumProc) { $command += " --num_proc $NumProc" }
+if ($NoCache) { $command += " --no_cache" }
+if ($Streaming) { $command += " --streaming" }
+if ($ShuffleBuffer) { $command += " --shuffle_buffer $ShuffleBuffer" }
+if ($MaxSteps) { $command += " --max_steps $MaxSteps" }
+if ($Profile) { $command += " --profile" }
+if ($ProfileSteps) { $command += " --profile_steps '$ProfileSteps'" }
 
 # Execute the python script inside the container
 try {